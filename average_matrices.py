@@ -0,0 +1,77 @@
+"""
+Average all the matrices of the healthy controls of each center.
+
+The matrices of all the subjects are stacked in a cohort (lib/cohort.py), the
+first time or with --rebuild, and the averages are computed over the stacks.
+For each center, saves in out_dir:
+ - {center}_HC_SC_weights.txt: average of the normalized weights (as TVB)
+ - {center}_HC_SC_weights_nonorm.txt
+ - {center}_HC_SC_distances.txt
+ - {center}_HC_r_matrix.csv, {center}_HC_zr_matrix.csv (average of the Fisher z)
+
+example: python average_matrices.py --in_csv subjects.csv --data_dir /DATA/MAGNIMS2021 --out_dir averages
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from lib.cohort import build_cohort, open_cohort, normalized_weights, group_average
+from lib.fc import fisher_z
+
+
+def average_matrices(in_csv, data_dir, out_dir, cohort_dir, group_col, control_label, rebuild=False):
+    if rebuild or not os.path.isfile(f"{cohort_dir}/cohort_index.csv"):
+        df = pd.read_csv(in_csv, dtype={"SubjID": str, "CENTER": str})
+        subjects = df.rename(columns={"SubjID": "id"})
+        subjects["subj_dir"] = [
+            f"{data_dir}/{center}_Post/{subID}"
+            for subID, center in zip(subjects.id, subjects.CENTER)
+        ]
+        # only the subjects that have been processed
+        subjects = subjects[[os.path.isdir(d) for d in subjects.subj_dir]]
+        index, stacks = build_cohort(subjects, cohort_dir)
+    else:
+        index, stacks = open_cohort(cohort_dir)
+
+    if group_col not in index.columns:
+        raise ValueError(f"Column {group_col} not in {in_csv}")
+    controls = (index[group_col].astype(str) == control_label).to_numpy()
+    print(f"{controls.sum()} controls from {len(index)} subjects")
+
+    weights_norm, _ = normalized_weights(stacks)
+    averages = {
+        "SC_weights.txt": group_average(weights_norm, index, controls & index.has_sc),
+        "SC_weights_nonorm.txt": group_average(stacks["weights"], index, controls & index.has_sc),
+        "SC_distances.txt": group_average(stacks["lengths"], index, controls & index.has_sc),
+        "r_matrix.csv": group_average(stacks["r"], index, controls & index.has_fc),
+        "zr_matrix.csv": group_average(fisher_z(stacks["r"]), index, controls & index.has_fc),
+    }
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for name, by_center in averages.items():
+        delimiter = "," if name.endswith(".csv") else " "
+        for center, matrix in by_center.items():
+            np.savetxt(f"{out_dir}/{center}_{control_label}_{name}", matrix, delimiter=delimiter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Average the matrices of the healthy controls of each center")
+    parser.add_argument("--in_csv", type=str, required=True, help="csv with the subject info (general csv)")
+    parser.add_argument("--data_dir", type=str, required=True, help="output directory of the pipeline")
+    parser.add_argument("--out_dir", type=str, required=True, help="directory where the averages are saved")
+    parser.add_argument("--cohort_dir", type=str, help="directory of the cohort (by default, data_dir/cohort)")
+    parser.add_argument("--group_col", type=str, default="GROUP", help="column of in_csv with the group")
+    parser.add_argument("--control_label", type=str, default="HC", help="value of group_col for the controls")
+    parser.add_argument("--rebuild", action="store_true", help="stack the matrices again")
+    args = parser.parse_args()
+
+    average_matrices(
+        args.in_csv,
+        args.data_dir,
+        args.out_dir,
+        args.cohort_dir or f"{args.data_dir}/cohort",
+        args.group_col,
+        args.control_label,
+        args.rebuild,
+    )
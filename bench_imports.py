@@ -0,0 +1,99 @@
+"""
+Import time of the entry points of the pipeline.
+
+The entry points are launched thousands of times from job arrays, so they
+have to start fast: the heavy modules (numpy, nibabel, matplotlib, ...) are
+only imported by the steps that use them.
+
+Each entry point is imported in a new interpreter (python -X importtime), and
+the script fails if any heavy module has been imported, or if the import time
+is over its budget. Run it before committing changes to the entry points.
+
+example: python bench_imports.py --repeat 5
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+# entry point: budget of the import time (ms)
+ENTRY_POINTS = {
+    "run_pipeline_prime": 100,
+    "check_qc": 200,
+}
+
+# modules that the entry points should not import at startup
+HEAVY_MODULES = [
+    "numpy",
+    "pandas",
+    "scipy",
+    "nibabel",
+    "nilearn",
+    "matplotlib",
+    "joblib",
+    "mrivis",
+]
+
+
+def import_time(module):
+    """
+    Import a module in a new interpreter.
+    Returns the import time (ms), the heavy modules imported and the times
+    of all the modules imported ({module: cumulative ms})
+    """
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {module}:\n{result.stderr}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    heavy = [m for m in result.stdout.strip().split(",") if m]
+    return times[module], heavy, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the entry points")
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_POINTS), help="entry points to check")
+    parser.add_argument("--repeat", type=int, default=3, help="imports of each entry point (the fastest is kept)")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports shown for each entry point")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeat)]
+        ms, heavy, times = min(runs, key=lambda r: r[0])
+        budget = ENTRY_POINTS.get(module)
+
+        problems = []
+        if heavy:
+            problems.append(f"imports {', '.join(heavy)}")
+        if budget is not None and ms > budget:
+            problems.append(f"over the budget of {budget} ms")
+        failed = failed or bool(problems)
+
+        print(f"{module}: {ms:.1f} ms {'FAIL: ' + '; '.join(problems) if problems else 'OK'}")
+        slowest = sorted(
+            ((t, m) for m, t in times.items() if m != module), reverse=True
+        )[: args.top]
+        for t, m in slowest:
+            print(f"    {t:8.1f} ms  {m}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Time of the QC mosaics of lib/qc_render.py, reading the volumes as before
+(slice by slice through the array proxy) and with load_image (compressed
+files read once).
+
+The volumes of a check are rendered several times (collage, color mix,
+checkerboard...), so each volume is rendered --renders times. The script
+fails if load_image is slower than the proxy for any of the volumes (by more
+than TOLERANCE: uncompressed volumes are read in the same way).
+Without volumes, a synthetic one is written in a temporal directory (as
+.nii.gz and .nii).
+
+example: python bench_qc_render.py sub/recon_all/mri/norm.mgz sub/dt_proc/mean_b0_preprocessed.nii.gz
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+TOLERANCE = 0.1
+
+def render_time(img, out_dir, renders):
+    """
+    Seconds to render the collage of a volume renders times
+    """
+    from lib.qc_render import collage
+
+    t0 = time.perf_counter()
+    for i in range(renders):
+        collage(img, os.path.join(out_dir, f"bench_{i}"))
+    return time.perf_counter() - t0
+
+
+def synthetic_volumes(out_dir, shape=(160, 192, 160)):
+    import numpy as np
+    import nibabel as nib
+
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 20, shape).astype(np.float32)
+    paths = []
+    for ext in (".nii.gz", ".nii"):
+        path = os.path.join(out_dir, f"synthetic{ext}")
+        nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the QC mosaics with and without load_image")
+    parser.add_argument("volumes", nargs="*", help="volumes to render (by default, a synthetic one)")
+    parser.add_argument("--renders", type=int, default=3, help="mosaics of each volume")
+    args = parser.parse_args()
+
+    import nibabel as nib
+    from lib.qc_render import load_image
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        volumes = args.volumes or synthetic_volumes(tmp)
+        for path in volumes:
+            # as before: the proxy, each slice read from the file
+            proxy = render_time(nib.load(path), tmp, args.renders)
+            load_image.cache_clear()
+            t0 = time.perf_counter()
+            img = load_image(path)
+            loaded = time.perf_counter() - t0
+            rendered = render_time(img, tmp, args.renders)
+
+            slower = loaded + rendered > proxy * (1 + TOLERANCE)
+            failed = failed or slower
+            print(
+                f"{os.path.basename(path)}: proxy {proxy:.2f} s, load_image {loaded + rendered:.2f} s "
+                f"(load {loaded:.2f} s) {'FAIL: slower' if slower else 'OK'}"
+            )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
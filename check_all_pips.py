@@ -3,74 +3,125 @@ Script that jointly checks for all the datasets that we have.
 
 This builds over all the datasets and creates a csv with the progress
 of the preprocessing for all of them.
+
+The checks are stat calls over {CENTER}_Post/{subID} (network filesystem), so
+they are run in a pool of threads. The modification times of the directories
+where each step writes its outputs are cached in the state store
+(lib/pipeline_state.py): subjects where none of them changed are skipped, and
+only the rows that changed are updated. pipeline.csv is exported from the store
+only if something changed.
 """
 
-import pandas as pd
-import numpy as np
-import datetime
+import argparse
 import os
-
-out_dir = "
-total_csv = f"{out_dir}/data_total.csv"
-
-df_total = pd.read_csv(total_csv)
-
-subj_list = []
-centre_list = []
-completion_list = [[] for i in range(6)]
-
-# iterate over subjects, 
-for row in df_total.itertuples():
-
-    # subject dir
-    subID = row.SubjID
-
-    centre_list.append(row.CENTER)
-
-    subj_list.append(subID)
-
-    out_dir_subject = f'{out_dir}/{row.CENTER}_Post/{subID}'
-
-    if not os.path.exists(out_dir_subject):
-        os.makedirs(out_dir_subject)
-        
-    #1 Fastsurfer
-    fastsurfer_done = os.path.isfile(f'{out_dir_subject}/recon_all/scripts/recon-all.done') and os.path.isfile(f'{out_dir_subject}/recon_all/scripts/recon-surf.done')
-    completion_list[0].append(fastsurfer_done)
-
-    #1.5 WM Lesion Segmentation
-    # NO INCLUSION BECAUSE A LOT OF VARIABILITY AND ISSUES (HEALTHIES, OHTERS) - JUST DO MANUALLY
-    # lst_done = os.path.isfile(f'{base_data_dir}/{subID}/r{subID}_ROI_00.nii.gz') or os.path.isfile(f'{base_data_dir}/{subID}/{subID}_ROI.nii.gz')
-    # completion_list[1].append(lst_done)
-
-    #2 DWI preprocessing
-    dt_done = os.path.isfile(f'{out_dir_subject}/dt_proc/connectome_weights.csv')
-    completion_list[2].append(dt_done)
-
-    #3 compute SC
-    sc_done = os.path.isfile(f'{out_dir_subject}/dt_proc/connectome_weights.csv')
-    completion_list[3].append(sc_done)
-
-    #4 fMRI
-    fmri_done = os.path.isfile(f'{out_dir_subject}/fmri_proc_dti/r_matrix.nii.gz')
-    completion_list[4].append(fmri_done)
-
-    #5 convert to TVB
-    # tvb lite
-    tvb_done = os.path.isfile(f'{out_dir_subject}/results/{subID}_SC_distances.txt') and os.path.isfile(f'{out_dir_subject}/results/{subID}_SC_weights.txt') and os.path.isfile(f'{out_dir_subject}/results/r_matrix.csv') and os.path.isfile(f'{out_dir_subject}/results/Connectivity.zip')
-    completion_list[5].append(tvb_done)
-
-# create dictionary
-dict_check = {
-    "id": subj_list,
-    "CENTER": centre_list,
-    "fastsurfer": completion_list[0],
-    "DWI_preproc": completion_list[2],
-    "agg_SC": completion_list[3],
-    "fMRI": completion_list[4],
-    "toTVB": completion_list[5]
-}
-
-# save csv tofile
-pd_results = pd.DataFrame(dict_check)
-pd_results.to_csv(f"{out_dir}/pipeline.csv", index=False)
\ No newline at end of file
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from lib.pipeline_state import PipelineState, check_subject
+
+# directories where the checked outputs are created (creating or removing a
+# file changes the modification time of its directory)
+WATCHED_DIRS = ["", "recon_all/scripts", "dt_proc", "fmri_proc_dti", "results"]
+
+
+def subject_signature(out_dir_subject):
+    """
+    Modification times of the watched directories of a subject
+    (or - if they don't exist)
+    """
+    mtimes = []
+    for d in WATCHED_DIRS:
+        try:
+            mtimes.append(str(os.stat(f"{out_dir_subject}/{d}").st_mtime_ns))
+        except FileNotFoundError:
+            mtimes.append("-")
+    return ",".join(mtimes)
+
+
+def scan_subject(subID, center, out_dir, cached_signature):
+    """
+    Check a subject, only if it changed since the last time.
+    Returns (subID, center, signature, steps or None if unchanged, seconds)
+    """
+    start = time.perf_counter()
+    out_dir_subject = f"{out_dir}/{center}_Post/{subID}"
+    signature = subject_signature(out_dir_subject)
+    done = None
+    if signature != cached_signature:
+        # WM Lesion Segmentation: NO INCLUSION BECAUSE A LOT OF VARIABILITY AND ISSUES (HEALTHIES, OHTERS) - JUST DO MANUALLY
+        done = check_subject(out_dir_subject, subID)
+    return subID, center, signature, done, time.perf_counter() - start
+
+
+def check_all_pips(out_dir, njobs=16, full=False):
+    """
+    Check all the subjects of {out_dir}/data_total.csv and update the
+    state store ({out_dir}/pipeline.db) and {out_dir}/pipeline.csv
+    """
+    df_total = pd.read_csv(f"{out_dir}/data_total.csv", dtype={"SubjID": str})
+    state = PipelineState(f"{out_dir}/pipeline.db")
+    cached = {} if full else state.scan_signatures()
+    current = {(r["CENTER"], r["id"]): r for r in state.rows()}
+
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        results = list(
+            pool.map(
+                lambda row: scan_subject(
+                    row.SubjID, row.CENTER, out_dir, cached.get((row.CENTER, row.SubjID))
+                ),
+                df_total.itertuples(),
+            )
+        )
+
+    changed = []
+    signatures = []
+    timing = {}
+    for subID, center, signature, done, seconds in results:
+        is_changed = False
+        if done is not None:
+            signatures.append((subID, center, signature))
+            old = current.get((center, subID))
+            if old is None or any(old[k] != v for k, v in done.items()):
+                changed.append((subID, center, done))
+                is_changed = True
+        n, n_checked, n_changed, total = timing.get(center, (0, 0, 0, 0.0))
+        timing[center] = (
+            n + 1,
+            n_checked + (done is not None),
+            n_changed + is_changed,
+            total + seconds,
+        )
+
+    # only the rows that changed
+    state.set_many(changed)
+    state.set_scan_signatures(signatures)
+    if changed or not os.path.isfile(f"{out_dir}/pipeline.csv"):
+        state.export_csv(f"{out_dir}/pipeline.csv")
+
+    # time spent per center, to see which mount is slow
+    for center, (n, n_checked, n_changed, total) in sorted(timing.items()):
+        print(
+            f"{center}: {n} subjects, {n_checked} checked, {n_changed} changed, "
+            f"{total:.2f}s ({1000 * total / n:.1f} ms/subject)"
+        )
+
+    return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the state of the pipeline for all the subjects"
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        required=True,
+        help="general directory, with data_total.csv and the {CENTER}_Post directories",
+    )
+    parser.add_argument("--njobs", type=int, default=16, help="Number of threads")
+    parser.add_argument(
+        "--full", action="store_true", help="check all the subjects, ignoring the cache"
+    )
+    args = parser.parse_args()
+
+    check_all_pips(args.out_dir, args.njobs, args.full)
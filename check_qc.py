@@ -7,28 +7,35 @@ Each step needs to have an own function to properly work
 Also, generate comparison images and values that are useful to rapidly assess
 the correctness of the preprocessing steps.
 
-Use this class:
-https://raamana.github.io/mrivis/readme.html
+The images are rendered with lib/qc_render.py (same images as
+https://raamana.github.io/mrivis/readme.html, only the slices that are shown).
+Compressed volumes (.nii.gz, .mgz) are read once in full and kept in memory,
+only the uncompressed ones are read slice by slice
 
-Compute SSIM between intermediate images
+Compute SSIM between intermediate images, and other numeric metrics
+(lib/qc_metrics.py), saved for all the subjects in qc_metrics.csv
 """
 
-import numpy as np
 import os
-import mrivis
-from mrivis.utils import read_image, scale_0to1
-import matplotlib.pyplot as plt
+import sys
 import click
-import subprocess
-import numpy as np
 import glob
-import pandas as pd
+from lib import qc_report
+from lib.supervisor import supervise
 
+# seconds before QC_track.sh is killed
+QC_TRACK_TIMEOUT = 3600
 
-def run_checks(subj_dir, type_dir, out_dir, fs, lst, dt, fc, track, matrix_plot):
+# the rendering (numpy, nibabel, matplotlib) and the pool are imported only
+# when a check runs, so subjects that are up to date (and --help) are fast
+
+
+def run_checks(subj_dir, type_dir, out_dir, checks):
     """
     General function to run the checks.
-    Flag inputs will select the evaluation functions to run.
+    checks: names of the checks to run (see CHECKS)
+    Only the checks whose inputs have changed since the last time are run,
+    and the results are saved in the QC manifest of the subject (lib/qc_report.py)
     """
 
     # check if subject exists
@@ -42,59 +49,52 @@ def run_checks(subj_dir, type_dir, out_dir, fs, lst, dt, fc, track, matrix_plot)
     subID = os.path.basename(subj_dir.rstrip("/"))
     print(f"Running QC for... {subID}")
 
+    # volumes of the previous subject are not needed anymore
+    # (the same volumes, T1, norm, mean b0, are shared by the checks of a subject)
+    if "lib.qc_render" in sys.modules:
+        sys.modules["lib.qc_render"].load_image.cache_clear()
+
     if not os.path.exists(f"{out_dir}/{type_dir}_{subID}"):
         os.makedirs(f"{out_dir}/{type_dir}_{subID}")
 
     out_dir = f"{out_dir}/{type_dir}_{subID}"
 
+    manifest = qc_report.load_manifest(out_dir) or qc_report.new_manifest(
+        subID, type_dir
+    )
+
     # Run specific tests
     # Each function should return an exception if the files that we are
-    # if QC has already run, dont do it again
-    """
-    if fs and not os.path.isfile(f'{out_dir}/1fs_seg_overlay2.png'):
-        try:
-            check_FastSurfer(subj_dir, out_dir, subID)
-        except FileNotFoundError:
-            print('Freesurfer QC failed!')
-    """
-    """
-    if lst and not os.path.isfile(f'{out_dir}/{subID}_2flair_lesionseg_dil.png'):
-        try:
-            check_LesionSeg(subj_dir, out_dir, subID)
-        except (FileNotFoundError, IOError) as e:
-            print('LesionSegmentation QC failed!')
-    
-    if dt and not os.path.isfile(f'{out_dir}/{subID}_2dt_t1_seg_overlay.png'):
-        try:
-            check_DTrecon(subj_dir, out_dir, subID)
-        except FileNotFoundError:
-            print("DT_recon QC failed!")
-    """
-    """
-    if dt and not os.path.isfile(f'{out_dir}/{subID}_3dtmask_checkbiascorrect.png'):
-        try:
-            check_DTMask(subj_dir, out_dir, subID)
-        except FileNotFoundError:
-            print("DT_recon Mask QC failed!")
-    """
-    """
-    if fc and not os.path.isfile(f'{out_dir}/{subID}_6fmri_t1_checkerboard.png'): 
-        try:
-            check_fMRI(subj_dir, out_dir, subID)
-        except FileNotFoundError:
-            print('fMRI QC failed!')
-    
-    if track and not os.path.isfile(f'{out_dir}/{subID}_track_tdi_count_AEC.png'): 
-        try:
-            check_Tracking(subj_dir, out_dir, subID)
-        except FileNotFoundError:
-            print('Tracking QC failed!')
-    """
-    if matrix_plot and not os.path.isfile(f"{out_dir}/{subID}_9fig_FChist.png"):
+    # if QC has already run with the same inputs, dont do it again
+    for name in checks:
+        func, inputs = CHECKS[name]
+        entry = manifest["checks"].get(name)
+        hashes = qc_report.check_inputs(
+            subj_dir, inputs, entry["inputs"] if entry else None
+        )
+        if qc_report.is_up_to_date(entry, hashes, out_dir):
+            continue
+
+        before = qc_report.image_mtimes(out_dir)
         try:
-            plot_connectivity(subj_dir, out_dir, subID)
-        except FileNotFoundError:
-            print("Connectivity FC failed!")
+            metrics = func(subj_dir, out_dir, subID)
+            status, error = "ok", None
+        except Exception as e:
+            print(f"{name} QC failed! {e!r}")
+            metrics, status, error = None, "failed", repr(e)
+        images = qc_report.new_images(before, qc_report.image_mtimes(out_dir))
+        qc_report.record_check(
+            manifest,
+            name,
+            hashes,
+            images,
+            metrics if isinstance(metrics, dict) else None,
+            status,
+            error,
+        )
+
+    qc_report.save_manifest(out_dir, manifest)
+    qc_report.write_fragment(out_dir, manifest)
 
 
 def check_FastSurfer(subj_dir, out_dir, subID):
@@ -111,6 +111,8 @@ def check_FastSurfer(subj_dir, out_dir, subID):
     The scripts also checks that the necessary files generated by FS exist, and if not, raises
     an exception
     """
+    from lib.qc_render import load_image, collage, color_mix
+
     # We assume that recon_all is in the root of subj_dir
     recon_all_path = f"{subj_dir}/recon_all"
     # T1 and brain should be already in nii if FastSurfer.sh has been run
@@ -128,32 +130,25 @@ def check_FastSurfer(subj_dir, out_dir, subID):
             "Files generated by FS not found. Make sure that the pipeline has run correctly!"
         )
 
-    # load and scale images
-    t1 = scale_0to1(read_image(t1_path, None))
-    brain = scale_0to1(read_image(brain_path, None))
-    seg = scale_0to1(read_image(seg_path, None))
+    # load images (only the header, the slices are read when rendering)
+    t1 = load_image(t1_path)
+    brain = load_image(brain_path)
+    seg = load_image(seg_path)
 
     ## COLLAGE OF T1
-    collage = mrivis.Collage()
-    collage.attach(t1)
-    collage.save(output_path=f"{out_dir}/{subID}_fs_t1_collage")
-    plt.close()
+    collage(t1, output_path=f"{out_dir}/{subID}_fs_t1_collage")
 
     ## COLLAGE OF BRAIN
-    collage = mrivis.Collage()
-    collage.attach(brain)
-    collage.save(output_path=f"{out_dir}/{subID}_fs_brain_collage")
-    plt.close()
+    collage(brain, output_path=f"{out_dir}/{subID}_fs_brain_collage")
 
     ## OVERLAY BETWEEN SEGMENTATION AND BRAIN
-    mrivis.color_mix(
+    color_mix(
         brain,
         seg,
         num_slices=10,
         alpha_channels=(1, 1),
         output_path=f"{out_dir}/{subID}_1fs_seg_overlay2",
     )
-    plt.close()
 
 
 def check_LesionSeg(subj_dir, out_dir, subID):
@@ -164,6 +159,7 @@ def check_LesionSeg(subj_dir, out_dir, subID):
     - Over the T1
     - Check registration between T1 and FLAIR
     """
+    from lib.qc_render import load_image, color_mix, checkerboard
 
     # We assume that recon_all is in the root of subj_dir
     recon_all_path = f"{subj_dir}/recon_all"
@@ -183,45 +179,48 @@ def check_LesionSeg(subj_dir, out_dir, subID):
     elif len(glob.glob(f"{subj_dir}/anat/FLAIR2T1.nii.gz")) > 0:
         flair_path = f"{subj_dir}/anat/FLAIR2T1.nii.gz"
 
-    t1 = scale_0to1(read_image(t1_path, None))
-    seg_dil = scale_0to1(read_image(seg_dil_path, None))
-    seg = scale_0to1(read_image(seg_path, None))
+    t1 = load_image(t1_path)
+    seg_dil = load_image(seg_dil_path)
+    seg = load_image(seg_path)
 
     if flair_path is not None:
-        os.system(f"mri_convert -c -rt nearest {flair_path} {flair_path}_256.nii.gz")
-        flair = scale_0to1(read_image(f"{flair_path}_256.nii.gz", None))
+        # resampled in the 256 grid of the lesions only on the slices shown,
+        # no need to reslice it with mri_convert
+        flair = load_image(flair_path)
 
     # show the lesions over the T1
     ## OVERLAY BETWEEN SEGMENTATION AND BRAIN
     if flair_path is not None:
         # mrivis.color_mix(flair, seg, num_slices=10, alpha_channels=(1, 0.2), output_path=f'{out_dir}/2flair_lesionseg')
         # plt.close()
-        mrivis.color_mix(
+        color_mix(
             flair,
             seg_dil,
             num_slices=10,
             alpha_channels=(1, 0.3),
+            grid=seg_dil,
             output_path=f"{out_dir}/{subID}_2flair_lesionseg_dil",
         )
-        plt.close()
     else:
         # if flair not available
         # mrivis.color_mix(t1, seg, num_slices=10, alpha_channels=(1, 0.2), output_path=f'{out_dir}/2flair_lesionseg')
         # plt.close()
-        mrivis.color_mix(
+        color_mix(
             t1,
             seg_dil,
             num_slices=10,
             alpha_channels=(1, 0.3),
             output_path=f"{out_dir}/{subID}_2flair_lesionseg_dil",
         )
-        plt.close()
 
     if flair_path is not None:
-        mrivis.checkerboard(
-            flair, t1, patch_size=15, output_path=f"{out_dir}/{subID}_2flair_t1_check"
+        checkerboard(
+            flair,
+            t1,
+            patch_size=15,
+            grid=t1,
+            output_path=f"{out_dir}/{subID}_2flair_t1_check",
         )
-        plt.close()
 
 
 def check_DTMask(subj_dir, out_dir, subID):
@@ -229,23 +228,31 @@ def check_DTMask(subj_dir, out_dir, subID):
     Check the mask generated from the dwi, to see if the dwbiascorrect
     has affected positively or negatively
     """
+    from lib.qc_render import load_image, color_mix
+    from lib.qc_metrics import mask_metrics
+
     dwi = f"{subj_dir}/dt_proc/mean_b0_preprocessed.nii.gz"
     dwi_mask = f"{subj_dir}/dt_proc/dwi_ec_unbiased_mask.nii.gz"
 
     # check paths existing
 
     # load the images
-    dwi = scale_0to1(read_image(dwi, None))
-    dwi_mask = scale_0to1(read_image(dwi_mask, None))
+    dwi_mask_path = dwi_mask
+    dwi = load_image(dwi)
+    dwi_mask = load_image(dwi_mask)
 
-    mrivis.color_mix(
+    color_mix(
         dwi_mask,
         dwi,
         num_slices=10,
         alpha_channels=(0.3, 1.0),
         output_path=f"{out_dir}/{subID}_3dtmask_checkbiascorrect",
     )
-    plt.close()
+
+    # fraction of the mask inside the brain (5tt in diffusion space), only
+    # the volume of the mask without it
+    seg5tt = f"{subj_dir}/dt_proc/5tt2diff.nii"
+    return mask_metrics(dwi_mask_path, seg5tt if os.path.exists(seg5tt) else None)
 
 
 def check_DTrecon(subj_dir, out_dir, subID):
@@ -262,6 +269,7 @@ def check_DTrecon(subj_dir, out_dir, subID):
 
     We assume that the DT_recon step of the pipeline has been run beforehand.
     """
+    from lib.qc_render import load_image, collage, color_mix
 
     # paths of relevant images
     og_b0 = f"{subj_dir}/dt_proc/dwi_b0.nii.gz"
@@ -287,31 +295,22 @@ def check_DTrecon(subj_dir, out_dir, subID):
         )
 
     # do I need to load the images, similar to the previous one? sure
-    og_b0 = scale_0to1(read_image(og_b0, None))
-    proc_b0 = scale_0to1(read_image(proc_b0, None))
-    FA = scale_0to1(read_image(FA, None))
-    seg5tt = scale_0to1(read_image(seg5tt, None))
-    t1 = scale_0to1(read_image(t1, None))
-    seg5tt_wm = scale_0to1(read_image(seg5tt_wm, None))
-    seg5tt_csf = scale_0to1(read_image(seg5tt_csf, None))
+    og_b0 = load_image(og_b0)
+    proc_b0 = load_image(proc_b0)
+    FA = load_image(FA)
+    seg5tt = load_image(seg5tt)
+    t1 = load_image(t1)
+    seg5tt_wm = load_image(seg5tt_wm)
+    seg5tt_csf = load_image(seg5tt_csf)
 
     # collage of DT b0, not processed
-    collage = mrivis.Collage()
-    collage.attach(og_b0)
-    collage.save(output_path=f"{out_dir}/{subID}_dt_b0_unproc")
-    plt.close()
+    collage(og_b0, output_path=f"{out_dir}/{subID}_dt_b0_unproc")
 
     # collage of DT b0, processed
-    collage = mrivis.Collage()
-    collage.attach(proc_b0)
-    collage.save(output_path=f"{out_dir}/{subID}_dt_b0_proc")
-    plt.close()
+    collage(proc_b0, output_path=f"{out_dir}/{subID}_dt_b0_proc")
 
     # FA image, visualization
-    collage = mrivis.Collage()
-    collage.attach(FA)
-    collage.save(output_path=f"{out_dir}/{subID}_dt_FA")
-    plt.close()
+    collage(FA, output_path=f"{out_dir}/{subID}_dt_FA")
     # visualize 5tt.wm and 5tt.csf (will be useful also for later)
     # collage = mrivis.Collage()
     # collage.attach(seg5tt_wm)
@@ -320,7 +319,7 @@ def check_DTrecon(subj_dir, out_dir, subID):
 
     # registration between T1 and wm (color mix)
     # TODO DO COLOR MIX
-    mrivis.color_mix(
+    color_mix(
         t1,
         seg5tt_wm,
         num_slices=10,
@@ -329,7 +328,6 @@ def check_DTrecon(subj_dir, out_dir, subID):
     )
     # mrivis.checkerboard(t1, seg5tt_wm)
     # plt.savefig(f'{out_dir}/dt_reg_t1_wm.png')
-    plt.close()
 
     # collage = mrivis.Collage()
     # collage.attach(seg5tt_csf)
@@ -338,7 +336,7 @@ def check_DTrecon(subj_dir, out_dir, subID):
 
     # registration between T1 and wm (color mix)
     # TODO DO COLOR MIX
-    mrivis.color_mix(
+    color_mix(
         t1,
         seg5tt_csf,
         num_slices=10,
@@ -347,21 +345,19 @@ def check_DTrecon(subj_dir, out_dir, subID):
     )
     # mrivis.checkerboard(t1, seg5tt_csf)
     # plt.savefig(f'{out_dir}/dt_reg_t1_csf.png')
-    plt.close()
 
     # 5TT over T1 (color mix)
     # mrivis.color_mix(t1, seg5tt, num_slices=10, alpha_channels=(1,1), output_path=f'{out_dir}/dt_seg_overlay')
     # plt.close()
 
     # 5TT over DT (color mix)
-    mrivis.color_mix(
+    color_mix(
         proc_b0,
         seg5tt,
         num_slices=10,
         alpha_channels=(1, 0.7),
         output_path=f"{out_dir}/{subID}_2dt_t1_seg_overlay",
     )
-    plt.close()
 
 
 def check_Tracking(subj_dir, out_dir, subID):
@@ -375,6 +371,8 @@ def check_Tracking(subj_dir, out_dir, subID):
 
     IN TRACKING, I DO A
     """
+    from lib.qc_render import load_image, color_mix, checkerboard
+    from lib.qc_metrics import registration_metrics
 
     # check that files exists
     dwi_proc = f"{subj_dir}/dt_proc/mean_b0_preprocessed.nii.gz"
@@ -392,15 +390,14 @@ def check_Tracking(subj_dir, out_dir, subID):
         )
 
     output_file = f"{out_dir}/log_qctrack.txt"
-    # redirect all output to file
-    with open(output_file, "w") as f:
-        cmd = subprocess.Popen(
-            f"exec scripts/QC_track.sh {subj_dir} {out_dir} {subID}",
-            shell=True,
-            stdout=f,
-            stderr=f,
-        )
-        cmd.wait()
+    # redirect all output to file, killed if it hangs
+    result = supervise(
+        f"scripts/QC_track.sh {subj_dir} {out_dir} {subID}",
+        output_file,
+        timeout=QC_TRACK_TIMEOUT,
+    )
+    if result["status"] == "timeout":
+        raise TimeoutError(f"QC_track.sh took more than {QC_TRACK_TIMEOUT} s")
 
     # check if the script has worked (this is, )
     # tdi_count_AEC = f'{out_dir}/track_tdi_count_AEC.nii.gz'
@@ -408,32 +405,34 @@ def check_Tracking(subj_dir, out_dir, subID):
     anat2diff = f"{subj_dir}/dt_proc/anat2diff.nii.gz"
     nodes2diff = f"{subj_dir}/dt_proc/nodes2diff.nii.gz"
 
+    # registration quality between anat and dti (anat2diff is made by
+    # Tracking.sh, so it is measured here and not in check_DTrecon)
+    metrics = registration_metrics(anat2diff, dwi_proc)
+
     # load images for collage
-    dwi_proc = scale_0to1(read_image(dwi_proc, None))
-    # tdi_count_AEC = scale_0to1(read_image(tdi_count_AEC, None))
-    # tdi_fractional_AEC = scale_0to1(read_image(tdi_fractional_AEC, None))
-    anat2diff = scale_0to1(read_image(anat2diff, None))
-    nodes2diff = scale_0to1(read_image(nodes2diff, None))
+    dwi_proc = load_image(dwi_proc)
+    # tdi_count_AEC = load_image(tdi_count_AEC)
+    # tdi_fractional_AEC = load_image(tdi_fractional_AEC)
+    anat2diff = load_image(anat2diff)
+    nodes2diff = load_image(nodes2diff)
 
     # check registration of anat and dti
-    mrivis.checkerboard(
+    checkerboard(
         dwi_proc,
         anat2diff,
         patch_size=15,
         output_path=f"{out_dir}/{subID}_3track_anat2diff_checkerboard",
     )
-    plt.close()
 
-    mrivis.color_mix(
+    color_mix(
         anat2diff,
         dwi_proc,
         num_slices=10,
         alpha_channels=(1, 0.7),
         output_path=f"{out_dir}/{subID}_4track_t1_seg_overlay",
     )
-    plt.close()
 
-    mrivis.color_mix(
+    color_mix(
         dwi_proc,
         nodes2diff,
         num_slices=10,
@@ -441,7 +440,6 @@ def check_Tracking(subj_dir, out_dir, subID):
         output_path=f"{out_dir}/{subID}_track_nodes2diff_overlay",
     )
     # mrivis.checkerboard(dwi_proc, nodes2diff, patch_size=15, output_path=f'{out_dir}/track_nodes2diff_overlay')
-    plt.close()
 
     # create collage of that prob mask
     # collage of DT b0, processed
@@ -450,12 +448,15 @@ def check_Tracking(subj_dir, out_dir, subID):
     # collage.save(output_path=f'{out_dir}/{subID}_track_tdi_count_AEC')
     # plt.close()
 
+    return metrics
+
 
 def check_fMRI(subj_dir, out_dir, subID):
     """
     Check the intermediate steps of the fMRI pipeline (mask, regression, correlation across specific points)
     to have a clear idea that everything has gone well
     """
+    from lib.qc_render import load_image, collage
 
     fmri_mean_brain = f"{subj_dir}/fmri_proc_dti/mean_func_brain.nii.gz"
     # fmri2t1 = f'{subj_dir}/fmri_proc/func2t1.nii.gz'
@@ -466,15 +467,12 @@ def check_fMRI(subj_dir, out_dir, subID):
             "Files generated by fMRIPROC not found. Make sure that the pipeline has run correctly!"
         )
 
-    fmri_mean_brain = scale_0to1(read_image(fmri_mean_brain, None))
-    t1 = scale_0to1(read_image(t1, None))
-    # fmri2t1 = scale_0to1(read_image(fmri2t1, None))
+    fmri_mean_brain = load_image(fmri_mean_brain)
+    t1 = load_image(t1)
+    # fmri2t1 = load_image(fmri2t1)
 
     # mean func brain
-    collage = mrivis.Collage()
-    collage.attach(fmri_mean_brain)
-    collage.save(output_path=f"{out_dir}/{subID}_fmri_mean_brain")
-    plt.close()
+    collage(fmri_mean_brain, output_path=f"{out_dir}/{subID}_fmri_mean_brain")
 
     # check alignment with T1
     # mrivis.color_mix(fmri2t1, t1, num_slices=10, alpha_channels=(0.7,0.7), output_path=f'{out_dir}/5fmri_t1_overlay')
@@ -492,29 +490,33 @@ def plot_connectivity(subj_dir, out_dir, subID):
         out_folder: name of the folder to put the images (will go inside subj_dir, and will be created if doesnt exist)
 
     """
-    # load matrices from disk
-    # TODO: LOAD THE NORMALIZED SC WEIGHTS WHEN IMPLEMENTED?
-    SC_path_weight = f"{subj_dir}/dt_proc/connectome_weights.csv"
-    SC_path_length = f"{subj_dir}/dt_proc/connectome_lengths.csv"
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from lib.connectivity_store import load_connectivity
+    from lib.qc_metrics import sc_metrics, fc_metrics
 
-    r_mat = f"{subj_dir}/fmri_proc_dti/r_matrix.csv"
-    zr_mat = f"{subj_dir}/fmri_proc_dti/zr_matrix.csv"
-    corrlabel_ts = f"{subj_dir}/fmri_proc_dti/corrlabel_ts.txt"
+    # load matrices from the connectivity store (csv for older subjects)
+    # TODO: LOAD THE NORMALIZED SC WEIGHTS WHEN IMPLEMENTED?
+    connectivity = load_connectivity(subj_dir)
 
-    if not (os.path.exists(SC_path_weight) and os.path.exists(SC_path_length)):
+    if not ("weights" in connectivity and "lengths" in connectivity):
         raise FileNotFoundError(
             "SC matrices not found. Make sure that the pipeline has been run correctly!"
         )
 
     """
-    if not (os.path.exists(r_mat) and os.path.exists(zr_mat) and os.path.exists(corrlabel_ts)):
+    if not ("r" in connectivity and "zr" in connectivity and "ts" in connectivity):
         raise FileNotFoundError("FC matrices not found. Make sure that the pipeline has been run correctly!")
     """
-    SC_weight = np.loadtxt(SC_path_weight, delimiter=",")
-    SC_length = np.loadtxt(SC_path_length, delimiter=",")
+    SC_weight = connectivity["weights"]
+    SC_length = connectivity["lengths"]
 
-    r_mat = np.loadtxt(r_mat, delimiter=",")
-    zr_mat = np.loadtxt(zr_mat, delimiter=",")
+    if not ("r" in connectivity and "zr" in connectivity):
+        raise FileNotFoundError("FC matrices not found.")
+    r_mat = connectivity["r"]
+    zr_mat = connectivity["zr"]
 
     plt.figure(figsize=(10, 4))
     plt.subplot(121), plt.title("weights"), plt.imshow(
@@ -536,6 +538,10 @@ def plot_connectivity(subj_dir, out_dir, subID):
     ), plt.colorbar()
     plt.savefig(f"{out_dir}/{subID}_8fig_FC.png")
     plt.close()
+
+    # numeric metrics of the SC and the FC
+    metrics = sc_metrics(SC_weight)
+    metrics.update(fc_metrics(r_mat, connectivity.get("ts")))
     """
     # compute histogram of FC and norm FC
     plt.figure(figsize=(15, 4))
@@ -546,7 +552,7 @@ def plot_connectivity(subj_dir, out_dir, subID):
     """
     """
     # compute bold from specific regions (regions collindant with each other, f. ex.) as a sanity check
-    corr_ts = np.loadtxt(corrlabel_ts)
+    corr_ts = connectivity["ts"]
 
     # indexs to use
     idx = [(5, 12), (27, 58), (16, 47)]
@@ -563,8 +569,108 @@ def plot_connectivity(subj_dir, out_dir, subID):
         plt.close()
     """
 
+    return metrics
+
+
+# checks: function and inputs (relative to the directory of the subject),
+# if the inputs change, the check is run again
+CHECKS = {
+    "fs": (
+        check_FastSurfer,
+        [
+            "recon_all/mri/T1.nii.gz",
+            "recon_all/mri/norm.nii.gz",
+            "recon_all/mri/aparc.DKTatlas+aseg.nii.gz",
+        ],
+    ),
+    "lst": (
+        check_LesionSeg,
+        [
+            "recon_all/mri/T1.nii.gz",
+            "dt_proc/lesions_dilated_std.nii.gz",
+            "lst/FLAIR2T1.nii.gz",
+            "anat/FLAIR2T1.nii.gz",
+        ],
+    ),
+    "dtmask": (
+        check_DTMask,
+        [
+            "dt_proc/mean_b0_preprocessed.nii.gz",
+            "dt_proc/dwi_ec_unbiased_mask.nii.gz",
+            "dt_proc/5tt2diff.nii",
+        ],
+    ),
+    "dt": (
+        check_DTrecon,
+        [
+            "dt_proc/dwi_b0.nii.gz",
+            "dt_proc/mean_b0_preprocessed.nii.gz",
+            "dt_recon/fa.nii.gz",
+            "dt_proc/5tt2diff_3d.nii.gz",
+            "recon_all/mri/norm.nii.gz",
+            "dt_proc/5tt.wm.nii.gz",
+            "dt_proc/5tt.csf.nii.gz",
+        ],
+    ),
+    "track": (
+        check_Tracking,
+        [
+            "dt_proc/mean_b0_preprocessed.nii.gz",
+            # the weights change with the tractogram, and are much smaller
+            "dt_proc/brain_track.txt",
+            "dt_proc/anat2diff.nii.gz",
+            "dt_proc/nodes2diff.nii.gz",
+        ],
+    ),
+    "fmri": (
+        check_fMRI,
+        [
+            "fmri_proc_dti/mean_func_brain.nii.gz",
+            "recon_all/mri/norm.nii.gz",
+        ],
+    ),
+    "connectivity": (
+        plot_connectivity,
+        [
+            "results/connectivity.npz",
+            "dt_proc/connectome_weights.csv",
+            "dt_proc/connectome_lengths.csv",
+            "fmri_proc_dti/r_matrix.csv",
+            "fmri_proc_dti/zr_matrix.csv",
+        ],
+    ),
+}
+
+
+def qc_subject(row, subj_dir, out_dir, checks):
+    """
+    Run the QC of a subject (row of the pipeline csv, as a dictionary)
+    """
+    subID = row["id"]
+    type_dir = row["CENTER"]
+
+    subj_dir_id = f"{subj_dir}/{type_dir}_Post/{subID}"
+
+    # run qc only in steps that have been done
+    done = {
+        "fs": row["fastsurfer"],
+        "lst": True,  # we assume truth, and if it fails, it fails
+        "dtmask": row["DWI_preproc"],
+        "dt": row["DWI_preproc"],
+        "track": row["agg_SC"],
+        "fmri": row["fMRI"],
+        "connectivity": True,  # and fc
+    }
+
+    # apply pipelines
+    # a subject that fails does not stop the rest of the pool
+    try:
+        run_checks(subj_dir_id, type_dir, out_dir, [c for c in checks if done[c]])
+    except Exception as e:
+        print(f"Something weird went on with {subID}: {e!r}")
+
 
-# example: python check_qc.py --out_dir /home/extop/GERARD/DATA/MAGNIMS2021/qc --subj_list test_ams_london.txt --pip_csv /home/extop/GERARD/DATA/MAGNIMS2021/pipeline.csv /home/extop/GERARD/DATA/MAGNIMS2021
+# example: python check_qc.py --njobs 8 --out_dir /home/extop/GERARD/DATA/MAGNIMS2021/qc --subj_list test_ams_london.txt --pip_csv /home/extop/GERARD/DATA/MAGNIMS2021/pipeline.csv /home/extop/GERARD/DATA/MAGNIMS2021
 # flags could be defined by the pipeline.csv: if that column is True, we
 
 
@@ -581,11 +687,28 @@ def plot_connectivity(subj_dir, out_dir, subID):
     type=click.STRING,
     help="csv with the current pipeline information for every subject",
 )
+@click.option(
+    "--njobs", default=1, type=click.INT, help="Number of subjects processed in parallel"
+)
+@click.option(
+    "--checks",
+    default="connectivity",
+    help=f"Comma separated checks to run, from: {','.join(CHECKS)}",
+)
+@click.option(
+    "--subjects_csv",
+    type=click.STRING,
+    help="csv with the subject info, its QC column (used by run_CONN.py) is updated from the annotations of the dashboard",
+)
 @click.argument("subj_dir")
-def run_all_subjects(subj_dir, out_dir, subj_list, pip_csv):
+def run_all_subjects(subj_dir, out_dir, subj_list, pip_csv, njobs, checks, subjects_csv):
     """
     Run over all subjects
     """
+    import numpy as np
+    import pandas as pd
+    from joblib import Parallel, delayed
+    from lib.qc_metrics import cohort_table
 
     df_pipeline = pd.read_csv(pip_csv)
     df_pipeline_todo = pd.DataFrame(columns=df_pipeline.columns, dtype=object)
@@ -603,26 +726,26 @@ def run_all_subjects(subj_dir, out_dir, subj_list, pip_csv):
         subj_list = []
         df_pipeline_todo = df_pipeline
 
-    for row in df_pipeline_todo.itertuples():
-        subID = row.id
-        type_dir = row.CENTER
-
-        subj_dir_id = f"{subj_dir}/{type_dir}_Post/{subID}"
-
-        # run qc only in steps that have been done
-        fs = row.fastsurfer
-        lst = True  # we assume truth, and if it fails, it fails
-        dt = row.DWI_preproc
-        fc = row.fMRI
-        track = row.agg_SC
-        matrix_plot = True  # and fc
-
-        # apply pipelines
-        # try:
-        run_checks(subj_dir_id, type_dir, out_dir, fs, lst, dt, fc, track, matrix_plot)
-        # except:
-        #     print(f"Something weird went on with {subID}")
-        #     continue
+    checks = [c.strip() for c in checks.split(",") if c.strip()]
+    unknown = set(checks) - set(CHECKS)
+    if unknown:
+        raise click.BadParameter(f"Unknown checks {unknown}")
+
+    # each subject in a different process
+    Parallel(n_jobs=njobs, backend="loky")(
+        delayed(qc_subject)(row, subj_dir, out_dir, checks)
+        for row in df_pipeline_todo.to_dict("records")
+    )
+
+    # table with the metrics of all the subjects, and dashboard
+    # (only the changed subjects are rendered again)
+    flagged = cohort_table(out_dir)
+    if len(flagged):
+        flagged = flagged[flagged.flagged != ""]
+        print(f"{len(flagged)} subjects flagged, see {out_dir}/qc_metrics.csv")
+    print(f"Dashboard in {qc_report.build_dashboard(out_dir)}")
+    if subjects_csv is not None:
+        qc_report.update_qc_column(out_dir, subjects_csv)
 
 
 if __name__ == "__main__":
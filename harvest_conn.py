@@ -0,0 +1,32 @@
+"""
+Harvest the results of CONN (run_CONN.py) of all the subjects, without
+running CONN again: the timeseries of the regions and the FC of CONN are read
+from the .mat files of each subject (only the variables needed), and the
+timeseries, FC, z-scored FC and FC of CONN are written to its CONN/results.
+
+The subjects are harvested in parallel (threads), and the ones whose results
+of CONN have not changed since the last harvest are skipped
+(lib/conn_results.py).
+
+example: python harvest_conn.py --out_dir /DATA/MAGNIMS2021 --njobs 16
+"""
+import argparse
+from lib.conn_results import harvest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Harvest the results of CONN of all the subjects")
+    parser.add_argument(
+        "--out_dir", type=str, required=True, help="output directory of the pipeline (the same of run_CONN.py)"
+    )
+    parser.add_argument("--center", type=str, help="only the subjects of a center")
+    parser.add_argument("--njobs", type=int, default=8, help="subjects harvested at the same time")
+    parser.add_argument("--force", action="store_true", help="harvest also the subjects that have not changed")
+    args = parser.parse_args()
+
+    counts = harvest(args.out_dir, args.center, args.njobs, args.force)
+    print(", ".join(f"{n} {status}" for status, n in counts.items()) or "No results of CONN found")
+
+
+if __name__ == "__main__":
+    main()
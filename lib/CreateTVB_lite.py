@@ -13,98 +13,100 @@ Adapted from CreateTVB.m to python. Original script by:
 
 """
 
+import argparse
 import numpy as np
 import os
-import shutil
-import zipfile
 from lib.change_segmentation import new_labels
-from nilearn.plotting import find_parcellation_cut_coords
-from nilearn.image import load_img
+from lib.fc import compute_fc
+from lib.connectivity_store import normalize_weights, save_store, store_path, export_tvb
+from lib.centroids import region_stats
 
-def CreateTVB(subjID, subj_dir, out_dir):
+def CreateTVB(subjID, subj_dir, out_dir, export=False):
     """
-    Main function to create the zip input to the TVB framework.
+    Main function to create the connectivity of the subject, input to the TVB framework.
     We assume that all the previous preprocessing steps have been done
-    Contents of the zip described in: docs.thevirtualbrain.org/manuals/UserGuide/DataExchange.html
+    Everything is saved once, in a binary store (lib/connectivity_store.py). The text files
+    and the zip described in: docs.thevirtualbrain.org/manuals/UserGuide/DataExchange.html
+    are only created if export is True (or later, with export_tvb)
     Input:
         subjID: ID of the subject
         subj_dir: Directory of the subject
         out_dir: Output directory
+        export: also write the TVB text files and Connectivity.zip
     Output:
-        no output, but {subjID}.zip created in output_dir, containing all the necessary files
+        no output, but connectivity.npz created in output_dir
     """
 
     # create output dir if doesnt exist
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    # load the SC matrices
+    # load the SC matrices (only place where the csv are parsed)
     SC_path_weight = f'{subj_dir}/dt_proc/connectome_weights.csv'
     SC_path_length = f'{subj_dir}/dt_proc/connectome_lengths.csv'
+    SC_path_count = f'{subj_dir}/dt_proc/connectome_counts.csv'
 
     SC_weight = np.loadtxt(SC_path_weight, delimiter=',')
     SC_length = np.loadtxt(SC_path_length, delimiter=',')
+    SC_count = np.loadtxt(SC_path_count, delimiter=',') if os.path.isfile(SC_path_count) else None
 
     # try different normalization for SC_weight
     # SC_weight_norm1 = SC_weight / max(sum(SC_weight))
-    results_SC_norm = SC_weight / max(np.sum(SC_weight, axis=0))
-
-    SC_weight_norm1 = (SC_weight - np.amin(SC_weight)) / (np.amax(SC_weight) - np.amin(SC_weight))
-    SC_weight_norm1 = SC_weight_norm1 * 0.2
-    # start writing the files
-
-    ### 1: Weights
-    # check if encoding is correct
-    # do we need to normalize?
-    # check for zeros?
-    np.savetxt(f'{out_dir}/{subjID}_SC_weights.txt', SC_weight_norm1, encoding='ascii')
-    np.savetxt(f'{out_dir}/{subjID}_SC_weights_nonorm.txt', SC_weight, encoding='ascii')
-
-    ### 2: Tract lengths
-    np.savetxt(f'{out_dir}/{subjID}_SC_distances.txt', SC_length, encoding='ascii')
-
-    # save again with the appropiate name for the connectivity
-    np.savetxt(f'{out_dir}/weights.txt', SC_weight_norm1, encoding='ascii')
-    np.savetxt(f'{out_dir}/tract_lengths.txt', SC_length, encoding='ascii')
+    SC_weight_norm1, results_SC_norm = normalize_weights(SC_weight)
 
     ### 2: Region centers
     # take the mean of every region
     # do the centers need to be existing vertices? NO
 
-    # load segmentation (new)
-    aseg_aparc = load_img(f'{subj_dir}/recon_all/mri/aparc.DKTatlas+aseg_newSeg.nii.gz')
+    # segmentation (new), center of mass of all the regions in one pass
+    # (cached next to the segmentation, see lib/centroids.py)
     labels_name_dict, fs_dict = new_labels()
     new_labels_dict = {fs_dict[k]: v for k, v in labels_name_dict.items()}
-
-    # use find_parcellation_cut_coords?
-    centers = find_parcellation_cut_coords(aseg_aparc)
-    # more complex than that 
-    with open(f'{out_dir}/centres.txt', 'w') as f:
-        # Write each line in the correct format
-        for (i, i_c) in enumerate(centers):
-            f.write(f'{new_labels_dict[i+1]} {i_c[0]} {i_c[1]} {i_c[2]}\n')
+    seg = f'{subj_dir}/recon_all/mri/aparc.DKTatlas+aseg_newSeg.nii.gz'
+    regions = region_stats(seg, n_regions=len(new_labels_dict))
+    centers = regions["centres"]
+    labels = np.array([new_labels_dict[i] for i in regions["labels"]])
+    # a region without voxels has no center (NaN), TVB can't use it
+    missing = labels[regions["volumes"] == 0]
+    if len(missing):
+        raise ValueError(f"Regions {', '.join(missing)} are not in {seg}!")
+
+    # fmri matrices
+    # keep both and we decide on runtime which one is the best option
+    # also need the information about the BOLD signal so that we can compute the metastability later
+    corrlabel_ts = np.loadtxt(f'{subj_dir}/fmri_proc_dti/corrlabel_ts.txt')
+    if os.path.isfile(f'{subj_dir}/fmri_proc_dti/r_matrix.csv') and os.path.isfile(f'{subj_dir}/fmri_proc_dti/zr_matrix.csv'):
+        r_matrix = np.loadtxt(f'{subj_dir}/fmri_proc_dti/r_matrix.csv', delimiter=',')
+        zr_matrix = np.loadtxt(f'{subj_dir}/fmri_proc_dti/zr_matrix.csv', delimiter=',')
+    else:
+        # compute them from the timeseries, same as run_CONN.py
+        r_matrix, zr_matrix = compute_fc(corrlabel_ts)
+
+    save_store(
+        store_path(out_dir),
+        weights=SC_weight,
+        weights_norm=SC_weight_norm1,
+        weights_norm_colsum=results_SC_norm,
+        lengths=SC_length,
+        counts=SC_count,
+        r=r_matrix,
+        zr=zr_matrix,
+        ts=corrlabel_ts,
+        labels=labels,
+        centres=np.asarray(centers, dtype=np.float64),
+        volumes=regions["volumes_mm3"],
+    )
+
+    if export:
+        export_tvb(store_path(out_dir), out_dir, subjID)
 
 
-    ## SAVE WEIGHTS AND TRACT ON CONNECTIVITY.ZIP
-    ## FINAL: Create ZIP
-    if os.path.isfile(f'{out_dir}/Connectivity.zip'): os.remove(f'{out_dir}/Connectivity.zip')
-    files_to_compress = ['weights.txt', 'tract_lengths.txt', 'centres.txt']
-    with zipfile.ZipFile(f'{out_dir}/Connectivity.zip', 'w') as myzip:
-        for f in files_to_compress:
-            myzip.write(f'{out_dir}/{f}', arcname=f)
-
-
-    # copy fmri matrix
-    # copy both and we decide on runtime which one is the best option
-    shutil.copy(f'{subj_dir}/fmri_proc_dti/r_matrix.csv', f'{out_dir}/')
-    shutil.copy(f'{subj_dir}/fmri_proc_dti/zr_matrix.csv', f'{out_dir}/')
-    # also need to copy the information about the BOLD signal so that we can compute the metastability later
-    shutil.copy(f'{subj_dir}/fmri_proc_dti/corrlabel_ts.txt', f'{out_dir}/')
-
-    
 if __name__ == "__main__":
-    subjID = 
-    subj_dir = 
-    out_dir = 
-
-    CreateTVB(subjID, subj_dir, out_dir)
+    parser = argparse.ArgumentParser(description="Create the connectivity store of a subject")
+    parser.add_argument("subjID", help="ID of the subject")
+    parser.add_argument("subj_dir", help="directory of the subject")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument("--export", action="store_true", help="also write the TVB text files and zip")
+    args = parser.parse_args()
+
+    CreateTVB(args.subjID, args.subj_dir, args.out_dir, args.export)
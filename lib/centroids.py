@@ -0,0 +1,108 @@
+"""
+Centers, volumes and bounding boxes of the regions of a segmentation.
+
+All the regions are computed in a single pass over the labelled voxels
+(np.bincount with the coordinates as weights), instead of one scan of the
+volume per label as nilearn find_parcellation_cut_coords. The centers are the
+center of mass (mean of the voxels) of each region, in voxel and in world
+coordinates (mm, through the affine).
+
+The results are cached next to the segmentation ({seg}_regions.npz), with the
+sha256 of the segmentation: they are only computed again if it changes.
+"""
+import os
+import numpy as np
+import nibabel as nib
+from lib.step_cache import file_hash
+
+
+def cache_path(seg):
+    return seg.replace(".nii.gz", "").replace(".nii", "") + "_regions.npz"
+
+
+def region_stats_from_data(data, affine, n_regions=None):
+    """
+    Stats of the regions 1..n_regions of a label volume (0 is the background).
+    Missing regions have volume 0 and NaN center and bounding box.
+    Returns a dictionary with:
+        labels: (n,) label of each region
+        volumes: (n,) number of voxels
+        volumes_mm3: (n,) volume in mm3
+        centres_vox: (n, 3) center of mass, voxel coordinates
+        centres: (n, 3) center of mass, world coordinates
+        bbox_min, bbox_max: (n, 3) bounding box (inclusive), voxel coordinates
+    """
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data).astype(np.int64)
+    if n_regions is None:
+        n_regions = max(int(data.max()), 0)
+
+    # only the labelled voxels
+    coords = np.nonzero(data > 0)
+    values = data[coords].astype(np.int64)
+    keep = values <= n_regions
+    coords = [c[keep] for c in coords]
+    values = values[keep]
+
+    n_bins = n_regions + 1
+    counts = np.bincount(values, minlength=n_bins)[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centres_vox = np.stack(
+            [np.bincount(values, weights=c, minlength=n_bins)[1:] / counts for c in coords],
+            axis=1,
+        )
+
+    # bounding box: for each axis, which positions each label touches
+    bbox_min = np.full((n_regions, 3), np.nan)
+    bbox_max = np.full((n_regions, 3), np.nan)
+    present = counts > 0
+    for axis, c in enumerate(coords):
+        size = data.shape[axis]
+        touched = np.bincount(values * size + c, minlength=n_bins * size)
+        touched = touched.reshape(n_bins, size)[1:] > 0
+        bbox_min[present, axis] = touched[present].argmax(axis=1)
+        bbox_max[present, axis] = size - 1 - touched[present, ::-1].argmax(axis=1)
+
+    centres = nib.affines.apply_affine(affine, centres_vox)
+    voxel_volume = abs(np.linalg.det(affine[:3, :3]))
+    return {
+        "labels": np.arange(1, n_regions + 1),
+        "volumes": counts,
+        "volumes_mm3": counts * voxel_volume,
+        "centres_vox": centres_vox,
+        "centres": centres,
+        "bbox_min": bbox_min,
+        "bbox_max": bbox_max,
+    }
+
+
+def region_stats(seg, n_regions=None, use_cache=True):
+    """
+    Stats of the regions of a segmentation file (see region_stats_from_data),
+    from the cache if the segmentation has not changed
+    """
+    sha = file_hash(seg)
+    path = cache_path(seg)
+    if use_cache and os.path.isfile(path):
+        try:
+            with np.load(path) as cached:
+                stats = {k: cached[k] for k in cached.files}
+            if str(stats.pop("sha256")) == sha and (
+                n_regions is None or len(stats["labels"]) == n_regions
+            ):
+                return stats
+        except (OSError, KeyError, ValueError):
+            pass
+
+    img = nib.load(seg)
+    stats = region_stats_from_data(np.asanyarray(img.dataobj), img.affine, n_regions)
+
+    # same folder, so the rename is atomic
+    tmp = f"{path}.tmp.npz"
+    try:
+        np.savez(tmp, sha256=sha, **stats)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not cache the regions of {seg}: {e}")
+    return stats
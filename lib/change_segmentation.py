@@ -126,40 +126,79 @@ def new_labels():
     return labels_name_dict, fs_dict
 
 
+def relabel_lut(max_label=None):
+    """
+    Build the lookup table that maps every FastSurfer label to our
+    sequential label (0 for the labels that we ignore).
+
+    max_label: largest label value that the table must cover. By default,
+               the largest label of new_labels().
+    """
+    _, fs_dict = new_labels()
+
+    if max_label is None:
+        max_label = max(int(k) for k in fs_dict.keys())
+
+    # 76 labels, fits in uint8
+    lut = np.zeros(int(max_label) + 1, dtype=np.uint8)
+    for key, value in fs_dict.items():
+        if int(key) <= max_label:
+            lut[int(key)] = value
+
+    return lut
+
+
 def new_segmentation(seg):
     """
     Function to update the segmentation obtained by FastSurfer to
     have sequenced values.
+
+    The volume is read with its native integer dtype and relabeled in a single
+    pass through a lookup table, instead of one boolean mask per label.
+    Returns the path of the new segmentation.
     """
     # load the image
     seg_nii = nib.load(seg)
 
-    labels_name_dict, fs_dict = new_labels()
+    # get original data, without casting it to float
+    seg_nii_data = np.asanyarray(seg_nii.dataobj)
+    if not np.issubdtype(seg_nii_data.dtype, np.integer):
+        seg_nii_data = np.rint(seg_nii_data).astype(np.int32)
 
-    # create empty numpy
-    new_data = np.zeros(seg_nii.shape, dtype=int)
-
-    # get original data
-    seg_nii_data = seg_nii.get_fdata().astype(int)
-
-    # for each value in the dict, fill the empty numpy
-    for key in fs_dict.keys():
-        mask_node = seg_nii_data == int(key)
-        new_data[mask_node] = fs_dict[key]
+    # labels outside the table (and negative ones) are not GM, map them to 0
+    lut = relabel_lut(max(int(seg_nii_data.max()), 0))
+    new_data = lut[np.clip(seg_nii_data, 0, None)]
 
     # save the values to a new image
     new_nii = nib.Nifti1Image(new_data, seg_nii.affine, seg_nii.header)
-    nib.save(new_nii, seg.replace(".nii.gz", "") + "_newSeg.nii.gz")
+    new_nii.set_data_dtype(np.uint8)
+    new_nii.header.set_slope_inter(1, 0)
+    out_seg = seg.replace(".nii.gz", "") + "_newSeg.nii.gz"
+    nib.save(new_nii, out_seg)
+
+    return out_seg
+
+
+def new_segmentation_batch(seg_list, njobs=1):
+    """
+    Relabel a list of segmentations in parallel, using a pool of processes.
+    Returns the list of new segmentations, in the same order.
+    """
+    from joblib import Parallel, delayed
+
+    return Parallel(n_jobs=njobs)(delayed(new_segmentation)(seg) for seg in seg_list)
 
 
 if __name__ == "__main__":
 
     # inputs
-    # first input should be the segmentation
-    try:
-        seg = sys.argv[1]
-    except:
+    # first input should be the segmentation, more than one will be done in parallel
+    seg_list = sys.argv[1:]
+    if len(seg_list) == 0:
         print("No file indicated")
         sys.exit()
 
-    new_segmentation(seg)
+    if len(seg_list) == 1:
+        new_segmentation(seg_list[0])
+    else:
+        new_segmentation_batch(seg_list, njobs=min(len(seg_list), os.cpu_count()))
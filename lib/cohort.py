@@ -0,0 +1,121 @@
+"""
+Cohort view of the connectivity of all the subjects.
+
+The SC weights, lengths and FC of all the subjects are stacked, once, in
+memory-mapped arrays (subjects x regions x regions) saved as .npy in the
+cohort directory, with an index (cohort_index.csv) with the subject and center
+of each row. Subjects without a matrix have it filled with NaN.
+
+The normalizations, the Fisher z (lib/fc.py) and the averages are computed for all
+the subjects at the same time, over the stacks, instead of parsing the csv
+of each subject every time.
+"""
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from lib.connectivity_store import load_connectivity, normalize_weights
+
+N_REGIONS = 76
+
+# matrices stacked in the cohort
+MATRICES = ["weights", "lengths", "r"]
+
+
+def _load_subject(subj_dir, n_regions):
+    """
+    Matrices of a subject, NaN if missing
+    """
+    try:
+        connectivity = load_connectivity(subj_dir)
+    except (OSError, ValueError) as e:
+        print(f"Problem loading {subj_dir}: {e}")
+        connectivity = {}
+    matrices = {}
+    for key in MATRICES:
+        m = connectivity.get(key)
+        if m is None or m.shape != (n_regions, n_regions):
+            m = np.full((n_regions, n_regions), np.nan)
+        matrices[key] = m
+    return matrices
+
+
+def build_cohort(subjects, cohort_dir, n_regions=N_REGIONS, njobs=8):
+    """
+    Stack the matrices of all the subjects.
+
+    subjects: DataFrame with columns id, CENTER and subj_dir (and any other
+              column, ex: the group, that is kept in the index)
+    cohort_dir: directory where the stacks and the index are saved
+    Returns the index and the stacks (see open_cohort)
+    """
+    os.makedirs(cohort_dir, exist_ok=True)
+    index = subjects.reset_index(drop=True)
+    n = len(index)
+
+    stacks = {
+        key: np.lib.format.open_memmap(
+            f"{cohort_dir}/{key}.npy",
+            mode="w+",
+            dtype=np.float64,
+            shape=(n, n_regions, n_regions),
+        )
+        for key in MATRICES
+    }
+
+    # reading the files is I/O, several subjects at the same time
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        loaded = pool.map(lambda d: _load_subject(d, n_regions), index.subj_dir)
+        for i, matrices in enumerate(loaded):
+            for key in MATRICES:
+                stacks[key][i] = matrices[key]
+
+    for key in MATRICES:
+        stacks[key].flush()
+    index["has_sc"] = ~np.isnan(stacks["weights"]).all(axis=(1, 2))
+    index["has_fc"] = ~np.isnan(stacks["r"]).all(axis=(1, 2))
+    index.to_csv(f"{cohort_dir}/cohort_index.csv", index=False)
+    del stacks
+
+    return open_cohort(cohort_dir)
+
+
+def open_cohort(cohort_dir, mode="r"):
+    """
+    Open a cohort created by build_cohort.
+    Returns the index (DataFrame, one row per subject) and a dictionary with
+    the memory-mapped stacks
+    """
+    index = pd.read_csv(
+        f"{cohort_dir}/cohort_index.csv", dtype={"id": str, "CENTER": str}
+    )
+    stacks = {
+        key: np.load(f"{cohort_dir}/{key}.npy", mmap_mode=mode) for key in MATRICES
+    }
+    return index, stacks
+
+
+def normalized_weights(stacks):
+    """
+    Normalizations of the weights of all the subjects at the same time
+    (same as CreateTVB). Returns (min-max * 0.2, divided by max column sum)
+    """
+    return normalize_weights(stacks["weights"])
+
+
+def group_average(stack, index, mask=None, by="CENTER"):
+    """
+    Average of the matrices of the subjects selected by mask, for each
+    value of the column by (ex: for each center). NaN (missing) are ignored.
+    Returns {value: average matrix}
+    """
+    if mask is None:
+        mask = np.ones(len(index), dtype=bool)
+    mask = np.asarray(mask, dtype=bool)
+    averages = {}
+    for value, rows in index[mask].groupby(by).groups.items():
+        selected = np.asarray(stack[np.sort(np.asarray(rows))])
+        if np.isnan(selected).all():
+            continue
+        averages[value] = np.nanmean(selected, axis=0)
+    return averages
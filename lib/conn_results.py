@@ -0,0 +1,146 @@
+"""
+Results of CONN (run_CONN.py) in the format of the other pipeline.
+
+Of the .mat files of CONN only two variables are needed: data (timeseries of
+the ROIs) of ROI_SubjectXXX_Condition000.mat and Z (FC) of
+resultsROI_SubjectXXX_Condition001.mat, so only those are read
+(loadmat variable_names). For each subject, the timeseries, the FC (lib/fc.py)
+and the FC of CONN are written to CONN/results at once, with a stamp
+(conn_harvest.json) of the .mat files used: if they have not changed, the
+subject is not harvested again.
+"""
+import os
+import glob
+import json
+import numpy as np
+import scipy.io as sio
+from concurrent.futures import ThreadPoolExecutor
+from lib.fc import compute_fc, save_fc
+
+STAMP_NAME = "conn_harvest.json"
+
+OUTPUTS = ["r_matrix.csv", "zr_matrix.csv", "corrlabel_ts.txt", "conn_matrix.csv"]
+
+
+def mat_paths(conn_dir, i=1):
+    """
+    Timeseries and FC of subject i of a CONN project (conn_dir/conn_FC)
+    """
+    results_dir = f"{conn_dir}/conn_FC/results"
+    return (
+        f"{results_dir}/preprocessing/ROI_Subject{i:03d}_Condition000.mat",
+        f"{results_dir}/firstlevel/FC1/resultsROI_Subject{i:03d}_Condition001.mat",
+    )
+
+
+def load_conn_results(mat_timeseries_path, mat_FC_path):
+    """
+    Timeseries of the regions (time x regions) and FC of CONN
+    """
+    mat_timeseries = sio.loadmat(mat_timeseries_path, squeeze_me=True, variable_names=["data"])
+    mat_FC = sio.loadmat(mat_FC_path, squeeze_me=True, variable_names=["Z"])
+    # select last 76 items (the first ones are grey matter, white matter, csf)
+    corrlabel_ts = np.column_stack(mat_timeseries["data"][3:])
+    return corrlabel_ts, mat_FC["Z"]
+
+
+def _stamp(paths):
+    stamp = {}
+    for path in paths:
+        st = os.stat(path)
+        stamp[path] = [st.st_size, st.st_mtime_ns]
+    return stamp
+
+
+def is_harvested(out_dir_subject, paths):
+    """
+    The results of the subject are from the same .mat files
+    """
+    results_dir = f"{out_dir_subject}/results"
+    try:
+        with open(f"{results_dir}/{STAMP_NAME}") as f:
+            previous = json.load(f)
+        current = _stamp(paths)
+    except (OSError, ValueError):
+        return False
+    return previous == current and all(
+        os.path.isfile(f"{results_dir}/{o}") for o in OUTPUTS
+    )
+
+
+def harvest_subject(out_dir_subject, mat_timeseries_path, mat_FC_path, force=False):
+    """
+    Write the timeseries, the FC and the FC of CONN of a subject to
+    out_dir_subject/results (out_dir_subject is the CONN directory).
+    Returns "done", "skipped" (unchanged) or "missing" (no results of CONN)
+    """
+    paths = [mat_timeseries_path, mat_FC_path]
+    if not all(os.path.isfile(p) for p in paths):
+        return "missing"
+    if not force and is_harvested(out_dir_subject, paths):
+        return "skipped"
+
+    corrlabel_ts, FC_CONN = load_conn_results(*paths)
+    # Do own FC (correlation and zfisher, lib/fc.py)
+    fMRI_syn, z_fmri_syn = compute_fc(corrlabel_ts)
+
+    results_dir = f"{out_dir_subject}/results"
+    os.makedirs(results_dir, exist_ok=True)
+    # Save all versions (zscored and normal)
+    save_fc(results_dir, fMRI_syn, z_fmri_syn, corrlabel_ts)
+    np.savetxt(f"{results_dir}/conn_matrix.csv", FC_CONN, delimiter=",")
+    # the stamp the last, so an interrupted harvest is done again
+    with open(f"{results_dir}/{STAMP_NAME}", "w") as f:
+        json.dump(_stamp(paths), f)
+    return "done"
+
+
+def find_results(out_dir, center=None):
+    """
+    Results of CONN of all the subjects: [(CONN directory of the subject,
+    timeseries .mat, FC .mat)], of the projects of a subject
+    ({CENTER}_Post/{subID}/CONN) and of the projects of several subjects
+    (run_CONN.py --multi, {CENTER}_Post/CONN_multi/*)
+    """
+    pattern = f"{out_dir}/{center or '*'}_Post"
+    found = {}
+
+    def add(conn_dir, paths):
+        # if a subject has been run several times, the latest results
+        if os.path.isfile(paths[0]) and (
+            conn_dir not in found
+            or os.path.getmtime(paths[0]) > os.path.getmtime(found[conn_dir][0])
+        ):
+            found[conn_dir] = paths
+
+    for conn_dir in glob.glob(f"{pattern}/*/CONN"):
+        add(conn_dir, mat_paths(conn_dir))
+
+    for subjects_file in glob.glob(f"{pattern}/CONN_multi/*/subjects.txt"):
+        group_dir = os.path.dirname(subjects_file)
+        with open(subjects_file) as f:
+            func_paths = [line.split("\t")[0] for line in f if line.strip()]
+        for i, func_path in enumerate(func_paths, 1):
+            # {conn_dir}/fmri/{fmri}
+            add(os.path.dirname(os.path.dirname(func_path)), mat_paths(group_dir, i))
+    return [(conn_dir, *paths) for conn_dir, paths in sorted(found.items())]
+
+
+def harvest(out_dir, center=None, njobs=8, force=False):
+    """
+    Harvest the results of CONN of all the subjects, njobs at the same time.
+    Returns {status: number of subjects}
+    """
+    results = find_results(out_dir, center)
+
+    def run(item):
+        conn_dir, mat_timeseries_path, mat_FC_path = item
+        try:
+            return harvest_subject(conn_dir, mat_timeseries_path, mat_FC_path, force)
+        except Exception as e:
+            print(f"Could not harvest {conn_dir}: {e!r}")
+            return "failed"
+
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        statuses = list(pool.map(run, results))
+    return {s: statuses.count(s) for s in sorted(set(statuses))}
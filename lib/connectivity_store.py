@@ -0,0 +1,141 @@
+"""
+Binary store with the connectivity of a subject.
+
+All the results of a subject are saved once, in a single .npz
+(results/connectivity.npz):
+ - weights: SC weights (connectome_weights.csv)
+ - weights_norm: weights normalized for TVB (min-max, scaled to 0.2)
+ - weights_norm_colsum: weights divided by the maximum column sum
+ - lengths: mean length of the tracts (connectome_lengths.csv)
+ - counts: number of streamlines (if available)
+ - r, zr: FC (correlation and Fisher z)
+ - ts: BOLD timeseries of each region (time x regions)
+ - labels: name of each region
+ - centres: centre of each region (mm)
+ - volumes: volume of each region (mm3)
+
+The text files and the Connectivity.zip that TVB reads are created from the
+store only when needed, with export_tvb.
+"""
+import io
+import os
+import zipfile
+import numpy as np
+
+STORE_NAME = "connectivity.npz"
+
+
+def store_path(results_dir):
+    return f"{results_dir}/{STORE_NAME}"
+
+
+def normalize_weights(weights):
+    """
+    Normalizations of the SC weights used by TVB: min-max scaled to 0.2, and
+    divided by the maximum column sum.
+    Works with a matrix or with a stack of matrices (..., regions, regions)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    low = np.amin(weights, axis=(-2, -1), keepdims=True)
+    span = np.amax(weights, axis=(-2, -1), keepdims=True) - low
+    colsum = np.amax(np.sum(weights, axis=-2, keepdims=True), axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights_norm = np.where(span != 0, (weights - low) / span * 0.2, 0)
+        weights_norm_colsum = np.where(colsum != 0, weights / colsum, 0)
+    return weights_norm, weights_norm_colsum
+
+
+def save_store(path, **arrays):
+    """
+    Save the arrays of a subject (written to a temporal file and renamed, so
+    readers never see a half-written store)
+    """
+    arrays = {k: np.asarray(v) for k, v in arrays.items() if v is not None}
+    tmp = f"{path}.tmp.npz"
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_store(path):
+    """
+    Load the store of a subject, as a dictionary of arrays
+    """
+    with np.load(path, allow_pickle=False) as data:
+        return {k: data[k] for k in data.files}
+
+
+def _savetxt(array, **kwargs):
+    buffer = io.StringIO()
+    np.savetxt(buffer, array, **kwargs)
+    return buffer.getvalue()
+
+
+def centres_text(labels, centres):
+    return "".join(
+        f"{label} {c[0]} {c[1]} {c[2]}\n" for label, c in zip(labels, centres)
+    )
+
+
+def export_tvb(store, out_dir, prefix):
+    """
+    Write the files that TVB (and the rest of the old scripts) read:
+        {prefix}_SC_weights.txt, {prefix}_SC_weights_nonorm.txt,
+        {prefix}_SC_distances.txt, Connectivity.zip (weights.txt,
+        tract_lengths.txt, centres.txt) and, if there is FC,
+        r_matrix.csv, zr_matrix.csv and corrlabel_ts.txt
+    store: dictionary of load_store (or the path of the store)
+    """
+    if isinstance(store, str):
+        store = load_store(store)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    weights_txt = _savetxt(store["weights_norm"], encoding="ascii")
+    lengths_txt = _savetxt(store["lengths"], encoding="ascii")
+    files = {
+        f"{prefix}_SC_weights.txt": weights_txt,
+        f"{prefix}_SC_weights_nonorm.txt": _savetxt(store["weights"], encoding="ascii"),
+        f"{prefix}_SC_distances.txt": lengths_txt,
+    }
+    if "r" in store:
+        files["r_matrix.csv"] = _savetxt(store["r"], delimiter=",")
+        files["zr_matrix.csv"] = _savetxt(store["zr"], delimiter=",")
+    if "ts" in store:
+        files["corrlabel_ts.txt"] = _savetxt(store["ts"])
+    for name, text in files.items():
+        with open(f"{out_dir}/{name}", "w") as f:
+            f.write(text)
+
+    # contents of the zip described in: docs.thevirtualbrain.org/manuals/UserGuide/DataExchange.html
+    tmp = f"{out_dir}/Connectivity.zip.tmp"
+    with zipfile.ZipFile(tmp, "w") as myzip:
+        myzip.writestr("weights.txt", weights_txt)
+        myzip.writestr("tract_lengths.txt", lengths_txt)
+        myzip.writestr("centres.txt", centres_text(store["labels"], store["centres"]))
+    os.replace(tmp, f"{out_dir}/Connectivity.zip")
+
+
+def load_connectivity(subj_dir):
+    """
+    Load the connectivity of a subject: from the store if it exists, if not
+    from the csv of each step (subjects processed before the store).
+    Missing matrices are not in the dictionary.
+    """
+    path = store_path(f"{subj_dir}/results")
+    if os.path.isfile(path):
+        return load_store(path)
+
+    csv_files = {
+        "weights": f"{subj_dir}/dt_proc/connectome_weights.csv",
+        "lengths": f"{subj_dir}/dt_proc/connectome_lengths.csv",
+        "r": f"{subj_dir}/fmri_proc_dti/r_matrix.csv",
+        "zr": f"{subj_dir}/fmri_proc_dti/zr_matrix.csv",
+    }
+    store = {
+        key: np.loadtxt(f, delimiter=",")
+        for key, f in csv_files.items()
+        if os.path.isfile(f)
+    }
+    if os.path.isfile(f"{subj_dir}/fmri_proc_dti/corrlabel_ts.txt"):
+        store["ts"] = np.loadtxt(f"{subj_dir}/fmri_proc_dti/corrlabel_ts.txt")
+    return store
@@ -0,0 +1,199 @@
+"""
+Build the structural connectome from a tractogram, in python.
+
+Replaces the tck2connectome calls of Tracking.sh: the endpoints of each
+streamline are assigned to the nodes of nodes2diff.nii.gz with a radial
+search (as -assignment_radial_search), and the weights (with the SIFT2
+weights of tcksift2, -tck_weights_in), the mean lengths
+(-stat_edge mean -scale_length) and the streamline counts are computed in a
+single pass over the tractogram, read in chunks with lib/tck_io.py.
+
+The radial search is done with a lookup volume: for each voxel, the label of
+the closest labelled voxel if it is closer than the search radius (in mm), so
+assigning an endpoint is a single voxel lookup.
+"""
+import argparse
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from lib.tck_io import TckFile
+
+# streamlines read at the same time. The points of a chunk are converted to
+# float64 (~300 points of 24 bytes each streamline, ~150 MB)
+CHUNK_SIZE = 20000
+
+
+def assignment_lookup(nodes, zooms, radius):
+    """
+    Create a lookup volume with the label assigned to each voxel:
+    its own label, or the label of the closest labelled voxel if it is
+    at less than radius mm, or 0.
+
+    nodes: parcellation volume (integers, 0 is background)
+    zooms: voxel size (mm)
+    radius: search radius (mm)
+    """
+    distance, indices = ndimage.distance_transform_edt(
+        nodes == 0, sampling=zooms, return_indices=True
+    )
+    lookup = nodes[tuple(indices)]
+    lookup[distance > radius] = 0
+    return lookup
+
+
+def assign_endpoints(points, offsets, lengths, lookup, inv_affine):
+    """
+    Assign both endpoints of each streamline to a node, using the
+    lookup volume. Returns an array (n_streamlines, 2) of nodes.
+    """
+    ends = np.stack(
+        (points[offsets], points[offsets + lengths - 1]), axis=1
+    ).reshape(-1, 3)
+    vox = np.rint(ends @ inv_affine[:3, :3].T + inv_affine[:3, 3]).astype(np.int64)
+    valid = np.all((vox >= 0) & (vox < np.array(lookup.shape)), axis=1)
+    vox[~valid] = 0
+    nodes = np.where(valid, lookup[vox[:, 0], vox[:, 1], vox[:, 2]], 0)
+    return nodes.reshape(-1, 2)
+
+
+def streamline_lengths(points, offsets, lengths):
+    """
+    Length (mm) of each streamline, sum of the length of its segments
+    """
+    steps = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    # steps that go from one streamline to the next one (or to the NaN
+    # delimiters) do not count
+    last = offsets + lengths - 1
+    steps[last[last < len(steps)]] = 0
+    steps[~np.isfinite(steps)] = 0
+    cum = np.concatenate(([0], np.cumsum(steps)))
+    return cum[last] - cum[offsets]
+
+
+def load_weights(weights_file):
+    """
+    Load the weights of each streamline (tcksift2 output)
+    """
+    return np.loadtxt(weights_file, comments="#", dtype=np.float64, ndmin=1).ravel()
+
+
+def build_connectome(
+    tck_file, nodes_file, radius, weights_file=None, chunk_size=CHUNK_SIZE, n_nodes=None
+):
+    """
+    Assign the streamlines of the tractogram and compute the connectomes
+    in a single pass.
+
+    tck_file: tractogram
+    nodes_file: parcellation in diffusion space (nodes2diff.nii.gz)
+    radius: radial search distance (mm)
+    weights_file: weights of each streamline (brain_track.txt), or None
+    n_nodes: number of nodes, by default the maximum label
+
+    Returns a dictionary with
+        assignments: (n_streamlines, 2) nodes of each streamline
+        weights: sum of the weights of the streamlines of each edge
+        lengths: mean length of each edge (weighted)
+        counts: number of streamlines of each edge
+    All matrices are symmetric, with zero diagonal.
+    """
+    nodes_nii = nib.load(nodes_file)
+    nodes = np.rint(np.asanyarray(nodes_nii.dataobj)).astype(np.int64)
+    nodes = nodes.reshape(nodes.shape[:3])
+    if n_nodes is None:
+        n_nodes = int(nodes.max())
+    lookup = assignment_lookup(nodes, nodes_nii.header.get_zooms()[:3], radius)
+    inv_affine = np.linalg.inv(nodes_nii.affine)
+
+    tck = TckFile(tck_file, persist_index=True)
+    sl_weights = np.ones(len(tck))
+    if weights_file is not None:
+        sl_weights = load_weights(weights_file)
+        if len(sl_weights) != len(tck):
+            raise ValueError(
+                f"{len(sl_weights)} weights for {len(tck)} streamlines in {tck_file}!"
+            )
+
+    size = (n_nodes + 1) ** 2
+    weights = np.zeros(size)
+    length_sum = np.zeros(size)
+    counts = np.zeros(size)
+    assignments = np.zeros((len(tck), 2), dtype=np.int64)
+
+    for first, points, offsets, lengths in tck.iter_chunks(chunk_size):
+        points = np.asarray(points, dtype=np.float64)
+        chunk_nodes = np.sort(
+            assign_endpoints(points, offsets, lengths, lookup, inv_affine), axis=1
+        )
+        assignments[first : first + len(lengths)] = chunk_nodes
+
+        w = sl_weights[first : first + len(lengths)]
+        edge = chunk_nodes[:, 0] * (n_nodes + 1) + chunk_nodes[:, 1]
+        weights += np.bincount(edge, weights=w, minlength=size)
+        length_sum += np.bincount(
+            edge,
+            weights=w * streamline_lengths(points, offsets, lengths),
+            minlength=size,
+        )
+        counts += np.bincount(edge, minlength=size)
+
+    def to_matrix(values):
+        # drop node 0 (unassigned), symmetric and zero diagonal
+        m = values.reshape(n_nodes + 1, n_nodes + 1)[1:, 1:]
+        m = np.triu(m) + np.triu(m, 1).T
+        np.fill_diagonal(m, 0)
+        return m
+
+    weights = to_matrix(weights)
+    counts = to_matrix(counts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        lengths = np.nan_to_num(to_matrix(length_sum) / weights)
+
+    return {
+        "assignments": assignments,
+        "weights": weights,
+        "lengths": lengths,
+        "counts": counts,
+    }
+
+
+def save_connectome(connectome, out_dir):
+    """
+    Save the matrices to the same files that tck2connectome created
+    """
+    np.savetxt(f"{out_dir}/connectome_weights.csv", connectome["weights"], delimiter=",")
+    np.savetxt(f"{out_dir}/connectome_lengths.csv", connectome["lengths"], delimiter=",")
+    np.savetxt(
+        f"{out_dir}/connectome_counts.csv",
+        connectome["counts"],
+        delimiter=",",
+        fmt="%d",
+    )
+
+
+def save_assignments(connectome, assignments_file):
+    """
+    Save the assignments, with the same format as tck2connectome -out_assignments
+    """
+    np.savetxt(assignments_file, connectome["assignments"], fmt="%d", delimiter=" ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the connectome of a tractogram (as tck2connectome)"
+    )
+    parser.add_argument("tck_file", help="tractogram")
+    parser.add_argument("nodes", help="parcellation in diffusion space")
+    parser.add_argument("--radius", type=float, required=True, help="radial search (mm)")
+    parser.add_argument("--tck_weights_in", help="weights of each streamline (SIFT2)")
+    parser.add_argument("--out_dir", help="directory where the csv are saved")
+    parser.add_argument("--out_assignments", help="file to save the assignments")
+    args = parser.parse_args()
+
+    connectome = build_connectome(
+        args.tck_file, args.nodes, args.radius, args.tck_weights_in
+    )
+    if args.out_assignments:
+        save_assignments(connectome, args.out_assignments)
+    if args.out_dir:
+        save_connectome(connectome, args.out_dir)
@@ -0,0 +1,389 @@
+"""
+Backends that run the steps of the pipeline.
+
+ - threads: all the steps in the same process, as threads that wait for the
+   scripts, within a budget of cpus and memory (lib/scheduler.py). Same as
+   before, the default.
+ - processes: each step of each subject is run by a new process (a command,
+   run_pipeline_prime.py --job ...), scheduled in the same way.
+ - batch: the steps are submitted to a cluster as job arrays (SLURM or SGE),
+   one array for each step with all the subjects that are ready for it, with
+   the cpus, memory and time of the step. The runner polls the arrays, and
+   submits the next steps of each subject when the previous ones finish.
+
+The jobs submitted are recorded in the state store (lib/pipeline_state.py), so
+if the runner is interrupted, running it again resumes the cohort: the steps
+already done are not planned, and the jobs still in the cluster are followed
+instead of being submitted again.
+
+The fake batch system runs the job arrays locally, in the background, to test
+the batch backend without a cluster.
+"""
+import os
+import abc
+import time
+import shlex
+import datetime
+import subprocess
+from lib.scheduler import Scheduler, Task, PENDING, RUNNING, DONE, FAILED, SKIPPED
+
+EXECUTORS = ["threads", "processes", "batch"]
+
+
+def run_command(command, log_file):
+    """
+    Run a command (list), with all the output to log_file.
+    Returns False if it failed
+    """
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, "w") as f:
+        return subprocess.run(command, stdout=f, stderr=f).returncode == 0
+
+
+class ProcessExecutor(Scheduler):
+    """
+    Each task is a command run in a new process (the scheduler only waits)
+    """
+
+    def add_command(self, name, command, log_file, deps=(), cpus=1, mem_gb=1, **kwargs):
+        return self.add(name, run_command, (command, log_file), deps, cpus, mem_gb)
+
+
+class BatchSystem(abc.ABC):
+    """
+    Job arrays of a cluster. Each task of an array runs a line of its tasks
+    file, and writes its exit code in {array_dir}/{task}.exit, so the runner
+    does not depend on the accounting of the cluster to know how it ended.
+
+    A batch system sets task_var and implements header, submit and is_alive.
+    """
+
+    # variable with the index of the task (from 1)
+    task_var = None
+
+    @abc.abstractmethod
+    def header(self, name, n_tasks, cpus, mem_gb, walltime, array_dir):
+        """
+        Header of an array script (resources of each task)
+        """
+
+    @abc.abstractmethod
+    def submit(self, script):
+        """
+        Submit an array script, returns the id of the job
+        """
+
+    @abc.abstractmethod
+    def is_alive(self, job_id):
+        """
+        Check if a job is still queued or running
+        """
+
+    def write_array(self, array_dir, name, commands, cpus, mem_gb, walltime):
+        """
+        Write the script and the tasks file of an array, returns the script
+        """
+        os.makedirs(array_dir, exist_ok=True)
+        with open(f"{array_dir}/tasks.txt", "w") as f:
+            f.writelines(shlex.join(c) + "\n" for c in commands)
+        script = f"{array_dir}/array.sh"
+        with open(script, "w") as f:
+            f.write(
+                self.header(name, len(commands), cpus, mem_gb, walltime, array_dir)
+                + f"\ncd {shlex.quote(os.getcwd())}\n"
+                f'TASK=${{{self.task_var}}}\n'
+                f'eval "$(sed -n "${{TASK}}p" {shlex.quote(array_dir)}/tasks.txt)"\n'
+                f"echo $? > {shlex.quote(array_dir)}/${{TASK}}.exit.tmp\n"
+                f"mv {shlex.quote(array_dir)}/${{TASK}}.exit.tmp {shlex.quote(array_dir)}/${{TASK}}.exit\n"
+            )
+        return script
+
+
+class Slurm(BatchSystem):
+    task_var = "SLURM_ARRAY_TASK_ID"
+
+    def header(self, name, n_tasks, cpus, mem_gb, walltime, array_dir):
+        return (
+            "#!/bin/bash\n"
+            f"#SBATCH --job-name={name}\n"
+            f"#SBATCH --array=1-{n_tasks}\n"
+            f"#SBATCH --cpus-per-task={max(cpus, 1)}\n"
+            f"#SBATCH --mem={max(int(mem_gb), 1)}G\n"
+            f"#SBATCH --time={walltime}\n"
+            f"#SBATCH --output={array_dir}/%a.log\n"
+        )
+
+    def submit(self, script):
+        out = subprocess.run(
+            ["sbatch", "--parsable", script], capture_output=True, text=True, check=True
+        )
+        # id;cluster
+        return out.stdout.strip().split(";")[0]
+
+    def is_alive(self, job_id):
+        out = subprocess.run(
+            ["squeue", "-h", "-j", str(job_id), "-o", "%i"], capture_output=True, text=True
+        )
+        return out.returncode == 0 and out.stdout.strip() != ""
+
+
+class SGE(BatchSystem):
+    task_var = "SGE_TASK_ID"
+
+    def header(self, name, n_tasks, cpus, mem_gb, walltime, array_dir):
+        cpus = max(cpus, 1)
+        return (
+            "#!/bin/bash\n"
+            "#$ -S /bin/bash\n"
+            f"#$ -N {name}\n"
+            f"#$ -t 1-{n_tasks}\n"
+            f"#$ -pe smp {cpus}\n"
+            # the memory is per slot
+            f"#$ -l h_vmem={max(mem_gb / cpus, 0.5):.1f}G\n"
+            f"#$ -l h_rt={walltime}\n"
+            "#$ -j y\n"
+            f"#$ -o {array_dir}/$TASK_ID.log\n"
+        )
+
+    def submit(self, script):
+        out = subprocess.run(
+            ["qsub", "-terse", script], capture_output=True, text=True, check=True
+        )
+        # id.first-last:step
+        return out.stdout.strip().split(".")[0]
+
+    def is_alive(self, job_id):
+        return (
+            subprocess.run(["qstat", "-j", str(job_id)], capture_output=True).returncode
+            == 0
+        )
+
+
+class FakeBatch(BatchSystem):
+    """
+    Local stand-in of a cluster: each array runs in the background, with
+    parallel tasks at the same time, and the output of each task in
+    {array_dir}/{task}.log. The id of the job is the pid of the array, so
+    it can be followed by a new runner.
+    """
+
+    task_var = "FAKE_ARRAY_TASK_ID"
+
+    def __init__(self, parallel=2):
+        self.parallel = parallel
+        self.procs = {}
+
+    def header(self, name, n_tasks, cpus, mem_gb, walltime, array_dir):
+        return (
+            "#!/bin/bash\n"
+            f"# {name}: {n_tasks} tasks, {cpus} cpus, {mem_gb} GB, {walltime}\n"
+        )
+
+    def submit(self, script):
+        array_dir = os.path.dirname(script)
+        with open(f"{array_dir}/tasks.txt") as f:
+            n_tasks = sum(1 for _ in f)
+        # the task, the script and the directory are arguments of the shell
+        # ($1, $2, $3), so they are never quoted inside the command
+        task = f'{self.task_var}="$1" exec bash "$2" > "$3/$1.log" 2>&1'
+        proc = subprocess.Popen(
+            ["xargs", "-P", str(self.parallel), "-I", "{}", "sh", "-c", task, "sh", "{}", script, array_dir],
+            start_new_session=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            text=True,
+        )
+        proc.stdin.write("".join(f"{i}\n" for i in range(1, n_tasks + 1)))
+        proc.stdin.close()
+        self.procs[str(proc.pid)] = proc
+        return str(proc.pid)
+
+    def is_alive(self, job_id):
+        if job_id in self.procs:
+            return self.procs[job_id].poll() is None
+        # submitted by another runner
+        try:
+            with open(f"/proc/{job_id}/stat") as f:
+                return f.read().split()[2] != "Z"
+        except (FileNotFoundError, IndexError):
+            return False
+
+
+BATCH_SYSTEMS = {"slurm": Slurm, "sge": SGE, "fake": FakeBatch}
+
+
+class BatchTask(Task):
+    """
+    A step of a subject submitted as a task of a job array
+    """
+
+    def __init__(self, name, step, key, command, deps, cpus, mem_gb, walltime):
+        super().__init__(name, None, (), deps, cpus, mem_gb)
+        self.step = step
+        self.key = key
+        self.command = command
+        self.walltime = walltime
+        self.job = None  # (job_id, array_dir, task)
+
+
+class BatchExecutor:
+    """
+    Run a graph of steps (commands) as job arrays of a cluster.
+
+    system: BatchSystem (Slurm, SGE, FakeBatch)
+    state: PipelineState, where the jobs are recorded
+    batch_dir: directory (shared with the nodes) of the array scripts and logs
+    poll_interval: seconds between checks of the running jobs
+    """
+
+    def __init__(self, system, state, batch_dir, poll_interval=60):
+        self.system = system
+        self.state = state
+        self.batch_dir = batch_dir
+        self.poll_interval = poll_interval
+        self.tasks = []
+
+    def add_command(self, name, command, log_file=None, deps=(), cpus=1, mem_gb=1, step=None, key=None, walltime="24:00:00"):
+        """
+        Add a step to the graph. key: (center, subID) of the subject.
+        The output goes to the log of the task of the array (log_file is
+        not used)
+        """
+        task = BatchTask(
+            name, step, key, command, [d for d in deps if d is not None], cpus, mem_gb, walltime
+        )
+        self.tasks.append(task)
+        return task
+
+    def _exit_code(self, task):
+        job_id, array_dir, index = task.job
+        try:
+            with open(f"{array_dir}/{index}.exit") as f:
+                return int(f.read().strip() or 1)
+        except FileNotFoundError:
+            return None
+
+    def _record(self, tasks, status):
+        self.state.set_jobs(
+            [
+                (t.key[1], t.key[0], t.step) + tuple(t.job or (None, None, None)) + (status,)
+                for t in tasks
+            ]
+        )
+
+    def _resume(self):
+        """
+        Follow the jobs submitted by a previous runner that are still in
+        the cluster (or have finished since)
+        """
+        submitted = self.state.jobs(status=RUNNING)
+        for task in self.tasks:
+            job = submitted.get(task.key + (task.step,))
+            if job is None:
+                continue
+            task.job = job[:3]
+            if self._exit_code(task) is not None or self.system.is_alive(task.job[0]):
+                print(f"{task.name}: following job {task.job[0]} (task {task.job[2]})")
+                task.status = RUNNING
+
+    def _submit(self, tasks):
+        """
+        Submit the tasks of a step as a job array
+        """
+        step = tasks[0].step
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        array_dir = os.path.abspath(f"{self.batch_dir}/{step}_{stamp}")
+        script = self.system.write_array(
+            array_dir,
+            f"pip_{step}",
+            [t.command for t in tasks],
+            max(t.cpus for t in tasks),
+            max(t.mem_gb for t in tasks),
+            tasks[0].walltime,
+        )
+        job_id = self.system.submit(script)
+        print(f"Submitted {step} for {len(tasks)} subjects: job {job_id} ({array_dir})")
+        for i, task in enumerate(tasks, start=1):
+            task.job = (job_id, array_dir, i)
+            task.status = RUNNING
+        self._record(tasks, RUNNING)
+
+    def _ready(self, task):
+        if any(d.status in (PENDING, RUNNING) for d in task.deps):
+            return False
+        if any(d.status != DONE for d in task.deps):
+            task.status = SKIPPED
+            return False
+        return True
+
+    def run(self):
+        """
+        Submit, and follow, all the steps. Returns the tasks (with their
+        final status)
+        """
+        self._resume()
+        while True:
+            # submit the steps that are ready, an array for each step
+            ready = {}
+            for task in self.tasks:
+                if task.status == PENDING and self._ready(task):
+                    ready.setdefault(task.step, []).append(task)
+            for tasks in ready.values():
+                try:
+                    self._submit(tasks)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(f"Could not submit {tasks[0].step}: {e!r}")
+                    for task in tasks:
+                        task.status = FAILED
+
+            running = [t for t in self.tasks if t.status == RUNNING]
+            if not running:
+                break
+            time.sleep(self.poll_interval)
+
+            # check the running ones
+            alive = {}
+            finished = {DONE: [], FAILED: []}
+            for task in running:
+                code = self._exit_code(task)
+                if code is None:
+                    job_id = task.job[0]
+                    if job_id not in alive:
+                        alive[job_id] = self.system.is_alive(job_id)
+                    if alive[job_id]:
+                        continue
+                    # the exit code could have been written after the check
+                    code = self._exit_code(task)
+                    if code is None:
+                        print(f"{task.name}: job {job_id} ended without exit code (cancelled, time limit?)")
+                        code = 1
+                task.status = DONE if code == 0 else FAILED
+                finished[task.status].append(task)
+            for status, tasks in finished.items():
+                if tasks:
+                    self._record(tasks, status)
+
+        for task in self.tasks:
+            if task.status == PENDING:
+                task.status = SKIPPED
+        return self.tasks
+
+    def summary(self):
+        counts = {}
+        for task in self.tasks:
+            counts[task.status] = counts.get(task.status, 0) + 1
+        return counts
+
+
+def make_executor(name, ncpus, mem_gb, njobs, state=None, batch_system="slurm", batch_dir="batch", poll_interval=60):
+    """
+    Executor with the name given (see EXECUTORS)
+    """
+    if name == "threads":
+        return Scheduler(ncpus, mem_gb, njobs)
+    if name == "processes":
+        return ProcessExecutor(ncpus, mem_gb, njobs)
+    if name == "batch":
+        system = BATCH_SYSTEMS[batch_system]()
+        return BatchExecutor(system, state, batch_dir, poll_interval)
+    raise ValueError(f"Unknown executor {name}, one of {EXECUTORS}")
@@ -0,0 +1,109 @@
+"""
+Functional connectivity from the BOLD timeseries of each region.
+
+The correlation, the Fisher z (clipped, with the perfect correlations and
+the diagonal set to 0) are computed in a single vectorized pass, optionally
+in float32. Long timeseries (ex: several runs) can be given by chunks of time,
+only the sums and the cross-products are kept in memory (FCAccumulator).
+
+Used by run_CONN.py and CreateTVB (timeseries of fmri_proc_dti).
+"""
+import numpy as np
+import pandas as pd
+
+
+def fisher_z(r, dtype=np.float64):
+    """
+    Fisher z of correlation matrices (one or a stack): arctanh of r clipped to
+    [-1, 1], with the perfect correlations (|r| == 1, ex: diagonal) and the
+    NaN set to 0
+    """
+    r = np.clip(np.nan_to_num(np.asarray(r, dtype=dtype)), -1, 1)
+    perfect = np.abs(r) == 1
+    with np.errstate(divide="ignore"):
+        z = np.arctanh(np.where(perfect, 0, r))
+    diag = np.arange(r.shape[-1])
+    z[..., diag, diag] = 0
+    return z
+
+
+class FCAccumulator:
+    """
+    Correlation between regions of a timeseries given by chunks of time
+    (time x regions). Accumulates the sums and cross-products, in float64,
+    after subtracting the mean of the first chunk (to avoid losing precision
+    with the big mean of the BOLD signal).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.shift = None
+        self.sums = None
+        self.cross = None
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.ndim == 1:
+            chunk = chunk[:, None]
+        if len(chunk) == 0:
+            return
+        if self.shift is None:
+            self.shift = chunk.mean(axis=0)
+            self.sums = np.zeros(chunk.shape[1])
+            self.cross = np.zeros((chunk.shape[1], chunk.shape[1]))
+        chunk = chunk - self.shift
+        self.n += len(chunk)
+        self.sums += chunk.sum(axis=0)
+        self.cross += chunk.T @ chunk
+
+    def result(self, dtype=np.float64):
+        """
+        Returns r, zr (as np.corrcoef + nan_to_num, and fisher_z)
+        """
+        if self.n < 2:
+            raise ValueError("At least two time points are needed to compute the FC")
+        mean = self.sums / self.n
+        cov = self.cross - self.n * np.outer(mean, mean)
+        std = np.sqrt(np.clip(np.diag(cov), 0, None))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r = cov / np.outer(std, std)
+        # constant regions have no correlation
+        r = np.clip(np.nan_to_num(r, posinf=0, neginf=0), -1, 1).astype(dtype)
+        return r, fisher_z(r, dtype)
+
+
+def compute_fc(ts, dtype=np.float64, chunk_size=None):
+    """
+    r and zr matrices of a timeseries (time x regions).
+    chunk_size: time points processed at the same time (None, all)
+    """
+    acc = FCAccumulator()
+    chunk_size = chunk_size or max(len(ts), 1)
+    for start in range(0, len(ts), chunk_size):
+        acc.update(ts[start : start + chunk_size])
+    return acc.result(dtype)
+
+
+def fc_from_files(ts_files, dtype=np.float64, chunk_size=10000):
+    """
+    r and zr matrices of the timeseries in text files (as corrlabel_ts.txt),
+    concatenated in time (ex: several runs), read by chunks
+    """
+    acc = FCAccumulator()
+    for ts_file in ts_files:
+        for chunk in pd.read_csv(
+            ts_file, sep=r"\s+", header=None, chunksize=chunk_size, dtype=np.float64
+        ):
+            acc.update(chunk.to_numpy())
+    return acc.result(dtype)
+
+
+def save_fc(out_dir, r, zr, ts=None):
+    """
+    Save the FC with the same files as the rest of the pipeline
+    (r_matrix.csv, zr_matrix.csv, corrlabel_ts.txt)
+    """
+    np.savetxt(f"{out_dir}/r_matrix.csv", r, delimiter=",")
+    np.savetxt(f"{out_dir}/zr_matrix.csv", zr, delimiter=",")
+    if ts is not None:
+        np.savetxt(f"{out_dir}/corrlabel_ts.txt", ts)
@@ -0,0 +1,209 @@
+"""
+Resting state denoising and FC in Python, without MATLAB.
+
+Produces the files of fmri_proc_dti used by CreateTVB (r_matrix.csv,
+zr_matrix.csv, corrlabel_ts.txt) from a 4D BOLD and the labels, WM and CSF
+masks in the same space (registered before, ex: the segmentation of
+FastSurfer). The steps, as in the CONN batch (scripts/Base_batch.m):
+ - the first scans_to_remove volumes are removed
+ - confounds: constant, linear and quadratic trends (detrending), and the
+   first components of the WM and CSF voxels (aCompCor)
+ - band-pass filter (0.008-0.09 Hz), of the data and of the confounds, and
+   regression of the confounds
+ - timeseries of each region (mean of its voxels) and FC (lib/fc.py)
+
+The BOLD is memory-mapped and read by slabs of z slices (contiguous on
+disk), so only a slab is in memory at a time. For each slab, the voxels of
+the regions are summed (a sparse product) and the WM and CSF voxels
+(detrended and normalized) are accumulated in their time x time Gram matrix,
+whose eigenvectors are the components of aCompCor.
+
+The filter and the regression are a single linear operator (time x time),
+so they are applied to the mean of each region: the same result as cleaning
+each voxel and averaging, without cleaning every voxel.
+
+example:
+    python -m lib.fmri_fc bold.nii.gz labels.nii.gz wm.nii.gz csf.nii.gz out_dir/fmri_proc_dti
+"""
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from lib.fc import compute_fc, save_fc
+
+SCANS_TO_REMOVE = 5
+
+# band-pass (Hz)
+LOW_PASS = 0.09
+HIGH_PASS = 0.008
+
+# components of aCompCor of each of WM and CSF
+N_COMPONENTS = 5
+
+# z slices read at the same time
+SLAB_SIZE = 8
+
+
+def trend_regressors(n):
+    """
+    Constant, linear and quadratic trends (orthogonal, Legendre) of n points
+    """
+    t = np.linspace(-1, 1, n)
+    return np.column_stack([np.ones(n), t, (3 * t**2 - 1) / 2])
+
+
+def bandpass_operator(n, tr, low_pass=LOW_PASS, high_pass=HIGH_PASS):
+    """
+    Band-pass filter of timeseries of n points as a matrix (n x n): the
+    frequencies out of [high_pass, low_pass] are removed (FFT)
+    """
+    freqs = np.fft.rfftfreq(n, d=tr)
+    keep = (freqs >= high_pass) & (freqs <= low_pass)
+    return np.fft.irfft(np.fft.rfft(np.eye(n), axis=0) * keep[:, None], n=n, axis=0)
+
+
+def cleaning_operator(confounds, tr, low_pass=LOW_PASS, high_pass=HIGH_PASS):
+    """
+    Band-pass and regression of the (band-passed) confounds, as a single
+    matrix (time x time) to apply to timeseries (time x regions)
+    """
+    F = bandpass_operator(len(confounds), tr, low_pass, high_pass)
+    X = F @ confounds
+    return F - X @ (np.linalg.pinv(X) @ F)
+
+
+def _gram(block, trends):
+    """
+    Time x time Gram matrix of voxels (voxels x time), detrended and with
+    unit variance
+    """
+    block = block.T.astype(np.float64)
+    block -= trends @ np.linalg.lstsq(trends, block, rcond=None)[0]
+    std = block.std(axis=0)
+    block = block[:, std > 0] / std[std > 0]
+    return block @ block.T
+
+
+def components(gram, n_components):
+    """
+    First principal components (time x n_components) from a Gram matrix
+    """
+    values, vectors = np.linalg.eigh(gram)
+    return vectors[:, ::-1][:, :n_components]
+
+
+def read_bold(bold, labels, wm, csf, n_regions=None, scans_to_remove=SCANS_TO_REMOVE, slab_size=SLAB_SIZE):
+    """
+    Read the BOLD by slabs: mean timeseries of each region (time x regions)
+    and the Gram matrices of the WM and CSF voxels.
+    labels: volume of the labels (1..n_regions), wm and csf: boolean volumes
+    """
+    img = nib.load(bold, mmap=True)
+    n_time = img.shape[3] - scans_to_remove
+    if n_time < 2:
+        raise ValueError(f"{bold} has {img.shape[3]} volumes, {scans_to_remove} are removed")
+    if labels.shape != img.shape[:3]:
+        raise ValueError(f"The labels ({labels.shape}) are not in the space of the BOLD ({img.shape[:3]})")
+    labels = np.rint(labels).astype(np.int64)
+    if n_regions is None:
+        n_regions = int(labels.max())
+    trends = trend_regressors(n_time)
+
+    sums = np.zeros((n_regions, n_time))
+    counts = np.zeros(n_regions)
+    grams = {"wm": np.zeros((n_time, n_time)), "csf": np.zeros((n_time, n_time))}
+    for z0 in range(0, img.shape[2], slab_size):
+        z = slice(z0, z0 + slab_size)
+        slab_labels = labels[:, :, z].ravel()
+        inside = (slab_labels > 0) & (slab_labels <= n_regions)
+        masks = {"wm": wm[:, :, z].ravel(), "csf": csf[:, :, z].ravel()}
+        if not (inside.any() or masks["wm"].any() or masks["csf"].any()):
+            continue
+
+        block = np.asarray(img.dataobj[:, :, z, scans_to_remove:], dtype=np.float32)
+        block = block.reshape(-1, n_time)
+
+        # sum of the voxels of each region
+        onehot = sparse.csr_matrix(
+            (np.ones(inside.sum()), (slab_labels[inside] - 1, np.flatnonzero(inside))),
+            shape=(n_regions, len(block)),
+        )
+        sums += onehot @ block
+        counts += np.bincount(slab_labels[inside] - 1, minlength=n_regions)
+
+        for tissue, mask in masks.items():
+            if mask.any():
+                grams[tissue] += _gram(block[mask], trends)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ts = np.where(counts[:, None] > 0, sums / counts[:, None], 0).T
+    return ts, grams, img.header.get_zooms()[3]
+
+
+def run_fc(
+    bold,
+    labels,
+    wm,
+    csf,
+    out_dir,
+    tr=None,
+    n_regions=None,
+    scans_to_remove=SCANS_TO_REMOVE,
+    n_components=N_COMPONENTS,
+    low_pass=LOW_PASS,
+    high_pass=HIGH_PASS,
+    mask_threshold=0.5,
+):
+    """
+    Denoised timeseries of the regions and FC of a BOLD (files), saved in
+    out_dir (r_matrix.csv, zr_matrix.csv, corrlabel_ts.txt).
+    wm and csf: masks or probability maps (> mask_threshold), in the space of
+    the BOLD. tr: in seconds, from the header of the BOLD if not given.
+    Returns the timeseries, r and zr
+    """
+    labels_data = np.asanyarray(nib.load(labels).dataobj)
+    wm_data = np.asanyarray(nib.load(wm).dataobj) > mask_threshold
+    csf_data = np.asanyarray(nib.load(csf).dataobj) > mask_threshold
+    ts, grams, header_tr = read_bold(bold, labels_data, wm_data, csf_data, n_regions, scans_to_remove)
+
+    if tr is None:
+        # some converters write it in ms
+        tr = float(header_tr) / 1000 if header_tr > 100 else float(header_tr)
+    confounds = [trend_regressors(len(ts))]
+    for gram in grams.values():
+        if gram.any():
+            confounds.append(components(gram, n_components))
+    ts = cleaning_operator(np.column_stack(confounds), tr, low_pass, high_pass) @ ts
+
+    r, zr = compute_fc(ts)
+    save_fc(out_dir, r, zr, ts)
+    return ts, r, zr
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Denoising and FC of a resting state BOLD")
+    parser.add_argument("bold", help="4D BOLD")
+    parser.add_argument("labels", help="labels of the regions, in the space of the BOLD")
+    parser.add_argument("wm", help="WM mask (or probability), in the space of the BOLD")
+    parser.add_argument("csf", help="CSF mask (or probability), in the space of the BOLD")
+    parser.add_argument("out_dir", help="directory of the results (ex: fmri_proc_dti)")
+    parser.add_argument("--tr", type=float, help="TR in seconds (by default, from the header)")
+    parser.add_argument("--n_regions", type=int, help="number of regions (by default, the maximum label)")
+    parser.add_argument("--scans_to_remove", type=int, default=SCANS_TO_REMOVE)
+    parser.add_argument("--n_components", type=int, default=N_COMPONENTS, help="aCompCor components of WM and of CSF")
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    run_fc(
+        args.bold,
+        args.labels,
+        args.wm,
+        args.csf,
+        args.out_dir,
+        tr=args.tr,
+        n_regions=args.n_regions,
+        scans_to_remove=args.scans_to_remove,
+        n_components=args.n_components,
+    )
@@ -32,6 +32,39 @@ from __future__ import (absolute_import, division,
 import json
 import os
 
+def fsl_slice_times(slicetime, TR):
+    """
+    Slice times (fraction of the TR, from the middle of the TR) and slices in
+    order of acquisition, from the SliceTiming of the sidecar (seconds)
+    """
+    reftime=TR/2
+    slicelist = [ (sliceidx+1,(float(sliceval) - reftime)/TR, sliceval) for sliceidx,sliceval in enumerate(slicetime)]
+
+    sortedSlices = sorted(slicelist, key=lambda tup: tup[1])
+
+    slicetimes=[str(sliceinfo[1]) for sliceinfo in slicelist]
+    slicenums=[str(sliceinfo[0]) for sliceinfo in sortedSlices]
+    return slicetimes, slicenums
+
+
+def multiband_slice_times(TR, nslices, multiband_channels):
+    """
+    Artificial slice times of a multiband acquisition without SliceTiming
+    (slices 1 & nslices/multiband_channels + 1, 2 & ... acquired at the same time)
+    """
+    reftime=TR/2
+    nsteps = int(nslices/multiband_channels)
+
+    slicelist = [ (sliceidx+1, ( (sliceidx+1)*TR/nsteps - reftime) ) for sliceidx in range(nsteps) ]
+
+    slicelistfull = [(x + band*nsteps, y) for band in range(int(multiband_channels)) for (x,y) in slicelist]
+
+    sortedSlices = sorted(slicelistfull, key=lambda tup: tup[1])
+    slicetimes=[str(sliceinfo[1]) for sliceinfo in slicelistfull]
+    slicenums=[str(sliceinfo[0]) for sliceinfo in sortedSlices]
+    return slicetimes, slicenums
+
+
 def make_fsl(jsonfile, slicetime, slicenum):
     """
     Setup all parameters for slice time correction file generation for FSL
@@ -57,15 +90,7 @@ def make_fsl(jsonfile, slicetime, slicenum):
 
     json_file=open(jsonfile)
     info = json.load(json_file)
-    slicetime=info['SliceTiming']
-    TR=float(info['RepetitionTime'])
-    reftime=TR/2
-    slicelist = [ (sliceidx+1,(float(sliceval) - reftime)/TR, sliceval) for sliceidx,sliceval in enumerate(slicetime)]
-
-    sortedSlices = sorted(slicelist, key=lambda tup: tup[1])
-
-    slicetimes=[str(sliceinfo[1]) for sliceinfo in slicelist]
-    slicenums=[str(sliceinfo[0]) for sliceinfo in sortedSlices]
+    slicetimes, slicenums = fsl_slice_times(info['SliceTiming'], float(info['RepetitionTime']))
 
     if doSliceTime:
         slicetimef=open(slicetimefile,'w')
@@ -75,12 +100,13 @@ def make_fsl(jsonfile, slicetime, slicenum):
         slicenumf=open(slicenumfile,'w')
         slicenumf.write("\n".join(slicenums))
 
-def make_milan(jsonfile, slicetime):
+def make_milan(jsonfile, slicetime, nslices=48, multiband_channels=2):
     """
     Setup all parameters for slice time correction file generation for MILAN dataset
 
     jsonfile: location of json file
     slicetime: name and location to place slice timing file with slice times for each slice acquired    
+    nslices, multiband_channels: of the acquisition (from the metadata index, lib/metadata.py)
     """
 
     if slicetime:
@@ -88,22 +114,10 @@ def make_milan(jsonfile, slicetime):
     else:
         slicetimefile=os.path.join(os.getcwd(),'slicetimes.txt')
 
-    multiband_channels = 2
-    nslices = 48
     json_file=open(jsonfile)
     info = json.load(json_file)
     TR=float(info['RepetitionTime'])
-    reftime=TR/2
-
-    slicelist = [ (sliceidx+1, ( (sliceidx+1)*TR/(nslices/multiband_channels) - reftime) ) for sliceidx in range( int(nslices/multiband_channels) ) ]
-
-    lst_temporal_slice = TR - TR/(nslices/multiband_channels)
-    slicelist2 = [(x+24, y) for (x,y) in slicelist]
-    slicelistfull = slicelist + slicelist2
-
-    sortedSlices = sorted(slicelistfull, key=lambda tup: tup[1])
-    slicetimes=[str(sliceinfo[1]) for sliceinfo in slicelistfull]
-    slicenums=[str(sliceinfo[0]) for sliceinfo in sortedSlices]
+    slicetimes, slicenums = multiband_slice_times(TR, nslices, multiband_channels)
 
     # compute slicetimes
     slicetimef=open(slicetimefile,'w')
@@ -0,0 +1,354 @@
+"""
+Pool of MATLAB sessions kept open to run the MATLAB parts of the pipeline
+(ps_LST_lga of LST, the batches of CONN).
+
+Before, each subject started a new MATLAB (and added SPM to the path), which
+takes longer than some of the jobs. Now the workers (scripts/matlab_worker.m)
+are started once, and the jobs are sent to them through their stdin, a json
+per line:
+    {"type": "ping"}                                   -> @@POOL PONG
+    {"type": "job", "id": 1, "cd": dir, "eval": "..."} -> @@POOL DONE 1 ok
+                                                          @@POOL DONE 1 failed <error>
+    {"type": "exit"}
+All the other output of a job goes to its log file.
+
+ - Health checks: before a job, a worker that has died or does not answer a
+   ping is started again.
+ - Recycling: a worker is restarted after max_jobs jobs, or if its memory
+   (RSS) is over mem_gb, so leaks of the toolboxes do not accumulate.
+ - Timeouts: a job that runs longer than its timeout is killed with its worker
+   (a new one takes its place).
+
+The fake worker (FAKE_WORKER_COMMAND) speaks the same protocol
+without MATLAB, to test the scheduling and the recovery: it understands
+pause(seconds), error('message') and exit.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import itertools
+import signal
+import datetime
+import threading
+import subprocess
+from lib.supervisor import session_processes, rss, kill_session, KILL_GRACE
+
+MARKER = "@@POOL "
+
+# jobs before a worker is restarted
+MAX_JOBS = 20
+
+# seconds to start a worker (MATLAB and the toolboxes), and to answer a ping
+STARTUP_TIMEOUT = 600
+PING_TIMEOUT = 30
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT_DIR, "scripts")
+
+FAKE_WORKER_COMMAND = [
+    sys.executable,
+    "-c",
+    f"import sys; sys.path.insert(0, {ROOT_DIR!r}); "
+    "from lib.matlab_pool import fake_worker; fake_worker()",
+]
+
+
+def matlab_command(matlab="matlab", spm_folder="", paths=()):
+    """
+    Command of a MATLAB worker, with the scripts of the pipeline, SPM (and
+    LST) and the directories in paths (ex: CONN, before the scripts) in the
+    path
+    """
+    addpaths = "".join(f"addpath('{p}'); " for p in paths if p)
+    return [
+        matlab,
+        "-nodisplay",
+        "-nosplash",
+        "-nodesktop",
+        "-r",
+        f"addpath('{SCRIPTS_DIR}'); {addpaths}matlab_worker('{spm_folder}')",
+    ]
+
+
+class WorkerError(Exception):
+    pass
+
+
+class Worker:
+    """
+    A MATLAB session (or the fake worker), in its own process group
+    """
+
+    def __init__(self, command, log_file=None, startup_timeout=STARTUP_TIMEOUT):
+        self.jobs = 0
+        self.lock = threading.Lock()
+        # output that is not part of a job
+        self.log = open(log_file, "a") if log_file else None
+        self.output = self.log
+        self.replies = queue.Queue()
+        self.proc = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            start_new_session=True,
+        )
+        self.pid = self.proc.pid
+        threading.Thread(target=self._read, daemon=True).start()
+        try:
+            self._wait("READY", startup_timeout)
+        except (WorkerError, TimeoutError) as e:
+            self.kill()
+            raise WorkerError(f"could not start the worker: {e}")
+
+    def _read(self):
+        for line in self.proc.stdout:
+            if line.startswith(MARKER):
+                self.replies.put(line[len(MARKER) :].strip())
+                continue
+            with self.lock:
+                if self.output is not None:
+                    self.output.write(line)
+                    self.output.flush()
+        # the worker has ended
+        self.replies.put(None)
+
+    def _send(self, message):
+        try:
+            self.proc.stdin.write(json.dumps(message) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerError(f"worker {self.pid} is not running: {e}")
+
+    def _wait(self, prefix, timeout):
+        """
+        Next reply of the worker, that should start with prefix.
+        Raises TimeoutError if it does not answer in time
+        """
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"worker {self.pid} did not answer in {timeout} s")
+        if reply is None:
+            raise WorkerError(f"worker {self.pid} has ended (exit code {self.proc.wait()})")
+        if not reply.startswith(prefix):
+            raise WorkerError(f"worker {self.pid} answered {reply!r} instead of {prefix}")
+        return reply
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def ping(self, timeout=PING_TIMEOUT):
+        try:
+            self._send({"type": "ping"})
+            self._wait("PONG", timeout)
+            return True
+        except (WorkerError, TimeoutError):
+            return False
+
+    def rss_gb(self):
+        return sum(rss(p) for p in session_processes(self.pid)) / 1024**3
+
+    def run(self, statement, cd=None, timeout=None, log_file=None):
+        """
+        Run a MATLAB statement in the worker, with its output to log_file.
+        Returns (ok, error message). Raises TimeoutError or WorkerError if the
+        worker has to be killed
+        """
+        self.jobs += 1
+        job = {"type": "job", "id": self.jobs, "cd": cd or "", "eval": statement}
+        output = open(log_file, "w") if log_file else None
+        with self.lock:
+            self.output = output
+        try:
+            self._send(job)
+            reply = self._wait(f"DONE {self.jobs} ", timeout)
+        finally:
+            with self.lock:
+                self.output = self.log
+            if output is not None:
+                output.close()
+        status, _, message = reply[len(f"DONE {self.jobs} ") :].partition(" ")
+        return status == "ok", message
+
+    def stop(self, timeout=KILL_GRACE):
+        """
+        End the worker, killing it if it does not exit by itself
+        """
+        try:
+            self._send({"type": "exit"})
+            self.proc.wait(timeout)
+        except (WorkerError, subprocess.TimeoutExpired):
+            pass
+        self.kill()
+
+    def kill(self):
+        kill_session(self.pid, signal.SIGKILL)
+        self.proc.wait()
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+            self.log = self.output = None
+
+
+class MatlabPool:
+    """
+    Up to n_workers workers, started when they are needed. run can be called
+    from several threads at the same time: each call takes an idle worker
+    (waiting for one if all of them are busy).
+    """
+
+    def __init__(
+        self,
+        n_workers,
+        command=None,
+        max_jobs=MAX_JOBS,
+        mem_gb=None,
+        job_timeout=None,
+        startup_timeout=STARTUP_TIMEOUT,
+        log_dir=None,
+    ):
+        self.command = command or matlab_command()
+        self.max_jobs = max_jobs
+        self.mem_gb = mem_gb
+        self.job_timeout = job_timeout
+        self.startup_timeout = startup_timeout
+        self.log_dir = log_dir
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        self.counter = itertools.count(1)
+        # a slot for each worker, None until it is started
+        self.idle = queue.LifoQueue()
+        for _ in range(n_workers):
+            self.idle.put(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self):
+        n = next(self.counter)
+        log_file = f"{self.log_dir}/worker_{n}.log" if self.log_dir else None
+        worker = Worker(self.command, log_file, self.startup_timeout)
+        print(f"Started MATLAB worker {worker.pid} ({self.command[0]})")
+        return worker
+
+    def _healthy(self, worker):
+        """
+        The worker if it answers, or a new one
+        """
+        if worker is not None and worker.alive() and worker.ping():
+            return worker
+        if worker is not None:
+            print(f"MATLAB worker {worker.pid} is not responding, restarting it")
+            worker.kill()
+        return self._start()
+
+    def _recycle(self, worker):
+        """
+        The worker, or None if it has to be restarted
+        """
+        if worker.jobs >= self.max_jobs:
+            reason = f"{worker.jobs} jobs"
+        elif self.mem_gb is not None and worker.rss_gb() > self.mem_gb:
+            reason = f"{worker.rss_gb():.1f} GB of memory"
+        else:
+            return worker
+        print(f"Recycling MATLAB worker {worker.pid} after {reason}")
+        worker.stop()
+        return None
+
+    def run(self, statement, cd=None, timeout=None, log_file=None):
+        """
+        Run a MATLAB statement in a worker (in the directory cd, with its
+        output to log_file), killing it after timeout seconds (by default, the
+        job_timeout of the pool).
+        Returns a dictionary with:
+            status: ok, failed (error in MATLAB), timeout or crashed (the
+                    worker died or could not start)
+            message: error message
+            wall_s: time of the job (without waiting for a worker)
+            worker: pid of the worker
+            start: start time
+        """
+        timeout = timeout if timeout is not None else self.job_timeout
+        worker = self.idle.get()
+        start = datetime.datetime.now().isoformat(timespec="seconds")
+        t0 = time.monotonic()
+        result = {"status": "crashed", "message": "", "worker": None}
+        try:
+            worker = self._healthy(worker)
+            result["worker"] = worker.pid
+            ok, message = worker.run(statement, cd, timeout, log_file)
+            result.update(status="ok" if ok else "failed", message=message)
+            worker = self._recycle(worker)
+        except TimeoutError as e:
+            result.update(status="timeout", message=str(e))
+            worker.kill()
+            worker = None
+        except WorkerError as e:
+            result.update(message=str(e))
+            if worker is not None:
+                worker.kill()
+            worker = None
+        finally:
+            self.idle.put(worker)
+        result.update(wall_s=round(time.monotonic() - t0, 2), start=start)
+        if result["status"] != "ok":
+            print(f"MATLAB job ended with {result['status']}: {result['message']}")
+        return result
+
+    def close(self):
+        """
+        End the idle workers (call it when no job is running)
+        """
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
+
+
+def fake_worker():
+    """
+    Stand-in for scripts/matlab_worker.m, without MATLAB
+    """
+    import re
+
+    time.sleep(float(os.environ.get("FAKE_MATLAB_STARTUP", 0)))
+    print(f"{MARKER}READY", flush=True)
+    home = os.getcwd()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        msg = json.loads(line)
+        if msg["type"] == "ping":
+            print(f"{MARKER}PONG", flush=True)
+        elif msg["type"] == "exit":
+            break
+        elif msg["type"] == "job":
+            status = "ok"
+            if msg["cd"]:
+                os.chdir(msg["cd"])
+            for statement in filter(None, (s.strip() for s in msg["eval"].split(";"))):
+                print(f">> {statement}", flush=True)
+                pause = re.fullmatch(r"pause\(([\d.]+)\)", statement)
+                error = re.fullmatch(r"error\('(.*)'\)", statement)
+                if pause:
+                    time.sleep(float(pause.group(1)))
+                elif error:
+                    status = f"failed {error.group(1)}"
+                    break
+                elif statement in ("exit", "quit"):
+                    sys.exit(1)
+            os.chdir(home)
+            print(f"{MARKER}DONE {msg['id']} {status}", flush=True)
+
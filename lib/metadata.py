@@ -0,0 +1,240 @@
+"""
+Index of the scanner metadata of the cohort, from the json sidecars.
+
+Before, the acquisition parameters were hardcoded in each script (TR from the
+csv, 48 slices and multiband 2 of MILAN, readout time 0.0828 of MILAN and
+dwell 0.000485 of CLINIC in DT_recon.sh...). Now every sidecar is parsed once
+(in parallel) into a table, keyed by (CENTER, SubjID, modality):
+    tr (s), n_slices, multiband, slice_timing (s), pe_dir, readout_time (s),
+    echo_spacing (s), echo_time (s)
+
+The table is saved as a csv ({out_dir}/metadata_index.csv) with the size and
+mtime of each sidecar, and a sidecar is only parsed again if it changes.
+The values that a sidecar does not have are taken from CENTER_DEFAULTS (the
+values that were hardcoded).
+"""
+import os
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_NAME = "metadata_index.csv"
+
+# modality: key of load_data with its sidecar
+SIDECAR_KEYS = {"func": "fMRI_json", "dwi": "dwi_json"}
+
+# values of the centers whose sidecars do not have them
+CENTER_DEFAULTS = {
+    "MILAN": {
+        "func": {"n_slices": 48, "multiband": 2},
+        "dwi": {"readout_time": 0.0828},
+    },
+    "CLINIC": {"dwi": {"echo_spacing": 0.000485}},
+}
+
+KEYS = ["CENTER", "SubjID", "modality"]
+
+# field: type
+FIELDS = {
+    "path": str,
+    "size": int,
+    "mtime_ns": int,
+    "tr": float,
+    "n_slices": int,
+    "multiband": int,
+    "slice_timing": lambda s: [float(t) for t in s.split()],
+    "pe_dir": str,
+    "readout_time": float,
+    "echo_spacing": float,
+    "echo_time": float,
+}
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None, None
+    return st.st_size, st.st_mtime_ns
+
+
+def parse_sidecar(path):
+    """
+    Metadata of a json sidecar (BIDS names). Missing values are None, and all
+    of them if the sidecar does not exist
+    """
+    size, mtime_ns = _stat(path)
+    meta = dict.fromkeys(FIELDS)
+    meta.update(path=path, size=size, mtime_ns=mtime_ns)
+    if size is None:
+        return meta
+    with open(path) as f:
+        info = json.load(f)
+
+    tr = info.get("RepetitionTime")
+    if tr is not None:
+        tr = float(tr)
+        # some converters write it in ms
+        meta["tr"] = tr / 1000 if tr > 100 else tr
+
+    slice_timing = info.get("SliceTiming")
+    if slice_timing:
+        meta["slice_timing"] = [float(t) for t in slice_timing]
+        meta["n_slices"] = len(slice_timing)
+        # slices acquired at the same time
+        n_times = len(set(round(t, 4) for t in slice_timing))
+        if meta["n_slices"] % n_times == 0:
+            meta["multiband"] = meta["n_slices"] // n_times
+    if info.get("MultibandAccelerationFactor"):
+        meta["multiband"] = int(info["MultibandAccelerationFactor"])
+
+    meta["pe_dir"] = info.get("PhaseEncodingDirection") or info.get("PhaseEncodingAxis")
+    for field, key in [
+        ("readout_time", "TotalReadoutTime"),
+        ("echo_spacing", "EffectiveEchoSpacing"),
+        ("echo_time", "EchoTime"),
+    ]:
+        if info.get(key) is not None:
+            meta[field] = float(info[key])
+    return meta
+
+
+def _format(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return " ".join(repr(t) for t in value)
+    return str(value)
+
+
+def load_index(index_file):
+    """
+    Index saved: {(CENTER, SubjID, modality): metadata}
+    """
+    index = {}
+    if not os.path.isfile(index_file):
+        return index
+    with open(index_file, newline="") as f:
+        for row in csv.DictReader(f):
+            key = tuple(row[k] for k in KEYS)
+            index[key] = {
+                field: convert(row[field]) if row.get(field) else None
+                for field, convert in FIELDS.items()
+            }
+    return index
+
+
+def save_index(index, index_file):
+    # tmp file of this process, so the rename is atomic
+    tmp = f"{index_file}.{os.getpid()}.tmp"
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(KEYS + list(FIELDS))
+        for key in sorted(index):
+            writer.writerow(list(key) + [_format(index[key][field]) for field in FIELDS])
+    os.replace(tmp, index_file)
+
+
+def is_current(meta, path):
+    """
+    The metadata is of the sidecar as it is now (the staged copies keep the
+    size and mtime, so the path is not compared)
+    """
+    return meta is not None and (meta["size"], meta["mtime_ns"]) == _stat(path)
+
+
+def build_index(entries, index_file, njobs=8):
+    """
+    Update the index with the sidecars of entries, [(CENTER, SubjID, modality,
+    path)], parsing only the new or changed ones (njobs at the same time).
+    The rows of other subjects are kept. Returns the index
+    """
+    index = load_index(index_file)
+    todo = [
+        (tuple(e[:3]), e[3])
+        for e in entries
+        if not is_current(index.get(tuple(e[:3])), e[3])
+    ]
+    if not todo:
+        return index
+
+    def parse(path):
+        try:
+            return parse_sidecar(path)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the sidecar {path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        parsed = list(pool.map(parse, [path for _, path in todo]))
+    for (key, _), meta in zip(todo, parsed):
+        if meta is not None:
+            index[key] = meta
+    save_index(index, index_file)
+    print(f"Metadata index: {len(todo)} sidecars parsed, {len(index)} in {index_file}")
+    return index
+
+
+def scan_cohort(base_data_dir, subjects, index_file, modalities=SIDECAR_KEYS, njobs=8):
+    """
+    Update the index with the sidecars of subjects, [(CENTER, SubjID)], found
+    with load_data
+    """
+    from lib.data_loading import load_data
+
+    def find(subject):
+        center, subID = subject
+        try:
+            d = load_data(f"{base_data_dir}/{center}/{subID}", subID, center)
+        except Exception:
+            print(f"Problem loading data for subject {subID} from {center}")
+            return []
+        return [
+            (center, subID, modality, d.get(key))
+            for modality, key in modalities.items()
+        ]
+
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        entries = [e for found in pool.map(find, subjects) for e in found]
+    return build_index(entries, index_file, njobs)
+
+
+def lookup(index, center, subID, modality, path=None):
+    """
+    Metadata of a subject, with the defaults of its center for the missing
+    values. If the sidecar has changed since it was indexed (or it is not in
+    the index), it is parsed again (without saving the index)
+    """
+    meta = index.get((center, subID, modality))
+    if path is not None and not is_current(meta, path):
+        meta = parse_sidecar(path)
+    meta = dict(meta or dict.fromkeys(FIELDS))
+    for field, value in CENTER_DEFAULTS.get(center, {}).get(modality, {}).items():
+        if meta[field] is None:
+            meta[field] = value
+    return meta
+
+
+def slice_times(meta):
+    """
+    Acquisition time (s) of each slice: the SliceTiming of the sidecar, or
+    from the number of slices and the multiband factor (slices 1 &
+    n_slices/multiband + 1, ... at the same time, ascending). None if unknown
+    """
+    if meta["slice_timing"]:
+        return meta["slice_timing"]
+    if meta["tr"] is None or not (meta["n_slices"] and meta["multiband"]):
+        return None
+    nsteps = meta["n_slices"] // meta["multiband"]
+    return [(i % nsteps) * meta["tr"] / nsteps for i in range(meta["n_slices"])]
+
+
+def conn_sliceorder(meta):
+    """
+    Slice order for CONN: the slice times in ms (MATLAB vector), or 'BIDS'
+    to read them from the sidecar
+    """
+    times = slice_times(meta)
+    if times is None:
+        return "'BIDS'"
+    return "[" + " ".join(f"{t * 1000:g}" for t in times) + "]"
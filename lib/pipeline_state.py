@@ -0,0 +1,271 @@
+"""
+Persistent state of the pipeline for every subject.
+
+Before, the state was a csv (pipeline.csv, created by check_all_pips.py) that
+was read once at the start of run_pipeline_prime.py and filtered for every
+subject. Now it is kept in a SQLite database, with one row per (CENTER, SubjID)
+(primary key, so lookups are indexed), and each step of the pipeline updates
+its own row as soon as it finishes, so the runner and check_all_pips.py share
+the same live view.
+
+The columns are the same as pipeline.csv, which can still be imported and
+exported (check_qc.py and move_completed_subjects.py read the csv).
+"""
+import os
+import sqlite3
+import datetime
+
+STEPS = ["fastsurfer", "DWI_preproc", "agg_SC", "fMRI", "toTVB"]
+
+
+def fastsurfer_done(out_dir_subject, subID):
+    return os.path.isfile(
+        f"{out_dir_subject}/recon_all/scripts/recon-all.done"
+    ) and os.path.isfile(f"{out_dir_subject}/recon_all/scripts/recon-surf.done")
+
+
+def dt_done(out_dir_subject, subID):
+    return os.path.isfile(f"{out_dir_subject}/dt_proc/connectome_weights.csv")
+
+
+def sc_done(out_dir_subject, subID):
+    return os.path.isfile(f"{out_dir_subject}/dt_proc/connectome_weights.csv")
+
+
+def fmri_done(out_dir_subject, subID):
+    return os.path.isfile(f"{out_dir_subject}/fmri_proc_dti/r_matrix.nii.gz")
+
+
+def tvb_done(out_dir_subject, subID):
+    # connectivity store (lib/connectivity_store.py), or the text files of
+    # the subjects processed before it
+    if os.path.isfile(f"{out_dir_subject}/results/connectivity.npz"):
+        return True
+    return (
+        os.path.isfile(f"{out_dir_subject}/results/{subID}_SC_distances.txt")
+        and os.path.isfile(f"{out_dir_subject}/results/{subID}_SC_weights.txt")
+        and os.path.isfile(f"{out_dir_subject}/results/r_matrix.csv")
+        and os.path.isfile(f"{out_dir_subject}/results/Connectivity.zip")
+    )
+
+
+# check of the outputs of each step
+STEP_CHECKS = {
+    "fastsurfer": fastsurfer_done,
+    "DWI_preproc": dt_done,
+    "agg_SC": sc_done,
+    "fMRI": fmri_done,
+    "toTVB": tvb_done,
+}
+
+
+def check_subject(out_dir_subject, subID, steps=STEPS):
+    """
+    Check which steps are done for a subject, looking at their outputs
+    """
+    return {step: STEP_CHECKS[step](out_dir_subject, subID) for step in steps}
+
+
+class PipelineState:
+    """
+    SQLite store with the state of the pipeline.
+
+    A new connection is opened for every operation, so the same object
+    can be used from several threads (and several processes).
+
+    WAL needs shared memory between the processes that use the database, so
+    it only works in a single host. When the database is shared between the
+    nodes of a cluster (network filesystem), use wal=False (rollback journal).
+    """
+
+    def __init__(self, db_file, wal=True):
+        self.db_file = db_file
+        with self._connect() as conn:
+            conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+            columns = ", ".join(f"{s} INTEGER NOT NULL DEFAULT 0" for s in STEPS)
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS status (CENTER TEXT NOT NULL, "
+                f"SubjID TEXT NOT NULL, {columns}, updated TEXT, "
+                f"PRIMARY KEY (CENTER, SubjID))"
+            )
+            # modification times of the directories of each subject, last time
+            # that they were checked (see check_all_pips.py)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scan_cache (CENTER TEXT NOT NULL, "
+                "SubjID TEXT NOT NULL, signature TEXT, "
+                "PRIMARY KEY (CENTER, SubjID))"
+            )
+            # jobs submitted to a cluster for each step (see lib/executors.py),
+            # so an interrupted run can be resumed without submitting them again
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (CENTER TEXT NOT NULL, "
+                "SubjID TEXT NOT NULL, step TEXT NOT NULL, job_id TEXT, "
+                "array_dir TEXT, task INTEGER, status TEXT, updated TEXT, "
+                "PRIMARY KEY (CENTER, SubjID, step))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def get(self, subID, center):
+        """
+        State of each step for a subject. Subjects that are not in the
+        store have all the steps not done.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(STEPS)} FROM status WHERE CENTER = ? AND SubjID = ?",
+                (center, subID),
+            ).fetchone()
+        if row is None:
+            return {step: False for step in STEPS}
+        return {step: bool(value) for step, value in zip(STEPS, row)}
+
+    def set(self, subID, center, **steps):
+        """
+        Update (atomically) the state of some steps of a subject,
+        ex: state.set("sub-01", "MILAN", fastsurfer=True)
+        """
+        unknown = set(steps) - set(STEPS)
+        if unknown:
+            raise ValueError(f"Unknown pipeline steps {unknown}")
+        self.set_many([(subID, center, steps)])
+
+    def set_many(self, rows):
+        """
+        Update several subjects in a single transaction.
+        rows: list of (subID, center, {step: done})
+        """
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self._connect() as conn:
+            for subID, center, steps in rows:
+                conn.execute(
+                    "INSERT OR IGNORE INTO status (CENTER, SubjID) VALUES (?, ?)",
+                    (center, subID),
+                )
+                if steps:
+                    assignments = ", ".join(f"{s} = ?" for s in steps)
+                    conn.execute(
+                        f"UPDATE status SET {assignments}, updated = ? "
+                        f"WHERE CENTER = ? AND SubjID = ?",
+                        [int(bool(v)) for v in steps.values()] + [now, center, subID],
+                    )
+
+    def refresh(self, subID, center, out_dir_subject, steps=STEPS):
+        """
+        Check the outputs of the steps of a subject and store the result.
+        Returns the new state of those steps.
+        """
+        done = check_subject(out_dir_subject, subID, steps)
+        self.set(subID, center, **done)
+        return done
+
+    def scan_signatures(self):
+        """
+        Cached signatures of all the subjects, {(center, subID): signature}
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("SELECT CENTER, SubjID, signature FROM scan_cache")
+            return {(c, s): sig for c, s, sig in cursor}
+
+    def set_scan_signatures(self, rows):
+        """
+        rows: list of (subID, center, signature)
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO scan_cache (CENTER, SubjID, signature) "
+                "VALUES (?, ?, ?)",
+                [(center, subID, sig) for subID, center, sig in rows],
+            )
+
+    def set_jobs(self, rows):
+        """
+        Record the jobs of some steps.
+        rows: list of (subID, center, step, job_id, array_dir, task, status)
+        """
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO jobs (CENTER, SubjID, step, job_id, "
+                "array_dir, task, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (center, subID, step, job_id, array_dir, task, status, now)
+                    for subID, center, step, job_id, array_dir, task, status in rows
+                ],
+            )
+
+    def jobs(self, status=None):
+        """
+        Recorded jobs, {(center, subID, step): (job_id, array_dir, task, status)}
+        """
+        query = "SELECT CENTER, SubjID, step, job_id, array_dir, task, status FROM jobs"
+        params = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self._connect() as conn:
+            return {
+                (c, s, step): (job_id, array_dir, task, st)
+                for c, s, step, job_id, array_dir, task, st in conn.execute(query, params)
+            }
+
+    def rows(self):
+        """
+        All the rows of the store, as dictionaries with the columns of pipeline.csv
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"SELECT SubjID, CENTER, {', '.join(STEPS)} FROM status "
+                f"ORDER BY CENTER, SubjID"
+            )
+            return [
+                dict(
+                    zip(
+                        ["id", "CENTER"] + STEPS,
+                        list(row[:2]) + [bool(v) for v in row[2:]],
+                    )
+                )
+                for row in cursor
+            ]
+
+    def import_csv(self, csv_file, overwrite=False):
+        """
+        Import a pipeline.csv. By default, subjects already in the store
+        are not modified (the csv could be older than the store).
+        """
+        import pandas as pd
+
+        df = pd.read_csv(csv_file, dtype={"id": str, "CENTER": str})
+        if not overwrite:
+            with self._connect() as conn:
+                existing = set(conn.execute("SELECT CENTER, SubjID FROM status"))
+            df = df[[(c, s) not in existing for c, s in zip(df.CENTER, df.id)]]
+        self.set_many(
+            [
+                (row["id"], row["CENTER"], {s: row[s] for s in STEPS if s in row})
+                for row in df.to_dict("records")
+            ]
+        )
+
+    def export_csv(self, csv_file):
+        """
+        Write the store as pipeline.csv
+        """
+        import pandas as pd
+
+        df = pd.DataFrame(self.rows(), columns=["id", "CENTER"] + STEPS)
+        df.to_csv(csv_file, index=False)
+
+
+def open_state(in_pip, wal=True):
+    """
+    Open the state store given to the scripts: either the database itself,
+    or a pipeline.csv, in which case the database next to it (pipeline.db) is
+    used, and created from the csv if needed.
+    """
+    if in_pip.endswith(".csv"):
+        state = PipelineState(os.path.splitext(in_pip)[0] + ".db", wal)
+        state.import_csv(in_pip)
+        return state
+    return PipelineState(in_pip, wal)
@@ -0,0 +1,314 @@
+"""
+Remove implausible streamlines between each pair of regions, in memory.
+
+Python version of the create_tracks loop of Tracking.sh: instead of splitting
+the tractogram in one file per pair of ROIs and running tckmap, fslmaths,
+cluster and tckedit for each of them, the streamlines and the nodes are loaded
+once and all the masks are computed with numpy/scipy on a crop around each
+pair.
+
+For each pair of ROIs (with at least 5 streamlines):
+ - Track density map, normalized and thresholded at 0.01, largest cluster.
+ - Exclude mask: the brain mask outside that cluster (not touching nodes).
+ - Remove the streamlines that touch the exclude mask, map them again,
+   erode + dilate (2D kernel) and keep the largest cluster.
+ - Include mask: that cluster plus the two ROIs, dilated (3D kernel).
+ - Truncate the original streamlines to the include mask, and keep the ones
+   that do not touch the exclude mask and reach both dilated ROIs.
+
+Voxels are looked up by nearest neighbour in the template grid.
+
+Based on https://doi.org/10.1371/journal.pone.0137064
+"""
+import argparse
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from lib.tck_io import TckFile, write_tck
+
+# 26 connectivity, as FSL cluster
+STRUCT_3D = np.ones((3, 3, 3), dtype=bool)
+# fslmaths -kernel 2D, 3x3 box in the x-y plane
+STRUCT_2D = np.zeros((3, 3, 3), dtype=bool)
+STRUCT_2D[:, :, 1] = True
+
+
+def load_assignments(assignments_file):
+    """
+    Load the node assignments written by tck2connectome -out_assignments,
+    one row per streamline. Each pair is returned sorted (lower node first).
+    """
+    assignments = np.loadtxt(assignments_file, comments="#", dtype=np.int64, ndmin=2)
+    return np.sort(assignments[:, :2], axis=1)
+
+
+def load_streamlines(tck_file):
+    """
+    Memory-map a .tck file (lib/tck_io.py). Returns the mapped points and
+    the offset and length of each streamline, only the streamlines of each
+    pair are read in memory later.
+    """
+    tck = TckFile(tck_file, persist_index=True)
+    return tck.data, tck.offsets, tck.lengths.astype(np.int64)
+
+
+def gather(points, offsets, lengths, selection):
+    """
+    Select a subset of streamlines, returning the new flat points,
+    offsets and lengths.
+    """
+    sel_lengths = lengths[selection]
+    sel_offsets = np.concatenate(([0], np.cumsum(sel_lengths)[:-1])).astype(np.int64)
+    idx = np.repeat(offsets[selection] - sel_offsets, sel_lengths) + np.arange(
+        sel_lengths.sum()
+    )
+    return np.asarray(points[idx]), sel_offsets, sel_lengths
+
+
+def to_voxels(points, inv_affine, shape):
+    """
+    World coordinates to (nearest) voxel indices. Points outside of the
+    volume are flagged as not valid.
+    """
+    vox = np.rint(points @ inv_affine[:3, :3].T + inv_affine[:3, 3]).astype(np.int64)
+    valid = np.all((vox >= 0) & (vox < np.array(shape)), axis=1)
+    vox[~valid] = 0
+    return vox, valid
+
+
+def in_mask(mask, vox, valid):
+    """
+    For each point, check if it falls inside the mask
+    """
+    return mask[vox[:, 0], vox[:, 1], vox[:, 2]] & valid
+
+
+def touches(mask, vox, valid, offsets):
+    """
+    For each streamline, check if any of its points falls inside the mask
+    """
+    if len(offsets) == 0:
+        return np.zeros(0, dtype=bool)
+    return np.logical_or.reduceat(in_mask(mask, vox, valid), offsets)
+
+
+def track_density(vox, valid, offsets, lengths, shape):
+    """
+    Number of streamlines that go through each voxel (as tckmap)
+    """
+    nvox = int(np.prod(shape))
+    flat = np.ravel_multi_index(vox[valid].T, shape)
+    sid = np.repeat(np.arange(len(lengths)), lengths)[valid]
+    # count each streamline only once per voxel
+    flat = np.unique(sid * nvox + flat) % nvox
+    return np.bincount(flat, minlength=nvox).reshape(shape)
+
+
+def largest_cluster(mask):
+    """
+    Keep only the largest connected cluster of the mask
+    """
+    labels, n_clusters = ndimage.label(mask, structure=STRUCT_3D)
+    if n_clusters == 0:
+        return np.zeros(mask.shape, dtype=bool)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    return labels == np.argmax(sizes)
+
+
+def crop_to_mask(points, vox, valid, offsets, mask):
+    """
+    Truncate the streamlines to the mask (as tckedit -mask): each run of
+    consecutive points inside the mask, of at least two points, becomes
+    a new streamline.
+    """
+    inside = in_mask(mask, vox, valid)
+    first_point = np.zeros(len(inside), dtype=bool)
+    first_point[offsets] = True
+    prev_inside = np.concatenate(([False], inside[:-1]))
+    run_start = inside & (first_point | ~prev_inside)
+    run_id = (np.cumsum(run_start) - 1)[inside]
+
+    run_lengths = np.bincount(run_id)
+    keep = run_lengths[run_id] >= 2
+    idx = np.flatnonzero(inside)[keep]
+    new_lengths = run_lengths[run_lengths >= 2]
+    new_offsets = np.concatenate(([0], np.cumsum(new_lengths)[:-1])).astype(np.int64)
+    return points[idx], vox[idx], valid[idx], new_offsets, new_lengths
+
+
+def prune_pair(points, offsets, lengths, nodes, roi1, roi2, brain_mask, inv_affine):
+    """
+    Remove the implausible streamlines connecting roi1 and roi2.
+
+    points, offsets, lengths: streamlines assigned to the pair
+    nodes: node parcellation (in diffusion space)
+    brain_mask: binary brain mask (in diffusion space)
+
+    Returns the points and lengths of the streamlines that are kept.
+    """
+    vox, valid = to_voxels(points, inv_affine, nodes.shape)
+    if not valid.any():
+        return points[:0], lengths[:0]
+
+    # crop everything around the streamlines, with margin for the dilations
+    lo = np.maximum(vox[valid].min(axis=0) - 2, 0)
+    hi = np.minimum(vox[valid].max(axis=0) + 3, nodes.shape)
+    crop = tuple(slice(a, b) for a, b in zip(lo, hi))
+    shape = tuple(hi - lo)
+    vox = vox - lo
+    valid = valid & np.all((vox >= 0) & (vox < np.array(shape)), axis=1)
+    vox[~valid] = 0
+
+    nodes_crop = nodes[crop]
+    nodes_bin = nodes_crop > 0
+    roi1_mask = nodes_crop == roi1
+    roi2_mask = nodes_crop == roi2
+
+    # track density map, normalized, binarized and largest cluster
+    tdi = track_density(vox, valid, offsets, lengths, shape)
+    if tdi.max() == 0:
+        return points[:0], lengths[:0]
+    cluster = largest_cluster(tdi / tdi.max() >= 0.01)
+
+    # brain outside of the cluster, not touching the nodes
+    exclude = (cluster != brain_mask[crop]) & ~nodes_bin
+
+    # map again the streamlines that do not go through the exclude mask
+    keep = ~touches(exclude, vox, valid, offsets)
+    sel_vox, sel_offsets, sel_lengths = gather(vox, offsets, lengths, keep)
+    sel_valid = gather(valid, offsets, lengths, keep)[0]
+    tdi = track_density(sel_vox, sel_valid, sel_offsets, sel_lengths, shape)
+
+    # erosion + dilation, and largest cluster again
+    include = ndimage.binary_erosion(tdi > 0, structure=STRUCT_2D)
+    include = ndimage.binary_dilation(include, structure=STRUCT_2D)
+    include = largest_cluster(include)
+
+    # add the two rois and dilate
+    include = ndimage.binary_dilation(
+        include | roi1_mask | roi2_mask, structure=STRUCT_3D
+    )
+
+    # truncate the streamlines to the include mask
+    points, vox, valid, offsets, lengths = crop_to_mask(
+        points, vox, valid, offsets, include
+    )
+
+    # exclude the not selected tracks and include the two (dilated) ROIs
+    roi1_dil = ndimage.binary_dilation(roi1_mask, structure=STRUCT_3D)
+    roi2_dil = ndimage.binary_dilation(roi2_mask, structure=STRUCT_3D)
+    keep = (
+        ~touches(exclude, vox, valid, offsets)
+        & touches(roi1_dil, vox, valid, offsets)
+        & touches(roi2_dil, vox, valid, offsets)
+    )
+    points, _, lengths = gather(points, offsets, lengths, keep)
+    return points, lengths
+
+
+def prune_tracks(
+    tck_file,
+    assignments_file,
+    nodes_file,
+    template_file,
+    mask_file,
+    out_file,
+    min_streamlines=5,
+):
+    """
+    Apply the removal of implausible streamlines to every pair of ROIs
+    and save all the remaining streamlines to out_file.
+
+    tck_file: full tractogram (brain_track.tck)
+    assignments_file: assignments of tck2connectome, one row per streamline
+    nodes_file: parcellation in diffusion space (nodes2diff.nii.gz)
+    template_file: image that defines the voxel grid (anat2diff.nii.gz)
+    mask_file: brain mask in diffusion space (dwi_ec_unbiased_mask.nii.gz)
+    out_file: output tractogram (brain_track_AEC.tck)
+    min_streamlines: pairs with less streamlines than this are removed
+    """
+    template = nib.load(template_file)
+    inv_affine = np.linalg.inv(template.affine)
+
+    nodes = np.rint(np.asanyarray(nib.load(nodes_file).dataobj)).astype(np.int16)
+    brain_mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    if not (nodes.shape[:3] == brain_mask.shape[:3] == template.shape[:3]):
+        raise ValueError(
+            "Nodes, mask and template need to be in the same (diffusion) space!"
+        )
+    nodes = nodes.reshape(template.shape[:3])
+    brain_mask = brain_mask.reshape(template.shape[:3])
+
+    points, offsets, lengths = load_streamlines(tck_file)
+    assignments = load_assignments(assignments_file)
+    if len(assignments) != len(lengths):
+        raise ValueError(
+            f"{len(assignments)} assignments for {len(lengths)} streamlines!"
+        )
+
+    # group the streamlines per pair of nodes, ignoring the unassigned ones
+    # and the ones that start and end in the same node
+    valid = (assignments[:, 0] > 0) & (assignments[:, 0] != assignments[:, 1])
+    valid &= lengths > 0
+    sids = np.flatnonzero(valid)
+    pair_key = assignments[sids, 0] * (nodes.max() + 1) + assignments[sids, 1]
+    order = np.argsort(pair_key, kind="stable")
+    sids, pair_key = sids[order], pair_key[order]
+    _, pair_start, pair_count = np.unique(
+        pair_key, return_index=True, return_counts=True
+    )
+
+    out_points = []
+    out_lengths = []
+    for start, count in zip(pair_start, pair_count):
+        roi1, roi2 = assignments[sids[start]]
+        if count < min_streamlines:
+            print(f"less than {min_streamlines} FC {roi1}-{roi2} {count}")
+            continue
+
+        pair_points, pair_offsets, pair_lengths = gather(
+            points, offsets, lengths, sids[start : start + count]
+        )
+        pair_points, pair_lengths = prune_pair(
+            pair_points,
+            pair_offsets,
+            pair_lengths,
+            nodes,
+            roi1,
+            roi2,
+            brain_mask,
+            inv_affine,
+        )
+        print(f"do {roi1} {roi2}: {count} -> {len(pair_lengths)}")
+        out_points.append(pair_points)
+        out_lengths.append(pair_lengths)
+
+    if len(out_points) == 0:
+        raise ValueError(f"No streamlines left after pruning {tck_file}!")
+
+    write_tck(out_file, np.concatenate(out_points), np.concatenate(out_lengths))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Remove implausible streamlines between each pair of regions"
+    )
+    parser.add_argument("tck_file", help="full tractogram (brain_track.tck)")
+    parser.add_argument("assignments", help="assignments from tck2connectome")
+    parser.add_argument("nodes", help="parcellation in diffusion space")
+    parser.add_argument("template", help="image with the diffusion space grid")
+    parser.add_argument("mask", help="brain mask in diffusion space")
+    parser.add_argument("out_file", help="output tractogram")
+    parser.add_argument("--min_streamlines", type=int, default=5)
+    args = parser.parse_args()
+
+    prune_tracks(
+        args.tck_file,
+        args.assignments,
+        args.nodes,
+        args.template,
+        args.mask,
+        args.out_file,
+        args.min_streamlines,
+    )
@@ -0,0 +1,189 @@
+"""
+Numeric QC metrics, to triage a whole cohort without opening the images.
+
+The volumes are read downsampled (every factor voxels, through the array proxy
+of nibabel) and all the metrics are vectorized numpy:
+ - registration: SSIM and NMI between two images in the same space
+ - mask: fraction of the mask inside the brain, volume of the mask
+ - SC: density, node strength and number of outlier nodes
+ - FC: mean and variance of the correlations, tSNR of the timeseries
+
+Each check of check_qc.py returns its metrics (saved in the QC manifest) and
+cohort_table puts all of them in a table (qc_metrics.csv), flagging the values
+that are outliers within their center.
+"""
+import glob
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from lib.qc_report import MANIFEST_NAME, load_manifest
+from lib.qc_render import load_image
+
+# robust z-score (median / MAD) above which a metric is flagged
+OUTLIER_Z = 3.5
+
+
+def load_downsampled(path, factor=2, sum_volumes=False):
+    """
+    Volume read every factor voxels, float32. Of 4D images, the first volume,
+    or the sum of all of them (ex: 5tt).
+    Returns the volume and its voxel size
+    """
+    img = load_image(path)
+    step = slice(None, None, factor)
+    if sum_volumes:
+        extra = (slice(None),) * (len(img.shape) - 3)
+    else:
+        extra = (0,) * (len(img.shape) - 3)
+    data = np.asarray(img.dataobj[(step, step, step) + extra], dtype=np.float32)
+    data = data.reshape(data.shape[:3] + (-1,)).sum(axis=-1)
+    return np.nan_to_num(data), np.array(img.header.get_zooms()[:3]) * factor
+
+
+def _scale(a):
+    low, high = np.percentile(a, [1, 99])
+    return np.clip((a - low) / (high - low), 0, 1) if high > low else np.zeros_like(a)
+
+
+def ssim(a, b, size=7):
+    """
+    Mean structural similarity between two volumes (scaled to 0-1), with
+    local statistics in windows of size voxels
+    """
+    a, b = _scale(a), _scale(b)
+    c1, c2 = 0.01**2, 0.03**2
+    mu_a = ndimage.uniform_filter(a, size)
+    mu_b = ndimage.uniform_filter(b, size)
+    var_a = ndimage.uniform_filter(a * a, size) - mu_a**2
+    var_b = ndimage.uniform_filter(b * b, size) - mu_b**2
+    cov = ndimage.uniform_filter(a * b, size) - mu_a * mu_b
+    s = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / (
+        (mu_a**2 + mu_b**2 + c1) * (var_a + var_b + c2)
+    )
+    return float(s.mean())
+
+
+def nmi(a, b, bins=32, mask=None):
+    """
+    Normalized mutual information, (H(a) + H(b)) / H(a, b): 1 for independent
+    images, 2 for identical ones
+    """
+    if mask is not None:
+        a, b = a[mask], b[mask]
+    joint, _, _ = np.histogram2d(a.ravel(), b.ravel(), bins=bins)
+    joint = joint / joint.sum()
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    return float(
+        (entropy(joint.sum(axis=0)) + entropy(joint.sum(axis=1))) / entropy(joint)
+    )
+
+
+def registration_metrics(path_a, path_b, factor=2):
+    """
+    SSIM and NMI between two volumes in the same space (ex: anat2diff and
+    the mean b0), inside the voxels where any of them is not zero
+    """
+    a, _ = load_downsampled(path_a, factor)
+    b, _ = load_downsampled(path_b, factor)
+    if a.shape != b.shape:
+        return {}
+    mask = (a != 0) | (b != 0)
+    return {"ssim": ssim(a, b), "nmi": nmi(a, b, mask=mask)}
+
+
+def mask_metrics(mask_path, brain_path=None, factor=2):
+    """
+    Fraction of the mask inside the brain (not zero voxels of brain_path,
+    summing all its volumes, ex: 5tt), and volume of the mask (ml).
+    Without brain_path, only the volume
+    """
+    mask, zooms = load_downsampled(mask_path, factor)
+    mask = mask > 0
+    metrics = {"mask_volume_ml": float(mask.sum() * np.prod(zooms) / 1000)}
+    if brain_path is None:
+        return metrics
+    brain, _ = load_downsampled(brain_path, factor, sum_volumes=True)
+    if brain.shape == mask.shape and mask.any():
+        metrics["mask_in_brain"] = float((mask & (brain > 0)).sum() / mask.sum())
+    return metrics
+
+
+def robust_z(values, axis=None):
+    values = np.asarray(values, dtype=np.float64)
+    median = np.nanmedian(values, axis=axis, keepdims=True)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median), axis=axis, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(mad > 0, (values - median) / mad, 0)
+
+
+def sc_metrics(weights):
+    """
+    Density of the SC, mean node strength and number of nodes with an
+    outlier strength
+    """
+    weights = np.asarray(weights)
+    n = len(weights)
+    upper = weights[np.triu_indices(n, 1)]
+    strength = weights.sum(axis=0)
+    return {
+        "sc_density": float(np.count_nonzero(upper) / upper.size),
+        "sc_strength_mean": float(strength.mean()),
+        "sc_strength_outliers": int(np.sum(np.abs(robust_z(strength)) > OUTLIER_Z)),
+    }
+
+
+def fc_metrics(r, ts=None):
+    """
+    Mean and variance of the FC (upper triangle) and median tSNR of the
+    timeseries (time x regions)
+    """
+    r = np.asarray(r)
+    upper = r[np.triu_indices(len(r), 1)]
+    metrics = {"fc_mean": float(upper.mean()), "fc_var": float(upper.var())}
+    if ts is not None and len(ts) > 1:
+        std = ts.std(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            tsnr = np.where(std > 0, np.abs(ts.mean(axis=0)) / std, 0)
+        metrics["ts_tsnr"] = float(np.median(tsnr))
+    return metrics
+
+
+def cohort_table(out_dir):
+    """
+    Table with the metrics of all the subjects (one column per check and
+    metric), with the outliers within each center flagged.
+    Saved in out_dir/qc_metrics.csv
+    """
+    rows = []
+    for manifest_file in sorted(glob.glob(f"{out_dir}/*/{MANIFEST_NAME}")):
+        manifest = load_manifest(manifest_file[: -len(MANIFEST_NAME) - 1])
+        if manifest is None:
+            continue
+        row = {"id": manifest["id"], "CENTER": manifest["CENTER"]}
+        for check, entry in manifest["checks"].items():
+            row[f"{check}_status"] = entry["status"]
+            for metric, value in entry["metrics"].items():
+                row[f"{check}_{metric}"] = value
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return df
+    metric_cols = [
+        c for c in df.columns if c not in ("id", "CENTER") and not c.endswith("_status")
+    ]
+    flags = pd.DataFrame(False, index=df.index, columns=metric_cols)
+    for _, group in df.groupby("CENTER"):
+        z = robust_z(group[metric_cols].to_numpy(dtype=np.float64), axis=0)
+        flags.loc[group.index] = np.abs(z) > OUTLIER_Z
+    failed = df[[c for c in df.columns if c.endswith("_status")]] == "failed"
+    df["flagged"] = [
+        ";".join(list(flags.columns[f]) + [c[: -len("_status")] for c in failed.columns[x]])
+        for f, x in zip(flags.to_numpy(), failed.to_numpy())
+    ]
+    df.to_csv(f"{out_dir}/qc_metrics.csv", index=False)
+    return df
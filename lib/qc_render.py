@@ -0,0 +1,209 @@
+"""
+Slice-based renderer for the QC images.
+
+mrivis loads the full volumes as float, rescales them, and renders every
+slice through matplotlib. Here only the slices that are shown are rendered
+(and, for uncompressed files, read through the array proxy of nibabel), the
+overlays are resampled only on those slices (so there is no need to reslice
+them with mri_convert), and the mosaics are composed with numpy and saved
+directly as PNG.
+
+Reading a slice of a compressed file (.nii.gz, .mgz) through the proxy
+decompresses it from the start, so those are read once and kept in memory
+(in the cache of load_image). Only uncompressed files are read slice by slice.
+bench_qc_render.py compares both.
+
+Each mosaic has a row for each view (sagittal, coronal, axial) and
+num_slices columns, evenly spaced between 15% and 85% of each axis.
+The images are rendered in the grid of a reference image (by default, the
+first one).
+"""
+import functools
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+VIEWS = (0, 1, 2)
+
+
+# files that are decompressed to be read
+COMPRESSED = (".gz", ".mgz", ".bz2", ".zst")
+
+
+@functools.lru_cache(maxsize=16)
+def load_image(path):
+    """
+    A volume: of compressed files, with all the data read (float32); of the
+    others, the header and the array proxy (the data is read when needed)
+    """
+    img = nib.load(path)
+    if path.endswith(COMPRESSED):
+        img = img.__class__(img.get_fdata(dtype=np.float32), img.affine, img.header)
+    return img
+
+
+def _image(img):
+    return load_image(img) if isinstance(img, str) else img
+
+
+def slice_indices(size, num_slices, margin=0.15):
+    return np.unique(
+        np.linspace(margin * (size - 1), (1 - margin) * (size - 1), num_slices).astype(int)
+    )
+
+
+def _extra_index(img):
+    # first volume of 4D images
+    return (0,) * (len(img.shape) - 3)
+
+
+def read_slices(img, grid, axis, indices, order=1):
+    """
+    Slices of img in the grid of another image (the reference).
+    If both have the same grid, each slice is read directly (from the proxy,
+    if the data is not in memory).
+    If not, only the block of img that covers each slice is read, and
+    resampled (order 0 for segmentations).
+    """
+    shape = grid.shape[:3]
+    extra = _extra_index(img)
+    same_grid = img.shape[:3] == shape and np.allclose(img.affine, grid.affine)
+
+    other = [a for a in range(3) if a != axis]
+    if not same_grid:
+        u, v = np.meshgrid(
+            np.arange(shape[other[0]]), np.arange(shape[other[1]]), indexing="ij"
+        )
+        vox2vox = np.linalg.inv(img.affine) @ grid.affine
+        img_shape = np.array(img.shape[:3])
+
+    slices = []
+    for i in indices:
+        if same_grid:
+            slicer = [slice(None)] * 3
+            slicer[axis] = int(i)
+            slices.append(np.asarray(img.dataobj[tuple(slicer) + extra], dtype=np.float32))
+            continue
+
+        coords = np.empty((3,) + u.shape)
+        coords[other[0]] = u
+        coords[other[1]] = v
+        coords[axis] = i
+        src = np.tensordot(vox2vox[:3, :3], coords, axes=1) + vox2vox[:3, 3, None, None]
+        lo = np.clip(np.floor(src.min(axis=(1, 2))).astype(int) - 1, 0, img_shape)
+        hi = np.clip(np.ceil(src.max(axis=(1, 2))).astype(int) + 2, 0, img_shape)
+        if np.any(hi <= lo):
+            slices.append(np.zeros(u.shape, dtype=np.float32))
+            continue
+        block = np.asarray(
+            img.dataobj[tuple(slice(a, b) for a, b in zip(lo, hi)) + extra],
+            dtype=np.float32,
+        )
+        slices.append(
+            ndimage.map_coordinates(
+                block, src - lo[:, None, None], order=order, mode="constant", cval=0
+            ).astype(np.float32)
+        )
+    return slices
+
+
+def read_views(img, grid, num_slices, order=1):
+    """
+    Slices of the three views, {axis: list of slices}, scaled to 0-1 (with
+    the minimum and maximum of all the slices read)
+    """
+    views = {
+        axis: read_slices(
+            img, grid, axis, slice_indices(grid.shape[axis], num_slices), order
+        )
+        for axis in VIEWS
+    }
+    values = np.concatenate([s.ravel() for slices in views.values() for s in slices])
+    low, high = (values.min(), values.max()) if values.size else (0, 0)
+    scale = high - low if high > low else 1
+    return {
+        axis: [(s - low) / scale for s in slices] for axis, slices in views.items()
+    }
+
+
+def mosaic(views):
+    """
+    Compose the slices in a single image: a row for each view.
+    Slices are rotated (superior/anterior up) and padded to the same size.
+    """
+    tiles = [[np.rot90(s) for s in views[axis]] for axis in VIEWS]
+    h = max(t.shape[0] for row in tiles for t in row)
+    w = max(t.shape[1] for row in tiles for t in row)
+    ncols = max(len(row) for row in tiles)
+    out = np.zeros((h * len(tiles), w * ncols) + tiles[0][0].shape[2:], dtype=np.float32)
+    for r, row in enumerate(tiles):
+        for c, t in enumerate(row):
+            y = r * h + (h - t.shape[0]) // 2
+            x = c * w + (w - t.shape[1]) // 2
+            out[y : y + t.shape[0], x : x + t.shape[1]] = t
+    return out
+
+
+def _save(output_path, image, cmap=None):
+    # same names as mrivis (png added if there is no extension)
+    if not output_path.endswith(".png"):
+        output_path = f"{output_path}.png"
+    plt.imsave(output_path, np.clip(image, 0, 1), cmap=cmap, vmin=0, vmax=1)
+    return output_path
+
+
+def collage(img, output_path, num_slices=12):
+    """
+    Mosaic of a volume (as mrivis.Collage)
+    """
+    img = _image(img)
+    return _save(output_path, mosaic(read_views(img, img, num_slices)), cmap="gray")
+
+
+def color_mix(
+    base, overlay, output_path, num_slices=10, alpha_channels=(1, 1), grid=None, cmap="jet"
+):
+    """
+    Overlay (in color, only where it is not zero) over a base image in gray
+    (as mrivis.color_mix). The overlay is resampled in the grid of the base
+    image, or in the grid of the image given in grid.
+    """
+    base, overlay = _image(base), _image(overlay)
+    grid = base if grid is None else _image(grid)
+    base_views = read_views(base, grid, num_slices)
+    overlay_views = read_views(overlay, grid, num_slices, order=0)
+    colormap = matplotlib.colormaps[cmap]
+
+    mixed = {}
+    for axis in VIEWS:
+        mixed[axis] = []
+        for b, o in zip(base_views[axis], overlay_views[axis]):
+            gray = np.repeat((b * alpha_channels[0])[..., None], 3, axis=-1)
+            color = colormap(o)[..., :3]
+            alpha = (o > 0)[..., None] * alpha_channels[1]
+            mixed[axis].append(gray * (1 - alpha) + color * alpha)
+    return _save(output_path, mosaic(mixed))
+
+
+def checkerboard(img1, img2, output_path, patch_size=15, num_slices=10, grid=None):
+    """
+    Alternate square patches of two images (as mrivis.checkerboard), to check
+    their registration. img2 is resampled in the grid of img1 (or grid).
+    """
+    img1, img2 = _image(img1), _image(img2)
+    grid = img1 if grid is None else _image(grid)
+    views1 = read_views(img1, grid, num_slices)
+    views2 = read_views(img2, grid, num_slices)
+
+    mixed = {}
+    for axis in VIEWS:
+        mixed[axis] = []
+        for a, b in zip(views1[axis], views2[axis]):
+            i, j = np.indices(a.shape)
+            board = ((i // patch_size) + (j // patch_size)) % 2 == 0
+            mixed[axis].append(np.where(board, a, b))
+    return _save(output_path, mosaic(mixed), cmap="gray")
@@ -0,0 +1,274 @@
+"""
+Incremental QC index of a cohort.
+
+For each subject, check_qc.py writes a manifest ({out_dir}/{CENTER}_{subID}/qc.json)
+with, for each check: the hashes of its inputs, the images it created, its
+numeric metrics and if it failed. A check is only run again when its inputs
+have changed (or it failed, or its images are missing).
+
+Each subject also has an html fragment (qc.html), rewritten only when its
+manifest changes, and all of them are put together in a static dashboard
+(index.html) with thumbnails, filters by center and step, and pass/fail
+buttons. The pass/fail annotations are exported from the dashboard as
+qc_annotations.csv (id, CENTER, QC, comment), from which the QC column of the
+subjects csv (used by run_CONN.py) is produced.
+"""
+import os
+import glob
+import json
+import html
+import datetime
+from lib.step_cache import hash_inputs
+
+MANIFEST_NAME = "qc.json"
+FRAGMENT_NAME = "qc.html"
+ANNOTATIONS_NAME = "qc_annotations.csv"
+
+
+def load_manifest(subj_out_dir):
+    try:
+        with open(f"{subj_out_dir}/{MANIFEST_NAME}") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_manifest(subj_out_dir, manifest):
+    path = f"{subj_out_dir}/{MANIFEST_NAME}"
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def new_manifest(subID, center):
+    return {"id": subID, "CENTER": center, "checks": {}}
+
+
+def check_inputs(subj_dir, inputs, previous=None):
+    """
+    Hashes of the inputs of a check (paths relative to subj_dir)
+    """
+    return hash_inputs({f: f"{subj_dir}/{f}" for f in inputs}, previous)
+
+
+def _sha(hashes):
+    return {k: (None if h is None else h["sha256"]) for k, h in hashes.items()}
+
+
+def is_up_to_date(entry, hashes, subj_out_dir):
+    """
+    Check if a check has already run with the same inputs and its images
+    are still there
+    """
+    if entry is None or entry.get("status") != "ok":
+        return False
+    if _sha(entry["inputs"]) != _sha(hashes):
+        return False
+    return all(os.path.isfile(f"{subj_out_dir}/{img}") for img in entry["images"])
+
+
+def image_mtimes(subj_out_dir):
+    return {
+        os.path.basename(f): os.stat(f).st_mtime_ns
+        for f in glob.glob(f"{subj_out_dir}/*.png")
+    }
+
+
+def new_images(before, after):
+    """
+    Images created or modified by a check
+    """
+    return sorted(f for f, mtime in after.items() if before.get(f) != mtime)
+
+
+def record_check(manifest, name, hashes, images, metrics, status, error=None):
+    manifest["checks"][name] = {
+        "inputs": hashes,
+        "images": images,
+        "metrics": metrics or {},
+        "status": status,
+        "error": error,
+        "updated": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def render_fragment(manifest, subj_dir_name):
+    """
+    html of a subject for the dashboard
+    """
+    subID, center = manifest["id"], manifest["CENTER"]
+    key = html.escape(f"{center}_{subID}")
+    parts = [
+        f'<div class="subject" data-center="{html.escape(center)}" '
+        f'data-id="{html.escape(subID)}" data-key="{key}">',
+        f"<h3>{html.escape(subID)} ({html.escape(center)})"
+        f' <label><input type="radio" name="{key}" value="Y"> pass</label>'
+        f' <label><input type="radio" name="{key}" value="N"> fail</label>'
+        f' <input type="text" class="comment" placeholder="comment"></h3>',
+    ]
+    for name, entry in sorted(manifest["checks"].items()):
+        metrics = ", ".join(
+            f"{k}={v:.3g}" if isinstance(v, float) else f"{k}={v}"
+            for k, v in sorted(entry["metrics"].items())
+        )
+        parts.append(
+            f'<div class="check" data-step="{html.escape(name)}">'
+            f"<b>{html.escape(name)}</b> [{entry['status']}] {html.escape(metrics)}"
+        )
+        if entry.get("error"):
+            parts.append(f"<pre>{html.escape(entry['error'])}</pre>")
+        for img in entry["images"]:
+            src = html.escape(f"{subj_dir_name}/{img}")
+            parts.append(
+                f'<a href="{src}"><img src="{src}" loading="lazy" title="{html.escape(img)}"></a>'
+            )
+        parts.append("</div>")
+    parts.append("</div>")
+    return "\n".join(parts) + "\n"
+
+
+def write_fragment(subj_out_dir, manifest):
+    """
+    Write the html of the subject, only if it has changed
+    """
+    fragment = render_fragment(manifest, os.path.basename(subj_out_dir.rstrip("/")))
+    path = f"{subj_out_dir}/{FRAGMENT_NAME}"
+    if os.path.isfile(path):
+        with open(path) as f:
+            if f.read() == fragment:
+                return False
+    with open(path, "w") as f:
+        f.write(fragment)
+    return True
+
+
+DASHBOARD_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>QC</title>
+<style>
+body {{ font-family: sans-serif; }}
+.subject {{ border-bottom: 1px solid #ccc; padding: 4px; }}
+.check img {{ width: 300px; margin: 2px; }}
+.hidden {{ display: none; }}
+</style></head><body>
+<h2>QC ({n_subjects} subjects)</h2>
+<p>Center: <select id="center"><option value="">all</option>{centers}</select>
+Step: <select id="step"><option value="">all</option>{steps}</select>
+<label><input type="checkbox" id="failed"> only failed checks</label>
+<button onclick="exportAnnotations()">Export annotations</button></p>
+{fragments}
+<script>
+const annotations = {annotations};
+function applyFilters() {{
+  const center = document.getElementById("center").value;
+  const step = document.getElementById("step").value;
+  const failed = document.getElementById("failed").checked;
+  document.querySelectorAll(".subject").forEach(s => {{
+    let visible = !center || s.dataset.center === center;
+    s.querySelectorAll(".check").forEach(c => {{
+      const show = (!step || c.dataset.step === step) &&
+        (!failed || !c.textContent.includes("[ok]"));
+      c.classList.toggle("hidden", !show);
+    }});
+    if (!s.querySelector(".check:not(.hidden)")) visible = false;
+    s.classList.toggle("hidden", !visible);
+  }});
+}}
+function exportAnnotations() {{
+  let csv = "id,CENTER,QC,comment\\n";
+  document.querySelectorAll(".subject").forEach(s => {{
+    const checked = s.querySelector("input[type=radio]:checked");
+    const comment = s.querySelector(".comment").value.replace(/[",\\n]/g, " ");
+    if (checked || comment)
+      csv += `${{s.dataset.id}},${{s.dataset.center}},${{checked ? checked.value : ""}},${{comment}}\\n`;
+  }});
+  const a = document.createElement("a");
+  a.href = URL.createObjectURL(new Blob([csv], {{type: "text/csv"}}));
+  a.download = "{annotations_name}";
+  a.click();
+}}
+document.querySelectorAll(".subject").forEach(s => {{
+  const a = annotations[s.dataset.key];
+  if (!a) return;
+  const radio = s.querySelector(`input[value="${{a.QC}}"]`);
+  if (radio) radio.checked = true;
+  s.querySelector(".comment").value = a.comment || "";
+}});
+["center", "step", "failed"].forEach(id =>
+  document.getElementById(id).addEventListener("change", applyFilters));
+</script></body></html>
+"""
+
+
+def load_annotations(out_dir):
+    """
+    Annotations exported from the dashboard, {CENTER_id: {QC, comment}}
+    """
+    path = f"{out_dir}/{ANNOTATIONS_NAME}"
+    if not os.path.isfile(path):
+        return {}
+    import pandas as pd
+
+    df = pd.read_csv(path, dtype=str).fillna("")
+    return {
+        f"{row['CENTER']}_{row['id']}": {"QC": row["QC"], "comment": row["comment"]}
+        for row in df.to_dict("records")
+    }
+
+
+def build_dashboard(out_dir):
+    """
+    Put together the fragments of all the subjects in out_dir/index.html
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    fragments = []
+    centers = set()
+    steps = set()
+    for manifest_file in sorted(glob.glob(f"{out_dir}/*/{MANIFEST_NAME}")):
+        subj_out_dir = os.path.dirname(manifest_file)
+        manifest = load_manifest(subj_out_dir)
+        if manifest is None:
+            continue
+        # subjects from before the fragments
+        if not os.path.isfile(f"{subj_out_dir}/{FRAGMENT_NAME}"):
+            write_fragment(subj_out_dir, manifest)
+        with open(f"{subj_out_dir}/{FRAGMENT_NAME}") as f:
+            fragments.append(f.read())
+        centers.add(manifest["CENTER"])
+        steps.update(manifest["checks"])
+
+    def options(values):
+        return "".join(
+            f'<option value="{html.escape(v)}">{html.escape(v)}</option>'
+            for v in sorted(values)
+        )
+
+    page = DASHBOARD_TEMPLATE.format(
+        n_subjects=len(fragments),
+        centers=options(centers),
+        steps=options(steps),
+        fragments="".join(fragments),
+        annotations=json.dumps(load_annotations(out_dir)),
+        annotations_name=ANNOTATIONS_NAME,
+    )
+    with open(f"{out_dir}/index.html", "w") as f:
+        f.write(page)
+    return f"{out_dir}/index.html"
+
+
+def update_qc_column(out_dir, subjects_csv, id_col="SubjID"):
+    """
+    Set the QC column (Y/N) of the subjects csv from the annotations of the
+    dashboard. Subjects without annotation keep their value.
+    """
+    import pandas as pd
+
+    annotations = load_annotations(out_dir)
+    df = pd.read_csv(subjects_csv, dtype={id_col: str, "CENTER": str})
+    if "QC" not in df.columns:
+        df["QC"] = ""
+    df["QC"] = df["QC"].astype(object)
+    for i, (subID, center) in enumerate(zip(df[id_col], df.CENTER)):
+        a = annotations.get(f"{center}_{subID}")
+        if a is not None and a["QC"] in ("Y", "N"):
+            df.iloc[i, df.columns.get_loc("QC")] = a["QC"]
+    df.to_csv(subjects_csv, index=False)
@@ -0,0 +1,151 @@
+"""
+Dependency graph scheduler for the steps of the pipeline.
+
+Each step of each subject is a Task, that declares the steps it depends on and
+the cpus and memory that it uses. The scheduler runs all the tasks whose
+dependencies have finished, as long as they fit in the global budget of cpus
+and memory, so steps of different subjects overlap (the Tracking of one subject
+can run while the FastSurfer of another one is running) without oversubscribing
+the machine.
+
+Tasks run in threads (they mostly wait for external processes). A task fails if
+it raises an exception or returns False, and then the tasks that depend on it
+are not run, except the ones marked as always (ex: cleanup).
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Task:
+    """
+    A step of the pipeline.
+
+    name: name of the task (for the logs), ex: "sub-01/tck"
+    func: function to run, with args
+    deps: tasks that need to finish before this one
+    cpus, mem_gb: resources used while running
+    always: run even if the dependencies failed
+    """
+
+    def __init__(self, name, func, args=(), deps=(), cpus=1, mem_gb=1, always=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+        self.always = always
+        self.status = PENDING
+        self.result = None
+
+    def __repr__(self):
+        return f"Task({self.name}, {self.status})"
+
+
+class Scheduler:
+    """
+    Run a graph of tasks within a budget of cpus and memory (GB).
+    max_tasks limits the number of tasks running at the same time.
+    """
+
+    def __init__(self, max_cpus, max_mem_gb, max_tasks=None):
+        self.max_cpus = max_cpus
+        self.max_mem_gb = max_mem_gb
+        self.max_tasks = max_tasks
+        self.tasks = []
+
+    def add(self, name, func, args=(), deps=(), cpus=1, mem_gb=1, always=False):
+        """
+        Add a task to the graph, and return it (to be used as dependency)
+        """
+        task = Task(
+            name,
+            func,
+            args,
+            [d for d in deps if d is not None],
+            # a task bigger than the budget runs alone
+            min(cpus, self.max_cpus),
+            min(mem_gb, self.max_mem_gb),
+            always,
+        )
+        self.tasks.append(task)
+        return task
+
+    def _ready(self, task):
+        """
+        Check if the dependencies of a task have finished. Tasks with
+        failed dependencies are skipped (unless always).
+        """
+        if any(d.status in (PENDING, RUNNING) for d in task.deps):
+            return False
+        if not task.always and any(d.status != DONE for d in task.deps):
+            task.status = SKIPPED
+            return False
+        return True
+
+    def _run_task(self, task):
+        try:
+            task.result = task.func(*task.args)
+            task.status = FAILED if task.result is False else DONE
+        except Exception as e:
+            print(f"{task.name} failed: {e!r}")
+            task.status = FAILED
+        return task
+
+    def run(self):
+        """
+        Run all the tasks. Returns the tasks (with their final status).
+        """
+        used_cpus = 0
+        used_mem = 0
+        running = set()
+        max_workers = self.max_tasks or max(len(self.tasks), 1)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while True:
+                # launch, in order, the tasks that are ready and fit in the budget
+                for task in self.tasks:
+                    if task.status != PENDING or not self._ready(task):
+                        continue
+                    if self.max_tasks is not None and len(running) >= self.max_tasks:
+                        break
+                    if (
+                        used_cpus + task.cpus > self.max_cpus
+                        or used_mem + task.mem_gb > self.max_mem_gb
+                    ):
+                        continue
+                    task.status = RUNNING
+                    used_cpus += task.cpus
+                    used_mem += task.mem_gb
+                    running.add(pool.submit(self._run_task, task))
+
+                if not running:
+                    break
+
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                running = set(running)
+                for future in finished:
+                    task = future.result()
+                    used_cpus -= task.cpus
+                    used_mem -= task.mem_gb
+
+        # tasks that could not run (dependencies not in the graph)
+        for task in self.tasks:
+            if task.status == PENDING:
+                task.status = SKIPPED
+
+        return self.tasks
+
+    def summary(self):
+        """
+        Number of tasks in each final status
+        """
+        counts = {}
+        for task in self.tasks:
+            counts[task.status] = counts.get(task.status, 0) + 1
+        return counts
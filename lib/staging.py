@@ -0,0 +1,173 @@
+"""
+Stage the raw data of a subject in the local working directory.
+
+Before, the whole directory of the subject was copied (cp -R) for every
+subject, even if the selected steps did not read any raw data. Now only the
+files that the steps use (from the dictionary of load_data) are staged:
+ - if the working directory is in the same filesystem as the raw data, they
+   are hardlinked (or reflinked, or symlinked if that is not possible), so
+   nothing is copied,
+ - if not, they are copied, several at the same time.
+
+The staged files keep the same relative paths as in the raw directory, and
+the staged directory is always removed by cleanup() (also when used as a
+context manager).
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # not in windows
+    fcntl = None
+
+# ioctl to clone a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def link_file(src, dst):
+    """
+    Stage a file in the same filesystem without copying it:
+    hardlink, reflink or symlink, the first that works.
+    Returns the method used.
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    if fcntl is not None and os.path.isfile(src):
+        try:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+            return "reflink"
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    os.symlink(os.path.abspath(src), dst)
+    return "symlink"
+
+
+def copy_file(src, dst):
+    """
+    Copy a file (or a directory) to another filesystem, keeping the
+    modification times
+    """
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return "copy"
+
+
+def is_staged(src, dst):
+    """
+    Check if dst is a complete staged copy (or link) of src: same size and
+    modification time (copy_file and link_file keep them)
+    """
+    if not os.path.lexists(dst):
+        return False
+    if os.path.isdir(src):
+        return os.path.isdir(dst)
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:  # broken symlink
+        return False
+    return s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns
+
+
+def remove(path):
+    """
+    Remove a file, link or directory, if it exists
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Staging:
+    """
+    Staged raw data of a subject.
+
+    source_dir: raw directory of the subject
+    stage_dir: local directory where the files are staged
+    njobs: maximum number of files copied at the same time
+    """
+
+    def __init__(self, source_dir, stage_dir, njobs=4):
+        self.source_dir = source_dir
+        self.stage_dir = stage_dir
+        self.njobs = njobs
+
+    def _staged_path(self, path):
+        rel = os.path.relpath(path, self.source_dir)
+        if rel.startswith(os.pardir):
+            # not in the directory of the subject
+            rel = os.path.basename(path)
+        return os.path.join(self.stage_dir, rel)
+
+    def stage(self, d, keys):
+        """
+        Stage the files of d (dictionary of load_data) in keys.
+        Returns a copy of d with the staged paths. The files that do not exist
+        (ex: no FLAIR for this subject) are not staged.
+        """
+        to_stage = {}
+        for key in keys:
+            path = d.get(key)
+            if path and os.path.exists(path):
+                to_stage[key] = (path, self._staged_path(path))
+
+        if not to_stage:
+            return dict(d)
+
+        os.makedirs(self.stage_dir, exist_ok=True)
+        same_fs = os.stat(self.stage_dir).st_dev == os.stat(self.source_dir).st_dev
+        stage_file = link_file if same_fs else copy_file
+
+        def stage_one(paths):
+            src, dst = paths
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if is_staged(src, dst):
+                return "staged"
+            remove(dst)
+            # staged in a temporal path and renamed when complete, so a
+            # killed job does not leave a truncated file that looks staged
+            tmp = dst + ".tmp"
+            remove(tmp)
+            if same_fs and os.path.isdir(src):
+                os.symlink(os.path.abspath(src), tmp)
+                method = "symlink"
+            else:
+                method = stage_file(src, tmp)
+            os.replace(tmp, dst)
+            return method
+
+        # same path for several keys, only once
+        unique = list(dict.fromkeys(to_stage.values()))
+        with ThreadPoolExecutor(max_workers=1 if same_fs else self.njobs) as pool:
+            list(pool.map(stage_one, unique))
+
+        staged = dict(d)
+        staged.update({key: dst for key, (src, dst) in to_stage.items()})
+        return staged
+
+    def cleanup(self):
+        """
+        Remove the staged files (only the links, not the raw data)
+        """
+        shutil.rmtree(self.stage_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+        return False
@@ -0,0 +1,177 @@
+"""
+Content-addressed cache of the steps of the pipeline.
+
+When a step finishes, a manifest is saved in
+{out_dir_subject}/manifests/{step}.json with:
+ - the sha256 of each input file (and its size and mtime),
+ - the version of the step,
+ - the parameters of the step,
+ - the outputs that it creates.
+
+Before running a step again, the manifest is built for the current inputs:
+if it is identical to the saved one and all the outputs exist, the step is
+skipped. So rerunning after a crash, or after changing the version or a
+parameter, only recomputes the steps (and subjects) that are affected.
+
+The version is declared with the step, and changed only when a change of its
+scripts changes the results (not for a refactor or a speed up). Manifests
+saved before the versions (with the sha256 of the scripts instead) are
+version 1.
+
+Hashing big inputs (DWI) is slow, so the hash of the saved manifest is reused
+when the size and modification time of the file have not changed.
+"""
+import os
+import json
+import hashlib
+import datetime
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    sha256 of the contents of a file
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_inputs(inputs, previous=None):
+    """
+    Hash the input files.
+
+    inputs: {name: path}. Missing files are recorded as None.
+    previous: inputs of a previous manifest, to reuse the hashes of the
+              files that have not changed.
+    """
+    previous = previous or {}
+    hashes = {}
+    for name, path in sorted(inputs.items()):
+        if path is None or not os.path.isfile(path):
+            hashes[name] = None
+            continue
+        stat = os.stat(path)
+        old = previous.get(name)
+        if (
+            old is not None
+            and old["size"] == stat.st_size
+            and old["mtime"] == stat.st_mtime_ns
+        ):
+            sha = old["sha256"]
+        else:
+            sha = file_hash(path)
+        hashes[name] = {"sha256": sha, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    return hashes
+
+
+def manifest_path(out_dir_subject, step):
+    return f"{out_dir_subject}/manifests/{step}.json"
+
+
+def load_manifest(out_dir_subject, step):
+    try:
+        with open(manifest_path(out_dir_subject, step)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if "version" not in manifest:
+        manifest.pop("scripts", None)
+        manifest["version"] = 1
+    return manifest
+
+
+def build_manifest(out_dir_subject, step, inputs, version, params, outputs):
+    """
+    Manifest of a step for the current inputs.
+
+    inputs: {name: path} of the input files
+    version: version of the step
+    params: dictionary with the parameters (json serializable)
+    outputs: list of outputs, relative to out_dir_subject
+    """
+    previous = load_manifest(out_dir_subject, step) or {}
+    return {
+        "step": step,
+        "inputs": hash_inputs(inputs, previous.get("inputs")),
+        "version": version,
+        "params": params,
+        "outputs": list(outputs),
+    }
+
+
+def _key(manifest):
+    """
+    Part of the manifest that identifies the computation
+    """
+    inputs = {
+        name: (None if h is None else h["sha256"])
+        for name, h in manifest["inputs"].items()
+    }
+    return json.dumps(
+        [inputs, manifest["version"], manifest["params"], manifest["outputs"]],
+        sort_keys=True,
+    )
+
+
+def is_stale(out_dir_subject, step, version, params, inputs=None):
+    """
+    Quick check, without hashing the inputs: True if the step has a manifest,
+    but it was done with another version or parameters, or some of the input
+    files in inputs ({name: path}) have changed (size or modification time)
+    since.
+    """
+    saved = load_manifest(out_dir_subject, step)
+    if saved is None:
+        return False
+    if saved["version"] != version or saved["params"] != params:
+        return True
+    for name, path in (inputs or {}).items():
+        old = saved["inputs"].get(name)
+        if not os.path.isfile(path):
+            if old is not None:
+                return True
+            continue
+        stat = os.stat(path)
+        if old is None or old["size"] != stat.st_size or old["mtime"] != stat.st_mtime_ns:
+            return True
+    return False
+
+
+def is_cached(out_dir_subject, manifest):
+    """
+    Check if the step has already been done with the same inputs, scripts and
+    parameters, and all its outputs are still there.
+    """
+    saved = load_manifest(out_dir_subject, manifest["step"])
+    if saved is None or _key(saved) != _key(manifest):
+        return False
+    return all(os.path.exists(f"{out_dir_subject}/{o}") for o in manifest["outputs"])
+
+
+def save_manifest(out_dir_subject, manifest):
+    """
+    Save the manifest of a step that has finished, only if all its outputs
+    have been created. Written to a temporal file and renamed, so a crash
+    never leaves a half-written manifest.
+    """
+    if not all(os.path.exists(f"{out_dir_subject}/{o}") for o in manifest["outputs"]):
+        return False
+    path = manifest_path(out_dir_subject, manifest["step"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    manifest = dict(manifest, created=datetime.datetime.now().isoformat())
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+    return True
+
+
+def invalidate(out_dir_subject, step):
+    """
+    Remove the manifest of a step (before running it again)
+    """
+    try:
+        os.remove(manifest_path(out_dir_subject, step))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,278 @@
+"""
+Supervisor of the external scripts of the pipeline.
+
+Before, each script was run with Popen(...).wait(): without time limit (a hung
+eddy or MATLAB blocked its worker forever), without checking how it ended, and
+without any accounting. Now each script:
+ - runs in its own session (process group), so it can be killed with all the
+   processes that it has started,
+ - is killed if it runs longer than its time limit, or if the memory (RSS) of
+   all its processes goes over its memory limit. The RSS is sampled from
+   /proc, RLIMIT_AS is not used because MATLAB and CUDA reserve much more
+   virtual memory than they use,
+ - is profiled: wall time, cpu time (os.wait4), peak RSS of the group, and
+   bytes read and written (/proc/<pid>/io, and the blocks of the rusage).
+
+Each run is appended as a json line to the profile of the subject
+(profile.jsonl), and summarize_profiles puts together the profiles of all the
+subjects, by center and step, to find the bottlenecks:
+    python -m lib.supervisor /DATA/MAGNIMS2021
+"""
+import os
+import json
+import time
+import signal
+import datetime
+import resource
+import contextlib
+import subprocess
+
+PROFILE_NAME = "profile.jsonl"
+
+# seconds between samples of the processes
+SAMPLE_INTERVAL = 1.0
+
+# seconds between SIGTERM and SIGKILL
+KILL_GRACE = 10
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def parse_walltime(walltime):
+    """
+    Seconds of a time limit as [[D-]HH:]MM:SS, or None
+    """
+    if walltime is None:
+        return None
+    days = 0
+    if "-" in walltime:
+        d, walltime = walltime.split("-", 1)
+        days = int(d)
+    seconds = 0
+    for part in walltime.split(":"):
+        seconds = seconds * 60 + int(part)
+    return days * 86400 + seconds
+
+
+def session_processes(sid):
+    """
+    Pids of the processes of a session
+    """
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the name can have spaces, the fields start after the last )
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # state, ppid, pgrp, session
+        if int(fields[3]) == sid and fields[0] != "Z":
+            pids.append(int(entry))
+    return pids
+
+
+def rss(pid):
+    """
+    Resident memory (bytes) of a process, 0 if it has finished
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _io(pid):
+    """
+    (bytes read, bytes written) from the storage by a process
+    """
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def kill_session(pid, sig):
+    """
+    Send a signal to all the processes of the session started by pid
+    """
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def supervise(command, log_file, timeout=None, mem_gb=None, env=None, interval=SAMPLE_INTERVAL):
+    """
+    Run a shell command, with all the output to log_file, within a time limit
+    (seconds) and a memory limit (GB, RSS of all its processes).
+
+    Returns a dictionary with:
+        status: ok, failed (exit code not 0), timeout or memory (killed)
+        exit_code: exit code (negative: killed by that signal)
+        wall_s, user_s, sys_s: wall and cpu time
+        peak_rss_mb: peak RSS of all the processes at the same time (sampled)
+        max_rss_mb: RSS of the biggest process (rusage)
+        read_mb, write_mb: bytes read and written from the storage
+        start: start time
+    """
+    start = datetime.datetime.now().isoformat(timespec="seconds")
+    t0 = time.monotonic()
+    with open(log_file, "w") as f:
+        # not exec: of a compound command (a; b) only the first part would run
+        proc = subprocess.Popen(
+            ["bash", "-c", command],
+            stdout=f,
+            stderr=f,
+            env=env,
+            start_new_session=True,
+        )
+
+    peak_rss = 0
+    io = {}  # last io of each process (also of the ones that have finished)
+    killed = None
+    kill_time = None
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+
+        pids = session_processes(proc.pid)
+        group_rss = sum(rss(p) for p in pids)
+        peak_rss = max(peak_rss, group_rss)
+        for p in pids:
+            value = _io(p)
+            if value is not None:
+                io[p] = value
+
+        elapsed = time.monotonic() - t0
+        if killed is None:
+            if timeout is not None and elapsed > timeout:
+                killed = "timeout"
+            elif mem_gb is not None and group_rss > mem_gb * 1024**3:
+                killed = "memory"
+            if killed is not None:
+                print(f"Killing {command.split()[0]} ({killed}), see {log_file}")
+                kill_session(proc.pid, signal.SIGTERM)
+                kill_time = elapsed
+        elif elapsed - kill_time > KILL_GRACE:
+            kill_session(proc.pid, signal.SIGKILL)
+        time.sleep(interval)
+
+    # the processes left in the group (ex: in background) are not needed
+    kill_session(proc.pid, signal.SIGKILL)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    read = sum(r for r, _ in io.values())
+    written = sum(w for _, w in io.values())
+    if killed is not None:
+        result_status = killed
+    else:
+        result_status = "ok" if proc.returncode == 0 else "failed"
+    return {
+        "status": result_status,
+        "exit_code": proc.returncode,
+        "wall_s": round(time.monotonic() - t0, 2),
+        "user_s": round(rusage.ru_utime, 2),
+        "sys_s": round(rusage.ru_stime, 2),
+        "peak_rss_mb": round(peak_rss / 1024**2, 1),
+        # KB in linux
+        "max_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+        # blocks of 512 bytes
+        "read_mb": round(max(read, rusage.ru_inblock * 512) / 1024**2, 1),
+        "write_mb": round(max(written, rusage.ru_oublock * 512) / 1024**2, 1),
+        "start": start,
+    }
+
+
+def write_profile(out_dir_subject, record):
+    """
+    Append a record to the profile of a subject (a line is written at once,
+    so runs of several steps at the same time are not mixed)
+    """
+    with open(f"{out_dir_subject}/{PROFILE_NAME}", "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def profiled(out_dir_subject, **fields):
+    """
+    Profile a block of python code (ex: CreateTVB) of a subject: wall time and
+    cpu time of the thread. The record has the fields given (subject, step...)
+    """
+    start = datetime.datetime.now().isoformat(timespec="seconds")
+    t0 = time.monotonic()
+    r0 = resource.getrusage(resource.RUSAGE_THREAD)
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        r1 = resource.getrusage(resource.RUSAGE_THREAD)
+        record = dict(
+            fields,
+            status=status,
+            wall_s=round(time.monotonic() - t0, 2),
+            user_s=round(r1.ru_utime - r0.ru_utime, 2),
+            sys_s=round(r1.ru_stime - r0.ru_stime, 2),
+            start=start,
+        )
+        try:
+            write_profile(out_dir_subject, record)
+        except OSError as e:
+            print(f"Could not write the profile of {out_dir_subject}: {e}")
+
+
+def summarize_profiles(out_dir):
+    """
+    Profiles of all the subjects ({out_dir}/{CENTER}_Post/{subID}/profile.jsonl),
+    summarized by center and step: runs, failed runs, median and maximum wall
+    time, median cpu time and maximum peak RSS
+    """
+    import glob
+    import pandas as pd
+
+    records = []
+    for path in glob.glob(f"{out_dir}/*_Post/*/{PROFILE_NAME}"):
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    if not records:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(records)
+    for col in ["peak_rss_mb", "user_s", "sys_s"]:
+        if col not in df:
+            df[col] = float("nan")
+    df["cpu_s"] = df.user_s + df.sys_s
+    df["failed"] = df.status != "ok"
+    return (
+        df.groupby(["center", "step"])
+        .agg(
+            runs=("status", "size"),
+            failed=("failed", "sum"),
+            wall_median_s=("wall_s", "median"),
+            wall_max_s=("wall_s", "max"),
+            cpu_median_s=("cpu_s", "median"),
+            peak_rss_max_mb=("peak_rss_mb", "max"),
+        )
+        .sort_values("wall_median_s", ascending=False)
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summary of the profiles of the steps, by center and step")
+    parser.add_argument("out_dir", help="output directory of the pipeline")
+    parser.add_argument("--out_csv", help="also save the summary in a csv")
+    args = parser.parse_args()
+
+    summary = summarize_profiles(args.out_dir)
+    print(summary.to_string())
+    if args.out_csv:
+        summary.to_csv(args.out_csv)
@@ -0,0 +1,248 @@
+"""
+Read and write MRtrix .tck files without loading them in memory.
+
+The tractograms of the pipeline (6M streamlines) are several GB, so the
+data of the file is memory-mapped and the position of each streamline is
+indexed once (start row and number of points). The index can be saved
+next to the .tck ({tck_file}.idx.npz) so that it is only computed once.
+
+Streamlines are returned as a flat array of points with the offset and length
+of each streamline, the same representation used in lib/prune_tracks.py:
+
+    points[offsets[i] : offsets[i] + lengths[i]] are the points of streamline i
+
+Format: https://mrtrix.readthedocs.io/en/latest/getting_started/image_data.html#tracks-file-format-tck
+"""
+import os
+import numpy as np
+
+DTYPES = {
+    "Float32LE": "<f4",
+    "Float32BE": ">f4",
+    "Float64LE": "<f8",
+    "Float64BE": ">f8",
+}
+
+# rows read at once when building the index
+INDEX_CHUNK_ROWS = 1 << 22
+
+
+def read_header(tck_file):
+    """
+    Read the text header of a .tck file into a dictionary.
+    Also includes the data offset (in bytes) and the numpy dtype.
+    """
+    header = {}
+    with open(tck_file, "rb") as f:
+        magic = f.readline().decode("latin-1").strip()
+        if magic != "mrtrix tracks":
+            raise ValueError(f"{tck_file} is not a .tck file!")
+        for line in f:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+            key, _, value = line.partition(":")
+            key, value = key.strip(), value.strip()
+            # repeated keys (command_history) are kept as lines
+            if key in header:
+                header[key] = f"{header[key]}\n{value}"
+            else:
+                header[key] = value
+        else:
+            raise ValueError(f"Header of {tck_file} has no END!")
+
+    filename, offset = header["file"].split()
+    if filename != ".":
+        raise ValueError(f"{tck_file}: data in a separate file is not supported")
+    header["offset"] = int(offset)
+    header["dtype"] = DTYPES[header.get("datatype", "Float32LE")]
+    return header
+
+
+def build_index(data, chunk_rows=INDEX_CHUNK_ROWS):
+    """
+    Find the start row and the number of points of each streamline
+    (delimited by NaN rows, and the file by an Inf row), reading the
+    memory-mapped data by chunks.
+    """
+    delimiters = []
+    end_row = len(data)
+    for base in range(0, len(data), chunk_rows):
+        first = data[base : base + chunk_rows, 0]
+        delimiters.append(np.flatnonzero(np.isnan(first)) + base)
+        inf_rows = np.flatnonzero(np.isinf(first))
+        if len(inf_rows) > 0:
+            end_row = base + inf_rows[0]
+            break
+
+    delimiters = np.concatenate(delimiters).astype(np.int64)
+    delimiters = delimiters[delimiters < end_row]
+    starts = np.concatenate(([0], delimiters[:-1] + 1)).astype(np.int64)
+    lengths = (delimiters - starts).astype(np.uint32)
+    return starts, lengths
+
+
+def index_path(tck_file):
+    return f"{tck_file}.idx.npz"
+
+
+def load_index(tck_file):
+    """
+    Load the sidecar index of a tractogram, if it exists and it
+    was created for this same file (same size and modification time).
+    """
+    idx_file = index_path(tck_file)
+    if not os.path.isfile(idx_file):
+        return None
+    stat = os.stat(tck_file)
+    with np.load(idx_file) as idx:
+        if int(idx["size"]) != stat.st_size or int(idx["mtime"]) != stat.st_mtime_ns:
+            return None
+        return idx["starts"], idx["lengths"]
+
+
+def save_index(tck_file, starts, lengths):
+    stat = os.stat(tck_file)
+    np.savez(
+        index_path(tck_file),
+        starts=starts,
+        lengths=lengths,
+        size=stat.st_size,
+        mtime=stat.st_mtime_ns,
+    )
+
+
+class TckFile:
+    """
+    Memory-mapped .tck file.
+
+    tck_file: path of the tractogram
+    persist_index: save the index of the streamlines next to the file
+                   (and reuse it if it is still valid)
+    """
+
+    def __init__(self, tck_file, persist_index=False):
+        self.tck_file = tck_file
+        self.header = read_header(tck_file)
+
+        n_bytes = os.path.getsize(tck_file) - self.header["offset"]
+        itemsize = np.dtype(self.header["dtype"]).itemsize
+        n_rows = n_bytes // (3 * itemsize)
+        self.data = np.memmap(
+            tck_file,
+            dtype=self.header["dtype"],
+            mode="r",
+            offset=self.header["offset"],
+            shape=(n_rows, 3),
+        )
+
+        index = load_index(tck_file) if persist_index else None
+        if index is None:
+            index = build_index(self.data)
+            if persist_index:
+                save_index(tck_file, *index)
+        self.offsets, self.lengths = index
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def streamline(self, i):
+        return self.data[self.offsets[i] : self.offsets[i] + self.lengths[i]]
+
+    def get(self, selection):
+        """
+        Load a subset of streamlines (indices or boolean mask) in memory.
+        Returns the flat points and the new offsets and lengths.
+        """
+        lengths = self.lengths[selection].astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        idx = np.repeat(self.offsets[selection] - offsets, lengths) + np.arange(
+            lengths.sum()
+        )
+        return np.asarray(self.data[idx], dtype=np.float32), offsets, lengths
+
+    def iter_chunks(self, chunk_size=100000):
+        """
+        Yield the streamlines in chunks of chunk_size, as
+        (first streamline, points, offsets, lengths). Points are a view of the
+        mapped file (including the NaN delimiters), nothing is copied.
+        """
+        for first in range(0, len(self), chunk_size):
+            last = min(first + chunk_size, len(self))
+            start = self.offsets[first]
+            end = self.offsets[last - 1] + self.lengths[last - 1]
+            yield (
+                first,
+                self.data[start:end],
+                self.offsets[first:last] - start,
+                self.lengths[first:last].astype(np.int64),
+            )
+
+    def write_subset(self, out_file, selection):
+        """
+        Write a subset of the streamlines (indices or boolean mask) to a
+        new .tck file. Consecutive selected streamlines are written directly
+        from the mapped file, as a single block.
+        """
+        selection = np.arange(len(self))[selection]
+        header = _copy_header(self.header)
+        with open(out_file, "wb") as f:
+            f.write(_header_bytes(header, len(selection), self.header["dtype"]))
+            if len(selection) > 0:
+                # blocks of consecutive streamlines, NaN delimiters included
+                breaks = np.flatnonzero(np.diff(selection) != 1) + 1
+                block_first = selection[np.concatenate(([0], breaks))]
+                block_last = selection[np.concatenate((breaks - 1, [-1]))]
+                for a, b in zip(block_first, block_last):
+                    start = self.offsets[a]
+                    end = self.offsets[b] + self.lengths[b] + 1
+                    f.write(self.data[start:end].view(np.uint8))
+            f.write(np.full((1, 3), np.inf, dtype=self.header["dtype"]).tobytes())
+
+
+def _copy_header(header):
+    """
+    Header fields that are copied to a new file
+    """
+    skip = ["file", "offset", "dtype", "datatype", "count", "total_count"]
+    return {k: v for k, v in header.items() if k not in skip}
+
+
+def _header_bytes(header, count, dtype="<f4"):
+    """
+    Text header of a .tck file, with the data offset right after it
+    """
+    datatype = {v: k for k, v in DTYPES.items()}[np.dtype(dtype).str]
+    lines = ["mrtrix tracks"]
+    for key, value in header.items():
+        for v in str(value).split("\n"):
+            lines.append(f"{key}: {v}")
+    lines += [f"datatype: {datatype}", f"count: {count:010d}"]
+    text = "\n".join(lines) + "\n"
+
+    # the offset is part of the header itself
+    base = len(text) + len("file: . \nEND\n")
+    offset = base
+    while base + len(str(offset)) != offset:
+        offset = base + len(str(offset))
+    return f"{text}file: . {offset}\nEND\n".encode("latin-1")
+
+
+def write_tck(out_file, points, lengths, header=None):
+    """
+    Write streamlines given as flat points and the number of points of
+    each streamline to a .tck file.
+    """
+    header = {} if header is None else _copy_header(header)
+    points = np.asarray(points, dtype="<f4")
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    # insert a NaN delimiter after each streamline
+    out = np.full((len(points) + len(lengths) + 1, 3), np.nan, dtype="<f4")
+    rows = np.arange(len(points)) + np.repeat(np.arange(len(lengths)), lengths)
+    out[rows] = points
+    out[-1] = np.inf
+
+    with open(out_file, "wb") as f:
+        f.write(_header_bytes(header, len(lengths)))
+        f.write(out.tobytes())
@@ -8,6 +8,7 @@ import shutil
 import os
 import pandas as pd
 import numpy as np
+from lib.connectivity_store import store_path, export_tvb
 
 
 @click.command(
@@ -39,7 +40,20 @@ def move_completed_subjects(ind_dir, pip_csv, out_dir):
             if not os.path.exists(f"{out_dir_subj}/results/"):
                 os.makedirs(f"{out_dir_subj}/results/")
 
-            # copy connectivity.zip, weights, tracts, z_matrix and zr_matrix
+            # export connectivity.zip, weights, tracts, z_matrix and zr_matrix
+            # from the connectivity store
+            if os.path.isfile(store_path(f"{subj_dir_id}/results")):
+                shutil.copy2(
+                    store_path(f"{subj_dir_id}/results"), f"{out_dir_subj}/results/"
+                )
+                export_tvb(
+                    store_path(f"{subj_dir_id}/results"),
+                    f"{out_dir_subj}/results",
+                    f"{type_dir}_{subID}",
+                )
+                continue
+
+            # subjects processed before the store, copy the files
             shutil.copy2(
                 f"{subj_dir_id}/results/Connectivity.zip", f"{out_dir_subj}/results/"
             )
@@ -10,29 +10,42 @@ For each subject:
  - Moves the necessary data to the new directories
  - Converts the label generated by fastsurfer to MNI 1mm
  - Generates a .mat file with all the selected subjects
- - Runs it in parallel
+ - Runs it in parallel. With --multi, the subjects with the same TR are run
+        in a single CONN project (scripts/Base_batch_multi.m, one MATLAB
+        session for all of them, parallelized by CONN)
+ - With --matlab_workers, the batches run in MATLAB sessions that are kept
+        open for all the subjects (lib/matlab_pool.py)
+ - The TR and the slice times are taken from the index of the json sidecars
+        (lib/metadata.py), parsed once for all the subjects
  - Extract the timeseries per region and the FC, save them with the
-        same format as the other pipeline
+        same format as the other pipeline (lib/conn_results.py, also
+        harvest_conn.py for all the subjects)
 """
 
 import argparse
 import pandas as pd
 import os
 from lib.data_loading import load_data
+from lib.conn_results import harvest_subject, mat_paths
+from lib.matlab_pool import MatlabPool, matlab_command
+from lib.metadata import INDEX_NAME, scan_cohort, lookup, conn_sliceorder
 from joblib import Parallel, delayed
-import scipy.io as sio
 import subprocess
-import numpy as np
 
+# hardcoded because yes
+matlab_path = "matlab"
+# CONN base directory (with CONN and Base_batch.m)
+conn_path = ""
 
-def run_pipeline(row, out_dir, base_data_dir, batch):
+# seconds that the batch of a subject can run in a MATLAB of the pool
+CONN_TIMEOUT = 6 * 3600
+
+
+def prepare_subject(row, out_dir, base_data_dir, index):
     """
-    Run conn pipeline for a single subject
+    Create the directories of a subject and copy its data.
+    Returns the information to run CONN, or None if it is not used
     """
-    # NOTE THAT WE NEED TO HAVE THE SAME TR FOR ALL SUBJECTS in a SINGLE project
-    # so, no need to do separate ones. Try to do single them
-    i = 0
-    # Start the loop
     # subject information
     subID = row.SubjID
     center_to_process = row.CENTER
@@ -74,7 +87,9 @@ def run_pipeline(row, out_dir, base_data_dir, batch):
 
     fmri = d["fMRI"]
     os.system(f"cp {fmri} {out_dir_subject}/fmri")
-    TR = d["TR"] / 1000
+    # scanner parameters from the sidecar (the TR of the csv if there is none)
+    meta = lookup(index, center_to_process, subID, "func", d.get("fMRI_json"))
+    TR = meta["tr"] if meta["tr"] is not None else d["TR"] / 1000
 
     # Get recon_all path
     recon_all_path = f"{out_dir}/{center_to_process}_Post/{subID}"
@@ -83,82 +98,145 @@ def run_pipeline(row, out_dir, base_data_dir, batch):
     file_newseg = f"{out_dir}/aparc.DKTatlas+aseg_newSeg.txt"
     os.system(f"cp {file_newseg} {recon_all_path}/recon_all")
 
+    return {
+        "subID": subID,
+        "center": center_to_process,
+        "out_dir_subject": out_dir_subject,
+        "func_path": f"{out_dir_subject}/fmri/{os.path.basename(fmri)}",
+        "recon_all_path": recon_all_path,
+        "TR": TR,
+        "sliceorder": conn_sliceorder(meta),
+    }
+
+
+def run_matlab(work_dir, function_call, pool=None, timeout=None):
+    """
+    Run a function of the CONN base directory in a new MATLAB session, or in
+    a session of the pool (killed after timeout seconds, by default the
+    job_timeout of the pool). Returns True if it has finished without errors
+    """
+    if pool is not None:
+        result = pool.run(
+            function_call, cd=work_dir, timeout=timeout, log_file=f"{work_dir}/log_conn.txt"
+        )
+        if result["status"] != "ok":
+            print(f"CONN in {work_dir} ended with {result['status']}, see {work_dir}/log_conn.txt")
+        return result["status"] == "ok"
+    # run
+    print(
+        f'export MATLABPATH={conn_path}; {matlab_path} -nosplash -nodisplay -nodesktop -r "cd {work_dir}; {function_call}"'
+    )
+    # redirect all output to file
+    # with open(output_file, 'w') as f:
+    cmd = subprocess.Popen(
+        f'export MATLABPATH={conn_path}; {matlab_path} -nosplash -nodesktop -r "cd {work_dir}; {function_call}exit;"',
+        shell=True,
+    )  # , stdout=f, stderr=f)
+    return cmd.wait() == 0
+
+
+def save_results(out_dir_subject, mat_timeseries_path, mat_FC_path):
+    """
+    Extract the timeseries per region and the FC of a subject from the results
+    of CONN, and save them in out_dir_subject/results (lib/conn_results.py)
+    """
+    if harvest_subject(out_dir_subject, mat_timeseries_path, mat_FC_path) == "missing":
+        print("Results not found! Something went wrong with processing")
+        return 0
+
+
+def run_pipeline(row, out_dir, base_data_dir, batch, index, pool=None):
+    """
+    Run conn pipeline for a single subject
+    """
+    subject = prepare_subject(row, out_dir, base_data_dir, index)
+    if subject is None:
+        return None
+    out_dir_subject = subject["out_dir_subject"]
+
     # Run the batch
-    # parameters
-    matlab_path = "''"
-    conn_path = "''"
-    func_path = f"{out_dir_subject}/fmri/{os.path.basename(fmri)}"
-    sliceorder = "'BIDS'"  # DEPEND ON CENTER, TODO
     scans_to_remove = 5
 
+    mat_timeseries_path, mat_FC_path = mat_paths(out_dir_subject)
     # if results doesnt exist, need to be done
-    if not os.path.exists(
-        f"{out_dir_subject}/conn_FC/results/preprocessing/ROI_Subject001_Condition000.mat"
-    ):
+    if not os.path.exists(mat_timeseries_path):
         function_call = (
             "Base_batch('"
-            + func_path
+            + subject["func_path"]
             + "', '"
-            + recon_all_path
+            + subject["recon_all_path"]
             + "', '"
             + out_dir_subject
             + "', str2num('"
-            + str(TR)
+            + str(subject["TR"])
             + "'), "
-            + str(sliceorder)
+            + str(subject["sliceorder"])
             + ", "
             + str(scans_to_remove)
             + ");"
         )
-        # run
-        print(
-            f'export MATLABPATH={conn_path}; {matlab_path} -nosplash -nodisplay -nodesktop -r "cd {out_dir_subject}; {function_call}"'
-        )
-        # redirect all output to file
-        # with open(output_file, 'w') as f:
-        cmd = subprocess.Popen(
-            f'export MATLABPATH={conn_path}; {matlab_path} -nosplash -nodesktop -r "cd {out_dir_subject}; {function_call}exit;"',
-            shell=True,
-        )  # , stdout=f, stderr=f)
-        cmd.wait()
-
-    # load mat file with the timeseries per row
-    try:
-        mat_timeseries_path = f"{out_dir_subject}/conn_FC/results/preprocessing/ROI_Subject001_Condition000.mat"
-        mat_FC_path = f"{out_dir_subject}/conn_FC/results/firstlevel/FC1/resultsROI_Subject001_Condition001.mat"
-        mat_timeseries = sio.loadmat(mat_timeseries_path, squeeze_me=True)
-        mat_FC = sio.loadmat(mat_FC_path, squeeze_me=True)
-    except FileNotFoundError:
-        print("Results not found! Something went wrong with processing")
-        return 0
+        if not run_matlab(out_dir_subject, function_call, pool):
+            return None
+
+    save_results(out_dir_subject, mat_timeseries_path, mat_FC_path)
 
-    # save the ROI timeseries
-    # select last 76 items
-    timeseries = [ts for ts in mat_timeseries["data"][3:]]
-    corrlabel_ts = np.array(timeseries).T
+    # Copy QC results to a shared directory
 
-    # load FC
-    FC_CONN = mat_FC["Z"]
 
-    # Do own FC
-    fMRI_syn = np.corrcoef(corrlabel_ts.T)
-    fMRI_syn = np.nan_to_num(fMRI_syn)
+def run_group(subjects, group_dir, nparallel, pool=None):
+    """
+    Run CONN for several subjects with the same TR (and slice order) in a
+    single project (scripts/Base_batch_multi.m), and split the results of
+    each subject (ROI_SubjectXXX) to its CONN/results
+    """
+    scans_to_remove = 5
+    if not os.path.exists(group_dir):
+        os.makedirs(group_dir)
+
+    # the order of the subjects in the project
+    subjects_file = f"{group_dir}/subjects.txt"
+    with open(subjects_file, "w") as f:
+        for subject in subjects:
+            f.write(f"{subject['func_path']}\t{subject['recon_all_path']}\n")
+
+    function_call = (
+        f"Base_batch_multi('{subjects_file}', '{group_dir}', "
+        f"str2num('{subjects[0]['TR']}'), {subjects[0]['sliceorder']}, "
+        f"{scans_to_remove}, {nparallel});"
+    )
+    # the batch of the whole group
+    timeout = pool.job_timeout * len(subjects) if pool is not None and pool.job_timeout else None
+    if not run_matlab(group_dir, function_call, pool, timeout):
+        return
 
-    # compute the zfisher correlation
-    z_fmri_syn = np.arctanh(fMRI_syn)
-    infs = np.isinf(z_fmri_syn).nonzero()
-    # replace the infs with 0
-    for idx in range(len(infs[0])):
-        z_fmri_syn[infs[0][idx]][infs[1][idx]] = 0
-    np.fill_diagonal(z_fmri_syn, 0)
+    for i, subject in enumerate(subjects, 1):
+        save_results(subject["out_dir_subject"], *mat_paths(group_dir, i))
 
-    # Save all versions (zscored and normal)
-    np.savetxt(f"{out_dir_subject}/results/r_matrix.csv", fMRI_syn, delimiter=",")
-    np.savetxt(f"{out_dir_subject}/results/zr_matrix.csv", z_fmri_syn, delimiter=",")
-    np.savetxt(f"{out_dir_subject}/results/conn_matrix.csv", FC_CONN, delimiter=",")
-    np.savetxt(f"{out_dir_subject}/results/corrlabel_ts.txt", corrlabel_ts)
 
-    # Copy QC results to a shared directory
+def run_multi(rows, out_dir, base_data_dir, index, njobs, nparallel, pool=None):
+    """
+    Run CONN with a project per group of subjects of the same TR and slice
+    order (a CONN project needs the same ones), instead of one MATLAB per
+    subject. The subjects that already have results are not run again
+    """
+    subjects = Parallel(n_jobs=njobs, backend="threading")(
+        delayed(prepare_subject)(row, out_dir, base_data_dir, index) for row in rows
+    )
+    groups = {}
+    for subject in subjects:
+        if subject is None:
+            continue
+        if os.path.exists(f"{subject['out_dir_subject']}/results/conn_matrix.csv"):
+            print(f"CONN for {subject['subID']} already done, skipping")
+            continue
+        groups.setdefault((subject["TR"], subject["sliceorder"]), []).append(subject)
+
+    # the groups run one after the other, CONN runs the subjects in parallel
+    for n, ((TR, _), group) in enumerate(sorted(groups.items()), 1):
+        center = group[0]["center"]
+        group_dir = f"{out_dir}/{center}_Post/CONN_multi/TR{TR:g}_{n}"
+        print(f"Running CONN for {len(group)} subjects with TR {TR:g} in {group_dir}")
+        run_group(group, group_dir, nparallel, pool)
 
 
 parser = argparse.ArgumentParser()
@@ -189,6 +267,29 @@ parser.add_argument(
 parser.add_argument(
     "--njobs", type=int, required=True, default=1, help="Number of jobs to use"
 )
+parser.add_argument(
+    "--multi",
+    action="store_true",
+    help="a CONN project for all the subjects with the same TR, instead of one per subject",
+)
+parser.add_argument(
+    "--matlab_workers",
+    type=int,
+    default=0,
+    help="MATLAB sessions kept open to run the batches, instead of one per batch",
+)
+parser.add_argument(
+    "--matlab_timeout",
+    type=int,
+    default=CONN_TIMEOUT,
+    help="with --matlab_workers, seconds that the batch of a subject can run (the MATLAB session is killed after)",
+)
+parser.add_argument(
+    "--nparallel",
+    type=int,
+    default=1,
+    help="with --multi, number of parallel jobs of CONN in each project",
+)
 
 # Parse and print the results
 args = parser.parse_args()
@@ -208,7 +309,40 @@ df_connect = pd.read_csv(args.in_csv)
 currentDirectory = os.getcwd()
 
 df_connect_todo = df_connect[df_connect.CENTER == center_to_process]
-outputs = Parallel(n_jobs=args.njobs, backend="threading")(
-    delayed(run_pipeline)(row, out_dir, base_data_dir, batch)
-    for row in df_connect_todo.itertuples()
+
+# parse the sidecars of all the subjects once (only the new or changed ones)
+index = scan_cohort(
+    base_data_dir,
+    [(row.CENTER, row.SubjID) for row in df_connect_todo.itertuples() if row.QC != "N"],
+    f"{out_dir}/{INDEX_NAME}",
+    {"func": "fMRI_json"},
+    njobs,
 )
+pool = None
+if args.matlab_workers > 0:
+    # CONN (and Base_batch) in the path of the workers, as with MATLABPATH
+    pool = MatlabPool(
+        args.matlab_workers,
+        matlab_command(matlab_path, paths=[conn_path]),
+        job_timeout=args.matlab_timeout,
+        log_dir=f"{out_dir}/matlab_pool",
+    )
+try:
+    if args.multi:
+        run_multi(
+            list(df_connect_todo.itertuples()),
+            out_dir,
+            base_data_dir,
+            index,
+            njobs,
+            args.nparallel,
+            pool,
+        )
+    else:
+        outputs = Parallel(n_jobs=args.njobs, backend="threading")(
+            delayed(run_pipeline)(row, out_dir, base_data_dir, batch, index, pool)
+            for row in df_connect_todo.itertuples()
+        )
+finally:
+    if pool is not None:
+        pool.close()
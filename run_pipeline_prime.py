@@ -4,269 +4,947 @@ New version of run pipeline. Changes:
 - Works with the unified csv. 
 - Can run over subsets of subjects indicated by a txt file
 - Can run parallel over subjects, limiting intra subject threading
+- Steps of all subjects are scheduled as a dependency graph, within a
+  budget of cpus and memory (lib/scheduler.py)
+- Each step saves a manifest of its inputs, version and parameters, and is
+  skipped if it has already been done with the same ones (lib/step_cache.py)
+- Only the raw files used by the selected steps are staged in the working
+  directory, linked or copied in parallel (lib/staging.py)
+- Heavy modules (nibabel, numpy, ...) are only imported by the steps that
+  use them, so starting a run is fast (see bench_imports.py)
+- The steps can run in threads (default), in a process each, or as job
+  arrays of a cluster (--executor, lib/executors.py). With processes and
+  batch, each step of a subject is run by this script with --job
+- The scripts run with time and memory limits, and each run is profiled in
+  the profile.jsonl of the subject (lib/supervisor.py)
+- The scanner parameters of DT_recon (readout time, dwell) come from the
+  index of the json sidecars (lib/metadata.py), not hardcoded in the script
+- With --matlab_workers, ps_LST_lga of LST runs in MATLAB sessions that are
+  kept open for all the subjects (lib/matlab_pool.py, threads executor)
 """
 
 import os
-import pandas as pd
-from contextlib import redirect_stdout, redirect_stderr
-import subprocess
-import shutil
+import sys
+import csv
+import types
 import argparse
-from lib.change_segmentation import new_segmentation
-from lib.make_stc import make_fsl, make_milan
-from lib.CreateTVB_lite import CreateTVB
-from lib.data_loading import load_data
-import datetime
-import numpy as np
-from joblib import Parallel, delayed
-
-
-def run_pipeline(
-    row, df_pip_status, out_dir, subj_list, base_data_dir, fs, lst, dt, tck, tvb
-):
+from lib.pipeline_state import open_state
+from lib.executors import EXECUTORS, BATCH_SYSTEMS, make_executor
+from lib.staging import Staging
+from lib.supervisor import supervise, parse_walltime, write_profile, profiled
+from lib.metadata import INDEX_NAME, scan_cohort, load_index, lookup
+from lib.matlab_pool import MatlabPool, matlab_command, FAKE_WORKER_COMMAND
+from lib.step_cache import (
+    build_manifest,
+    is_cached,
+    is_stale,
+    save_manifest,
+    invalidate,
+)
+
+
+# hardcoded because yes
+working_dir_raw = ""
+spm_folder = ""
+
+# files copied at the same time when staging the raw data of a subject
+STAGING_NJOBS = 4
+
+# resources used by each step: (cpus, memory in GB). The cpus are also the
+# number of threads that the scripts use (PIPELINE_NTHREADS)
+STEP_RESOURCES = {
+    "prepare": (1, 1),
+    "fs": (4, 8),
+    "lst": (1, 4),
+    # tckgen of DT_recon.sh used 6 threads before they came from here
+    "dt": (6, 8),
+    "tck": (6, 16),
+    "tvb": (1, 2),
+    "cleanup": (0, 0),
+}
+
+# time limit of each step (also when submitted to a cluster), the scripts
+# are killed if they run longer (lib/supervisor.py)
+STEP_WALLTIME = {
+    "fs": "04:00:00",
+    "lst": "02:00:00",
+    "dt": "12:00:00",
+    "tck": "12:00:00",
+    "tvb": "00:30:00",
+}
+
+# memory limit (GB, RSS of all the processes) of the scripts of each step,
+# they are killed if they use more. Higher than STEP_RESOURCES, which is
+# what they usually use
+STEP_MEM_LIMIT_GB = {
+    "fs": 24,
+    "lst": 12,
+    "dt": 32,
+    "tck": 48,
+}
+
+# steps that each step needs (for --executor processes and batch, where
+# each step is a separate job that prepares its own data)
+STEP_DEPS = {
+    "fs": [],
+    "lst": [],
+    "dt": ["fs", "lst"],
+    "tck": ["fs", "dt"],
+    "tvb": ["tck"],
+}
+
+# version of each step (part of the manifest). Increase it when a change of
+# the scripts that implement the step changes its results: the step is done
+# again for all the subjects. Not for changes that give the same results
+# (refactors, speed ups)
+STEP_VERSIONS = {
+    # scripts/FastSurfer.sh
+    "fs": 1,
+    # scripts/runLST.sh
+    "lst": 1,
+    # scripts/DT_recon.sh
+    "dt": 1,
+    # scripts/Tracking.sh, lib/change_segmentation.py, lib/connectome.py,
+    # lib/prune_tracks.py, lib/tck_io.py
+    "tck": 1,
+    # lib/CreateTVB_lite.py
+    "tvb": 1,
+}
+
+# scanner parameter of the DWI that DT_recon.sh uses for each center, and the
+# value that it had hardcoded before it was taken from the sidecar. It is a
+# parameter of the step only if it is another value (same results otherwise)
+DT_RECON_SCANNER = {
+    "MILAN": ("readout_time", 0.0828),
+    "CLINIC": ("echo_spacing", 0.000485),
+}
+
+# outputs of each step, relative to the directory of the subject.
+STEP_OUTPUTS = {
+    "fs": [
+        "recon_all/scripts/recon-all.done",
+        "recon_all/scripts/recon-surf.done",
+        "recon_all/mri/aparc.DKTatlas+aseg.mgz",
+        "recon_all/mri/aparc.DKTatlas+aseg.nii.gz",
+        "recon_all/mri/norm.mgz",
+        "recon_all/mri/T1.mgz",
+    ],
+    "lst": ["lst/{subID}_ROI.nii.gz"],
+    "dt": [
+        "dt_recon/lowb.nii.gz",
+        "dt_recon/register.dat",
+        "dt_recon/fa.nii.gz",
+        "dt_proc/wmfod.mif",
+        "dt_proc/5tt2diff.nii",
+        "dt_proc/dwi_ec_unbiased_mask.nii.gz",
+        "dt_proc/brain_track.tck",
+    ],
+    "tck": [
+        "recon_all/mri/aparc.DKTatlas+aseg_newSeg.nii.gz",
+        "dt_proc/connectome_weights.csv",
+        "dt_proc/connectome_lengths.csv",
+        "dt_proc/connectome_counts.csv",
+        "dt_proc/brain_track_AEC.tck",
+        "dt_proc/brain_track.txt",
+    ],
+    "tvb": ["results/connectivity.npz"],
+}
+
+# raw data used by each step (keys of load_data)
+STEP_RAW_INPUTS = {
+    "fs": ["T1w"],
+    "lst": ["T1w", "FLAIR"],
+    "dt": [
+        "DWI",
+        "DWI2",
+        "bval",
+        "bvec",
+        "Lesions",
+        "DWI_ph",
+        "DWI_mag",
+        "dwi_json",
+        "bval2",
+        "bvec2",
+    ],
+    "tck": [],
+    "tvb": [],
+}
+
+# outputs of previous steps used by each step
+STEP_DERIVED_INPUTS = {
+    "fs": [],
+    "lst": [],
+    "dt": [
+        "recon_all/mri/aparc.DKTatlas+aseg.mgz",
+        "recon_all/mri/aparc.DKTatlas+aseg.nii.gz",
+        "recon_all/mri/norm.mgz",
+    ],
+    "tck": [
+        "recon_all/mri/aparc.DKTatlas+aseg.nii.gz",
+        "recon_all/mri/T1.mgz",
+        "dt_recon/lowb.nii.gz",
+        "dt_recon/register.dat",
+        "dt_recon/fa.nii.gz",
+        "dt_proc/wmfod.mif",
+        "dt_proc/5tt2diff.nii",
+        "dt_proc/dwi_ec_unbiased_mask.nii.gz",
+    ],
+    "tvb": [
+        "dt_proc/connectome_weights.csv",
+        "dt_proc/connectome_lengths.csv",
+        "recon_all/mri/aparc.DKTatlas+aseg_newSeg.nii.gz",
+        "fmri_proc_dti/r_matrix.csv",
+        "fmri_proc_dti/zr_matrix.csv",
+        "fmri_proc_dti/corrlabel_ts.txt",
+    ],
+}
+
+# steps that create some of the inputs of each step: if they run, the step
+# has to run after them
+STEP_UPSTREAM = {
+    step: [
+        other
+        for other, outputs in STEP_OUTPUTS.items()
+        if set(outputs) & set(STEP_DERIVED_INPUTS[step])
+    ]
+    for step in STEP_OUTPUTS
+}
+
+### sub-MS0186 DOESNT WORK
+# (subject, center), None for any center
+SKIP_SUBJECTS = [
+    ("FIS_083", None),
+    ("FIS_121", None),
+    ("sub-MS0186", None),
+    ("sub-0010", "MAINZ"),
+    ("sub-0026", "MAINZ"),
+]
+
+
+def run_script(subject, command, output_file, step, extra_env=None):
+    """
+    Run one of the scripts of the pipeline, redirecting all the output to
+    output_file, with the number of threads assigned to the step (and the
+    variables of extra_env), and within its time and memory limits. The run is
+    added to the profile of the subject.
+    Returns the result of the run (see lib/supervisor.py)
+    """
+    env = dict(os.environ, PIPELINE_NTHREADS=str(max(STEP_RESOURCES[step][0], 1)))
+    env.update(extra_env or {})
+    result = supervise(
+        command,
+        output_file,
+        timeout=parse_walltime(STEP_WALLTIME[step]),
+        mem_gb=STEP_MEM_LIMIT_GB[step],
+        env=env,
+    )
+    record = dict(
+        subject=subject["subID"], center=subject["type_dir"], step=step, **result
+    )
+    try:
+        write_profile(subject["out_dir_subject"], record)
+    except OSError as e:
+        print(f"Could not write the profile of {subject['subID']}: {e}")
+    if result["status"] != "ok":
+        print(
+            f"{step} for {subject['subID']} ended with {result['status']} "
+            f"(exit code {result['exit_code']}), see {output_file}"
+        )
+    return result
+
+
+def finish_step(subject, step, manifest, result):
+    """
+    Save the manifest of a step after running its script. The step has failed
+    if the script was killed (time or memory limit) or if it has not created
+    all its outputs (the exit code of the scripts is the one of their last
+    command, so it is not enough)
+    """
+    if result["status"] in ("timeout", "memory"):
+        return False
+    if save_manifest(subject["out_dir_subject"], manifest):
+        return True
+    print(f"{step} for {subject['subID']} did not create all its outputs")
+    return False
+
+
+def step_params(subject, step):
+    """
+    Parameters of a step that change its results
+    """
+    params = {}
+    if step in ("lst", "dt"):
+        params["center"] = subject["type_dir"]
+    if step == "dt" and subject["dwi_meta"] is not None:
+        field, hardcoded = DT_RECON_SCANNER.get(subject["type_dir"], (None, None))
+        value = subject["dwi_meta"][field] if field else None
+        if value is not None and float(value) != hardcoded:
+            params[field] = float(value)
+    return params
+
+
+def step_manifest(subject, step):
     """
-    Function that implements the pipeline, so that
-    this thing can be parallelized.
+    Manifest of a step with the current inputs (see lib/step_cache.py)
+    """
+    subID, d, out_dir_subject = subject["subID"], subject["d"], subject["out_dir_subject"]
+    inputs = {key: d[key] for key in STEP_RAW_INPUTS[step]}
+    inputs.update(
+        {f: f"{out_dir_subject}/{f}" for f in STEP_DERIVED_INPUTS[step]}
+    )
+    outputs = [o.format(subID=subID) for o in STEP_OUTPUTS[step]]
+    return build_manifest(
+        out_dir_subject,
+        step,
+        inputs,
+        STEP_VERSIONS[step],
+        step_params(subject, step),
+        outputs,
+    )
+
 
-    Only apply to the steps that are not done.
+def plan_subject(row, state, out_dir, fs, lst, dt, tck, tvb, index=None):
     """
+    Decide which steps need to run for a subject.
 
+    Only apply to the steps that are not done. Returns None if there is
+    nothing to do. index: metadata of the sidecars (lib/metadata.py), for the
+    parameters of DT_recon
+    """
     # subject dir
     subID = row.SubjID
     type_dir = row.CENTER
 
-    # hardcoded because yes
-    working_dir_raw = ""
-
-    ### sub-MS0186 DOESNT WORK
-    if subID == "FIS_083":
-        return 0
-    if subID == "FIS_121":
-        return 0
-    if subID == "sub-MS0186":
-        return 0
-    if subID == "sub-0010" and type_dir == "MAINZ":
-        return 0
-    if subID == "sub-0026" and type_dir == "MAINZ":
-        return 0
-    if subID == "sub-0010" and type_dir == "MAINZ":
-        return 0
-
-    # information about pipeline steps
-    fastsurfer_status = df_pip_status[
-        (df_pip_status.id == subID) & (df_pip_status.CENTER == type_dir)
-    ]["fastsurfer"].bool()
-    dt_status = df_pip_status[
-        (df_pip_status.id == subID) & (df_pip_status.CENTER == type_dir)
-    ]["DWI_preproc"].bool()
-    sc_status = df_pip_status[
-        (df_pip_status.id == subID) & (df_pip_status.CENTER == type_dir)
-    ]["agg_SC"].bool()
-    tvb_status = df_pip_status[
-        (df_pip_status.id == subID) & (df_pip_status.CENTER == type_dir)
-    ]["toTVB"].bool()
-
-    # only do steps if are not done AND we have the flag to do that step
+    if (subID, None) in SKIP_SUBJECTS or (subID, type_dir) in SKIP_SUBJECTS:
+        return None
+
+    # information about pipeline steps (live, from the state store)
+    status = state.get(subID, type_dir)
+    fastsurfer_status = status["fastsurfer"]
+    dt_status = status["DWI_preproc"]
+    sc_status = status["agg_SC"]
+    tvb_status = status["toTVB"]
+
+    subject = {
+        "subID": subID,
+        "type_dir": type_dir,
+        "out_dir_subject": f"{out_dir}/{type_dir}_Post/{subID}",
+        "metadata_index": f"{out_dir}/{INDEX_NAME}",
+        "dwi_meta": None if index is None else lookup(index, type_dir, subID, "dwi"),
+        "steps": None,
+        "d": None,
+        "staging": None,
+        # local directory of the staged raw data, removed at the end
+        "stage_dir": f"{working_dir_raw}/{type_dir}_{subID}",
+    }
+
+    def stale(step):
+        # done, but with another version, parameters or outputs of the
+        # previous steps (ex: FastSurfer has been run again since)
+        return is_stale(
+            subject["out_dir_subject"],
+            step,
+            STEP_VERSIONS[step],
+            step_params(subject, step),
+            {f: f"{subject['out_dir_subject']}/{f}" for f in STEP_DERIVED_INPUTS[step]},
+        )
+
+    def upstream(step):
+        # a step that creates its inputs runs in this plan
+        return any(steps.get(other) for other in STEP_UPSTREAM[step])
+
+    # only do steps if are not done (or are outdated) AND we have the flag to
+    # do that step. Steps that are really done are skipped by their manifest.
     # we assume that all previous steps will run
-    do_fs = (not fastsurfer_status) and fs
-    do_dt = (not dt_status) and dt
-    do_tck = (not sc_status) and tck
-    do_tvb = (not tvb_status) and tvb and sc_status
-    do_lst = lst
+    steps = {}
+    steps["fs"] = fs and (not fastsurfer_status or stale("fs"))
+    steps["lst"] = lst
+    # the tracking needs the tractogram of DT_recon (subjects done before it
+    # was kept)
+    tck_needed = tck and (not sc_status or stale("tck") or upstream("tck"))
+    steps["dt"] = dt and (
+        not dt_status
+        or stale("dt")
+        or upstream("dt")
+        or (
+            tck_needed
+            and not os.path.isfile(
+                f"{subject['out_dir_subject']}/dt_proc/brain_track.tck"
+            )
+        )
+    )
+    steps["tck"] = tck_needed or (tck and steps["dt"])
+    steps["tvb"] = (
+        tvb
+        and (not tvb_status or stale("tvb") or upstream("tvb"))
+        and (sc_status or steps["tck"])
+    )
 
     # if no task is assigned for this subject, then don't do anything
-    if not (do_fs or do_dt or do_tck or do_tvb or do_lst):
-        return 0
+    if not any(steps.values()):
+        return None
+
+    subject["steps"] = steps
+    return subject
+
+
+def cached(subject, step, name):
+    """
+    Check if a step has already been done with the same inputs. If not,
+    remove its manifest (it will be saved again when the step finishes).
+    Returns the manifest, or None if the step can be skipped.
+    """
+    manifest = step_manifest(subject, step)
+    if is_cached(subject["out_dir_subject"], manifest):
+        print(f"{name} for {subject['subID']} already done, skipping")
+        return None
+    invalidate(subject["out_dir_subject"], step)
+    return manifest
+
 
-    # make directory
-    out_dir_subject = f"{out_dir}/{type_dir}_Post/{subID}"
+def step_prepare(subject, base_data_dir):
+    """
+    Stage the raw data used by the selected steps in local, and load it
+    """
+    subID = subject["subID"]
+    type_dir = subject["type_dir"]
+    source_dir = f"{base_data_dir}/{type_dir}/{subID}"
 
-    # copy the raw data to local
-    os.system(f"cp -R {base_data_dir}/{type_dir}/{subID} {working_dir_raw}/")
+    from lib.data_loading import load_data
 
     # load the data
     # here we need to do a try because if it fails (and we assume that the function works well)
     # it means that some of the data is missing and it is not worth it to process it
     try:
-        d = load_data(f"{working_dir_raw}/{subID}", subID, type_dir)
+        d = load_data(source_dir, subID, type_dir)
     except:
         print(f"Problem loading data for subject {subID} from {type_dir}")
-        return -1
+        return False
+
+    # stage only the files that the steps read (nothing for tck and tvb)
+    keys = [
+        key
+        for step, selected in subject["steps"].items()
+        if selected
+        for key in STEP_RAW_INPUTS[step]
+    ]
+    subject["staging"] = Staging(source_dir, subject["stage_dir"], STAGING_NJOBS)
+    try:
+        subject["d"] = subject["staging"].stage(d, keys)
+    except OSError as e:
+        print(f"Problem staging data for subject {subID} from {type_dir}: {e}")
+        return False
+
     # create directory if doesnt exist
-    if not os.path.exists(out_dir_subject):
-        os.makedirs(out_dir_subject)
+    if not os.path.exists(subject["out_dir_subject"]):
+        os.makedirs(subject["out_dir_subject"])
+
 
-    if do_fs:
-        output_file = out_dir_subject + "/log_fs.txt"
+def step_fs(subject, state):
+    subID, d, out_dir_subject = subject["subID"], subject["d"], subject["out_dir_subject"]
+    manifest = cached(subject, "fs", "FastSurfer")
+    if manifest is not None:
         print(f"Running FastSurfer for {subID}...")
-        with open(output_file, "w") as f:
-            cmd = subprocess.Popen(
-                f'exec scripts/FastSurfer.sh {subID} {d["T1w"]} {out_dir_subject}',
-                shell=True,
-                stdout=f,
-                stderr=f,
-            )
-            cmd.wait()
+        result = run_script(
+            subject,
+            f'scripts/FastSurfer.sh {subID} {d["T1w"]} {out_dir_subject}',
+            out_dir_subject + "/log_fs.txt",
+            "fs",
+        )
+        if not finish_step(subject, "fs", manifest, result):
+            return False
+    # next steps need the segmentation
+    return state.refresh(subID, subject["type_dir"], out_dir_subject, ["fastsurfer"])[
+        "fastsurfer"
+    ]
+
+
+def lst_in_pool(subject, pool):
+    """
+    LST with ps_LST_lga in the MATLAB pool: runLST.sh prepare, the MATLAB
+    job, and runLST.sh finalize. Returns the result of the first part that
+    failed, or of the last one
+    """
+    subID, d, out_dir_subject = subject["subID"], subject["d"], subject["out_dir_subject"]
+    type_dir = subject["type_dir"]
+    command = f'scripts/runLST.sh {subID} {d["T1w"]} {d["FLAIR"]} {out_dir_subject} {type_dir}'
+    result = run_script(subject, f"{command} prepare", out_dir_subject + "/log_lst.txt", "lst")
+    if result["status"] != "ok":
+        return result
+
+    # same inputs as runLST.sh
+    t1_path = f"{out_dir_subject}/lst/T1{'_pos' if type_dir == 'AMSTERDAM' else ''}.nii.gz"
+    flair_path = f"{out_dir_subject}/lst/FLAIR.nii.gz"
+    result = pool.run(
+        f"ps_LST_lga('{t1_path}','{flair_path}',0.3,1,50);",
+        cd=out_dir_subject,
+        timeout=parse_walltime(STEP_WALLTIME["lst"]),
+        log_file=out_dir_subject + "/log_lst_matlab.txt",
+    )
+    try:
+        write_profile(
+            out_dir_subject,
+            dict(subject=subID, center=type_dir, step="lst_matlab", **result),
+        )
+    except OSError as e:
+        print(f"Could not write the profile of {subID}: {e}")
+    if result["status"] != "ok":
+        return result
+
+    return run_script(subject, f"{command} finalize", out_dir_subject + "/log_lst_finalize.txt", "lst")
+
 
+def step_lst(subject, pool=None):
+    subID, d, out_dir_subject = subject["subID"], subject["d"], subject["out_dir_subject"]
     # check if flair exists, if it doesnt, just don't do it
-    if do_lst and os.path.isfile(d["FLAIR"]):
-        ### HACK remove directory if exists
-        if os.path.exists(f"{out_dir_subject}/lst"):
-            os.system(f"rm -rf {out_dir_subject}/lst/")
-
-        output_file = out_dir_subject + "/log_lst.txt"
-        print(f"Running LST for {subID}...")
-        with open(output_file, "w") as f:
-            cmd = subprocess.Popen(
-                f'exec scripts/runLST.sh {subID} {d["T1w"]} {d["FLAIR"]} {out_dir_subject} {type_dir}',
-                shell=True,
-                stdout=f,
-                stderr=f,
-            )
-            cmd.wait()
+    if not os.path.isfile(d["FLAIR"]):
+        return
+
+    manifest = cached(subject, "lst", "LST")
+    if manifest is None:
+        return
+
+    ### HACK remove directory if exists
+    if os.path.exists(f"{out_dir_subject}/lst"):
+        os.system(f"rm -rf {out_dir_subject}/lst/")
+
+    print(f"Running LST for {subID}...")
+    if pool is not None:
+        result = lst_in_pool(subject, pool)
+    else:
+        result = run_script(
+            subject,
+            f'scripts/runLST.sh {subID} {d["T1w"]} {d["FLAIR"]} {out_dir_subject} {subject["type_dir"]}',
+            out_dir_subject + "/log_lst.txt",
+            "lst",
+        )
+    # DT_recon uses the lesions of the raw data, it can run even if LST fails
+    finish_step(subject, "lst", manifest, result)
+
+
+def step_dt(subject, state):
+    subID, d, out_dir_subject = subject["subID"], subject["d"], subject["out_dir_subject"]
+    type_dir = subject["type_dir"]
+
+    # scanner parameters of the DWI, from its sidecar (the defaults of the
+    # center for the ones that it does not have)
+    meta = lookup(load_index(subject["metadata_index"]), type_dir, subID, "dwi", d["dwi_json"])
+    scanner_env = {
+        var: str(meta[field])
+        for var, field in [("DWI_READOUT_TIME", "readout_time"), ("DWI_ECHO_SPACING", "echo_spacing")]
+        if meta[field] is not None
+    }
+    # the parameters of the manifest, with the sidecar as it is now
+    subject["dwi_meta"] = meta
+
+    # only remove the outputs (hours of eddy and tckgen) if they are outdated
+    manifest = cached(subject, "dt", "DT_recon")
+    if manifest is None:
+        state.refresh(subID, type_dir, out_dir_subject, ["DWI_preproc"])
+        return
+
+    os.system(f"rm -rf {out_dir_subject}/dt_recon")
+    os.system(f"rm -rf {out_dir_subject}/dt_proc")
+    os.system(f"rm -rf {out_dir_subject}/dt_recon_lowshell")
 
-    if do_dt:
-        os.system(f"rm -rf {out_dir_subject}/dt_recon")
-        os.system(f"rm -rf {out_dir_subject}/dt_proc")
-        os.system(f"rm -rf {out_dir_subject}/dt_recon_lowshell")
+    # create directory if doesnt exist
+    if not os.path.exists(f"{out_dir_subject}/dt_recon"):
+        os.makedirs(f"{out_dir_subject}/dt_recon")
 
-        # create directory if doesnt exist
-        if not os.path.exists(f"{out_dir_subject}/dt_recon"):
-            os.makedirs(f"{out_dir_subject}/dt_recon")
+    # create directory if doesnt exist
+    if not os.path.exists(f"{out_dir_subject}/dt_proc"):
+        os.makedirs(f"{out_dir_subject}/dt_proc")
+
+    print(f"Running DT_recon for {subID}...")
+    # redirect all output to file
+    result = run_script(
+        subject,
+        f'scripts/DT_recon.sh {subID} {out_dir_subject} {d["DWI"]} {d["DWI2"]} {d["bval"]} {d["bvec"]} {d["Lesions"]}\
+                                      {type_dir} {d["DWI_ph"]} {d["DWI_mag"]} {d["dwi_json"]} {d["bval2"]} {d["bvec2"]}',
+        out_dir_subject + "/log_dt.txt",
+        "dt",
+        scanner_env,
+    )
+    done = finish_step(subject, "dt", manifest, result)
+    state.refresh(subID, type_dir, out_dir_subject, ["DWI_preproc"])
+    if not done:
+        return False
 
-        # create directory if doesnt exist
-        if not os.path.exists(f"{out_dir_subject}/dt_proc"):
-            os.makedirs(f"{out_dir_subject}/dt_proc")
 
-        output_file = out_dir_subject + "/log_dt.txt"
-        print(f"Running DT_recon for {subID}...")
-        # redirect all output to file
+def step_tck(subject, state):
+    subID, out_dir_subject = subject["subID"], subject["out_dir_subject"]
+    manifest = cached(subject, "tck", "Tracking")
+    if manifest is None:
+        return state.refresh(
+            subID, subject["type_dir"], out_dir_subject, ["DWI_preproc", "agg_SC"]
+        )["agg_SC"]
 
-        with open(output_file, "w") as f:
-            cmd = subprocess.Popen(
-                f'exec scripts/DT_recon.sh {subID} {out_dir_subject} {d["DWI"]} {d["DWI2"]} {d["bval"]} {d["bvec"]} {d["Lesions"]}\
-                                      {type_dir} {d["DWI_ph"]} {d["DWI_mag"]} {d["dwi_json"]} {d["bval2"]} {d["bvec2"]}',
-                shell=True,
-                stdout=f,
-                stderr=f,
-            )
-            cmd.wait()
+    print(f"Running Tracking for {subID}...")
 
-    if do_tck:
-        output_file = out_dir_subject + "/log_track.txt"
-        print(f"Running Tracking for {subID}...")
+    # first, create new segmentation
+    seg_file = f"{out_dir_subject}/recon_all/mri/aparc.DKTatlas+aseg.nii.gz"
 
-        # first, create new segmentation
-        seg_file = f"{out_dir_subject}/recon_all/mri/aparc.DKTatlas+aseg.nii.gz"
+    # RUN the python function in LIB
+    try:
+        from lib.change_segmentation import new_segmentation
 
-        # RUN the python function in LIB
-        try:
+        with profiled(out_dir_subject, subject=subID, center=subject["type_dir"], step="newseg"):
             new_segmentation(seg_file)
-        except:
-            print(f"new segmentation for {subID} failed!")
-            return 0
-        # redirect all output to file
-        with open(output_file, "w") as f:
-            cmd = subprocess.Popen(
-                f"exec scripts/Tracking.sh {subID} {out_dir_subject}",
-                shell=True,
-                stdout=f,
-                stderr=f,
-            )
-            cmd.wait()
+    except:
+        print(f"new segmentation for {subID} failed!")
+        return False
+    # redirect all output to file
+    result = run_script(
+        subject,
+        f"scripts/Tracking.sh {subID} {out_dir_subject}",
+        out_dir_subject + "/log_track.txt",
+        "tck",
+    )
+    if not finish_step(subject, "tck", manifest, result):
+        state.refresh(subID, subject["type_dir"], out_dir_subject, ["DWI_preproc", "agg_SC"])
+        return False
+    # TVB only if the SC has been created
+    return state.refresh(
+        subID, subject["type_dir"], out_dir_subject, ["DWI_preproc", "agg_SC"]
+    )["agg_SC"]
 
-    if do_tvb:
-        print(f"Running TVB for {subID}...")
 
-        # create directory if doesnt exist
-        if not os.path.exists(f"{out_dir_subject}/results/results"):
-            os.makedirs(f"{out_dir_subject}/results/results")
+def step_tvb(subject, state):
+    subID, out_dir_subject = subject["subID"], subject["out_dir_subject"]
+    manifest = cached(subject, "tvb", "TVB")
+    if manifest is None:
+        state.refresh(subID, subject["type_dir"], out_dir_subject, ["toTVB"])
+        return
+
+    print(f"Running TVB for {subID}...")
+
+    # create directory if doesnt exist
+    if not os.path.exists(f"{out_dir_subject}/results/results"):
+        os.makedirs(f"{out_dir_subject}/results/results")
 
-        output_file = out_dir_subject + "/log_tvb.txt"
+    try:
+        from lib.CreateTVB_lite import CreateTVB
 
-        try:
+        with profiled(out_dir_subject, subject=subID, center=subject["type_dir"], step="tvb"):
             CreateTVB(subID, out_dir_subject, f"{out_dir_subject}/results/")
-        except:
-            print(f"CreateTVB for {subID} failed!")
-            return 0
-
-    # remove the temporal values
-    shutil.rmtree(f"{working_dir_raw}/{subID}")
-    print(f"Finished {subID}!")
-    return 0
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--in_dir",
-    type=str,
-    required=True,
-    help="input dir with subject data, general input dir (MAGNIMS2021",
-)
-parser.add_argument(
-    "--in_csv", type=str, required=True, help="csv with the subject info (general csv)"
-)
-parser.add_argument(
-    "--in_pip",
-    type=str,
-    required=True,
-    help="csv with the information of the current state of the pipeline",
-)
-parser.add_argument(
-    "--out_dir",
-    type=str,
-    required=True,
-    help="A string argument (also general directory)",
-)
-parser.add_argument("--njobs", type=int, default=1, help="Number of jobs to use")
-parser.add_argument(
-    "--subj_list", type=str, help="A text file with a list of subjects, one per line"
-)
-parser.add_argument("-fs", action="store_true")
-parser.add_argument("-lst", action="store_true")
-parser.add_argument("-dt", action="store_true")
-parser.add_argument("-tck", action="store_true")
-parser.add_argument("-tvb", action="store_true")
-
-# Parse and print the results
-args = parser.parse_args()
-
-# select type of data loading
-base_data_dir = args.in_dir
-out_dir = args.out_dir
-
-# read the csv
-# esta a base dir, copiar
-df_connect = pd.read_csv(args.in_csv)
-currentDirectory = os.getcwd()
-
-# read the completion csv
-df_pip_status = pd.read_csv(args.in_pip)
-
-df_connect_todo = pd.DataFrame(columns=df_connect.columns, dtype=object)
-
-if args.subj_list:
-    subj_list = np.genfromtxt(args.subj_list, delimiter=",", dtype="str")
-    for s in subj_list:
-        # s[0] should be the id, s[1] should be the center
-        df_connect_todo = df_connect_todo.append(
-            df_connect[(df_connect.SubjID == s[0]) & (df_connect.CENTER == s[1])]
-        )  # will select subjects taht we don't have to process
-else:
-    subj_list = []
-    df_connect_todo = df_connect
-
-
-fs = args.fs
-lst = args.lst
-dt = args.dt
-tck = args.tck
-tvb = args.tvb
-
-###############
-outputs = Parallel(n_jobs=args.njobs, backend="threading")(
-    delayed(run_pipeline)(
-        row, df_pip_status, out_dir, subj_list, base_data_dir, fs, lst, dt, tck, tvb
+    except:
+        print(f"CreateTVB for {subID} failed!")
+        return False
+    save_manifest(out_dir_subject, manifest)
+    state.refresh(subID, subject["type_dir"], out_dir_subject, ["toTVB"])
+
+
+def step_cleanup(subject):
+    # remove the staged data
+    if subject["staging"] is not None:
+        subject["staging"].cleanup()
+    print(f"Finished {subject['subID']}!")
+
+
+def add_subject_tasks(scheduler, subject, state, base_data_dir, pool=None, after=None):
+    """
+    Add the steps of a subject to the graph:
+
+    prepare -> FastSurfer -> DT_recon -> Tracking -> CreateTVB
+            -> LST ---------^
+    and cleanup when everything has finished (even if something failed).
+    after: task (cleanup of another subject) that needs to finish before the
+    prepare of this one, so the data staged at the same time is limited.
+    Returns the cleanup task
+    """
+    name = f"{subject['type_dir']}/{subject['subID']}"
+    steps = subject["steps"]
+
+    def add(step, func, args, deps, always=False):
+        cpus, mem_gb = STEP_RESOURCES[step]
+        return scheduler.add(f"{name}/{step}", func, args, deps, cpus, mem_gb, always)
+
+    # always: also after a failed subject
+    prepare = add("prepare", step_prepare, (subject, base_data_dir), [after], always=True)
+    fs = add("fs", step_fs, (subject, state), [prepare]) if steps["fs"] else None
+    lst = add("lst", step_lst, (subject, pool), [prepare]) if steps["lst"] else None
+    dt = add("dt", step_dt, (subject, state), [prepare, fs, lst]) if steps["dt"] else None
+    tck = add("tck", step_tck, (subject, state), [prepare, fs, dt]) if steps["tck"] else None
+    tvb = add("tvb", step_tvb, (subject, state), [prepare, tck]) if steps["tvb"] else None
+    return add("cleanup", step_cleanup, (subject,), [prepare, fs, lst, dt, tck, tvb], always=True)
+
+
+def stages_raw_data(subject):
+    """
+    Check if the selected steps of a subject read raw data (staged by prepare)
+    """
+    return any(STEP_RAW_INPUTS[step] for step, selected in subject["steps"].items() if selected)
+
+
+def add_subject_jobs(executor, subject, args, state, batch_dir):
+    """
+    Add the steps of a subject to the graph of an executor of commands
+    (processes or batch): each step is a job (this script with --job)
+    """
+    name = f"{subject['type_dir']}/{subject['subID']}"
+    flags = [f"-{step}" for step in ["fs", "lst", "dt", "tck", "tvb"] if getattr(args, step)]
+    jobs = {}
+    for step in ["fs", "lst", "dt", "tck", "tvb"]:
+        if not subject["steps"][step]:
+            continue
+        cpus, mem_gb = STEP_RESOURCES[step]
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--in_dir", args.in_dir,
+            "--in_csv", args.in_csv,
+            "--in_pip", state.db_file,
+            "--out_dir", args.out_dir,
+            "--executor", args.executor,
+            "--job", f"{step}:{subject['type_dir']}:{subject['subID']}",
+        ] + flags
+        jobs[step] = executor.add_command(
+            f"{name}/{step}",
+            command,
+            log_file=f"{batch_dir}/logs/{subject['type_dir']}_{subject['subID']}_{step}.log",
+            deps=[jobs.get(d) for d in STEP_DEPS[step]],
+            cpus=cpus,
+            mem_gb=mem_gb,
+            step=step,
+            key=(subject["type_dir"], subject["subID"]),
+            walltime=STEP_WALLTIME[step],
+        )
+
+
+def run_job(args, state):
+    """
+    Run a single step of a subject (--job step:center:subID), staging only
+    the data of that step. Returns the exit code
+    """
+    step, type_dir, subID = args.job.split(":", 2)
+    row = types.SimpleNamespace(SubjID=subID, CENTER=type_dir)
+    subject = plan_subject(
+        row,
+        state,
+        args.out_dir,
+        args.fs,
+        args.lst,
+        args.dt,
+        args.tck,
+        args.tvb,
+        load_index(f"{args.out_dir}/{INDEX_NAME}"),
     )
-    for row in df_connect_todo.itertuples()
-)
+    # done since the job was planned
+    if subject is None or not subject["steps"][step]:
+        print(f"{step} for {subID} has nothing to do")
+        return 0
+    subject["steps"] = {s: s == step for s in subject["steps"]}
+    # steps of the same subject can run at the same time (ex: fs and lst),
+    # each one stages (and removes) its own copy of the data
+    subject["stage_dir"] = f"{subject['stage_dir']}_{step}"
+
+    if step_prepare(subject, args.in_dir) is False:
+        return 1
+    try:
+        if step == "lst":
+            result = step_lst(subject)
+        else:
+            funcs = {"fs": step_fs, "dt": step_dt, "tck": step_tck, "tvb": step_tvb}
+            result = funcs[step](subject, state)
+    except Exception as e:
+        print(f"{step} for {subID} failed: {e!r}")
+        result = False
+    finally:
+        step_cleanup(subject)
+    return 1 if result is False else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--in_dir",
+        type=str,
+        required=True,
+        help="input dir with subject data, general input dir (MAGNIMS2021",
+    )
+    parser.add_argument(
+        "--in_csv", type=str, required=True, help="csv with the subject info (general csv)"
+    )
+    parser.add_argument(
+        "--in_pip",
+        type=str,
+        required=True,
+        help="state of the pipeline: pipeline.db, or a pipeline.csv (pipeline.db is created next to it)",
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        required=True,
+        help="A string argument (also general directory)",
+    )
+    parser.add_argument(
+        "--njobs",
+        type=int,
+        default=None,
+        help="Maximum number of steps running at the same time (by default, only limited by --ncpus and --mem_gb)",
+    )
+    parser.add_argument(
+        "--max_staged",
+        type=int,
+        default=None,
+        help="Maximum number of subjects with their raw data staged at the same time, with --executor threads "
+        "(by default --njobs, or the FastSurfer that fit in --ncpus)",
+    )
+    parser.add_argument(
+        "--ncpus", type=int, default=os.cpu_count(), help="Number of cpus that all the steps can use"
+    )
+    parser.add_argument(
+        "--mem_gb",
+        type=float,
+        default=os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3,
+        help="Memory (GB) that all the steps can use",
+    )
+    parser.add_argument(
+        "--subj_list", type=str, help="A text file with a list of subjects, one per line"
+    )
+    parser.add_argument("-fs", action="store_true")
+    parser.add_argument("-lst", action="store_true")
+    parser.add_argument("-dt", action="store_true")
+    parser.add_argument("-tck", action="store_true")
+    parser.add_argument("-tvb", action="store_true")
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default="threads",
+        help="run the steps in threads, in a process each, or as job arrays of a cluster",
+    )
+    parser.add_argument(
+        "--batch_system", choices=list(BATCH_SYSTEMS), default="slurm", help="cluster of --executor batch (fake runs the arrays locally)"
+    )
+    parser.add_argument(
+        "--batch_dir", type=str, help="directory of the job scripts and logs, shared with the nodes (by default, out_dir/batch)"
+    )
+    parser.add_argument(
+        "--poll_interval", type=float, default=60, help="seconds between checks of the jobs in the cluster"
+    )
+    parser.add_argument(
+        "--matlab_workers",
+        type=int,
+        default=0,
+        help="MATLAB sessions kept open to run LST, instead of one per subject (only with --executor threads)",
+    )
+    parser.add_argument(
+        "--matlab_max_jobs", type=int, default=20, help="jobs before a MATLAB session is restarted"
+    )
+    parser.add_argument(
+        "--matlab_worker",
+        choices=["matlab", "fake"],
+        default="matlab",
+        help="fake runs the jobs in a stand-in worker without MATLAB, for testing",
+    )
+    parser.add_argument("--job", type=str, help=argparse.SUPPRESS)
+
+    # Parse and print the results
+    args = parser.parse_args()
+
+    # select type of data loading
+    base_data_dir = args.in_dir
+    out_dir = args.out_dir
+
+    # open the state of the pipeline, shared with check_all_pips.py (and the
+    # nodes of the cluster, where WAL does not work)
+    state = open_state(args.in_pip, wal=args.executor != "batch")
+    if args.job:
+        sys.exit(run_job(args, state))
+
+    # read the csv (with csv, pandas is slow to import and not needed here)
+    # esta a base dir, copiar
+    with open(args.in_csv, newline="") as f:
+        rows = [types.SimpleNamespace(**r) for r in csv.DictReader(f)]
+
+    if args.subj_list:
+        with open(args.subj_list, newline="") as f:
+            subj_list = [s for s in csv.reader(f) if s]
+        rows_todo = []
+        for s in subj_list:
+            # s[0] should be the id, s[1] should be the center
+            rows_todo += [
+                r for r in rows if r.SubjID == s[0].strip() and r.CENTER == s[1].strip()
+            ]  # will select subjects taht we don't have to process
+    else:
+        rows_todo = rows
+
+    fs = args.fs
+    lst = args.lst
+    dt = args.dt
+    tck = args.tck
+    tvb = args.tvb
+
+    ###############
+    # all the steps of all the subjects in a single graph
+    batch_dir = args.batch_dir or f"{out_dir}/batch"
+    scheduler = make_executor(
+        args.executor,
+        args.ncpus,
+        args.mem_gb,
+        args.njobs,
+        state,
+        args.batch_system,
+        batch_dir,
+        args.poll_interval,
+    )
+    # the MATLAB sessions are shared by the threads of this process
+    pool = None
+    if args.matlab_workers > 0 and lst:
+        if args.executor == "threads":
+            pool = MatlabPool(
+                args.matlab_workers,
+                FAKE_WORKER_COMMAND if args.matlab_worker == "fake" else matlab_command(spm_folder=spm_folder),
+                max_jobs=args.matlab_max_jobs,
+                mem_gb=STEP_MEM_LIMIT_GB["lst"],
+                log_dir=f"{out_dir}/matlab_pool",
+            )
+        else:
+            print("--matlab_workers only works with --executor threads, ignoring it")
+
+    # parse the sidecars of DT_recon once, in parallel (only the new or
+    # changed ones): the plan and the steps read them from the index
+    index = None
+    if dt:
+        index = scan_cohort(
+            base_data_dir,
+            [(row.CENTER, row.SubjID) for row in rows_todo],
+            f"{out_dir}/{INDEX_NAME}",
+            {"dwi": "dwi_json"},
+        )
+
+    # the prepare of a subject waits for the cleanup of the subject staged
+    # max_staged subjects before, so the raw data of the whole cohort is not
+    # staged at the start (prepare is cheap and always fits in the budget)
+    max_staged = args.max_staged or args.njobs or max(args.ncpus // STEP_RESOURCES["fs"][0], 1)
+    staged = []
+
+    subjects = []
+    for row in rows_todo:
+        subject = plan_subject(row, state, out_dir, fs, lst, dt, tck, tvb, index)
+        if subject is not None:
+            if args.executor == "threads":
+                after = None
+                if stages_raw_data(subject) and len(staged) >= max_staged:
+                    after = staged[-max_staged]
+                cleanup = add_subject_tasks(scheduler, subject, state, base_data_dir, pool, after)
+                if stages_raw_data(subject):
+                    staged.append(cleanup)
+            else:
+                add_subject_jobs(scheduler, subject, args, state, batch_dir)
+            subjects.append(subject)
+
+    try:
+        scheduler.run()
+    finally:
+        # staged data is removed also if the run is interrupted
+        for subject in subjects:
+            if subject["staging"] is not None:
+                subject["staging"].cleanup()
+        if pool is not None:
+            pool.close()
+    print(scheduler.summary())
+
+
+if __name__ == "__main__":
+    main()
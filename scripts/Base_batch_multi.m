@@ -0,0 +1,97 @@
+function Base_batch_multi(SUBJECTS_FILE, base_dir, TR, sliceorder, scans_to_remove, nparallel)
+%%% COPY TO THE CONN BASE DIRECTORY TO WORK
+% Same as Base_batch, but for several subjects with the same TR in a single
+% CONN project (one MATLAB session for all of them).
+% SUBJECTS_FILE has a line per subject: the fmri scan and the subject
+% directory (with recon_all), separated by a tab. The results of the subject
+% of line i are ROI_Subject00i_...
+% nparallel: jobs of the CONN parallelization (0, run in this session)
+
+%% subjects
+fid = fopen(SUBJECTS_FILE);
+subjects = textscan(fid, '%s %s', 'Delimiter', '\t');
+fclose(fid);
+FUNCTIONAL_FILES = subjects{1};
+FS_DIRS = subjects{2};
+nsubjects = numel(FUNCTIONAL_FILES);
+
+%% CONN New experiment
+% assume it doesnt exist
+batch.filename=fullfile(base_dir,'conn_FC.mat');
+
+%% CONN Setup
+batch.Setup.nsubjects=nsubjects;
+for nsub=1:nsubjects
+    batch.Setup.functionals{nsub}{1}=FUNCTIONAL_FILES{nsub};
+    batch.Setup.structurals{nsub}=fullfile(FS_DIRS{nsub}, 'recon_all', 'mri', 'T1.mgz');
+    batch.Setup.conditions.onsets{1}{nsub}{1}=0;
+    batch.Setup.conditions.durations{1}{nsub}{1}=inf;
+end
+batch.Setup.RT=TR;
+batch.Setup.conditions.names={'rest'};
+batch.Setup.isnew=1;
+
+batch.Setup.done=0;
+
+% do this to import the aseg things (of all the subjects)
+conn_batch(batch);
+conn_importaseg;
+
+batch.Setup.done=1;
+batch.Setup.overwrite='Yes';
+
+%% Load freesurfer ROI and WM, csf, GM (of each subject)
+batch.Setup.rois.names = {'Grey Matter', 'White Matter', 'CSF', 'fs'};
+roi_files = {'c1_aseg.img', 'c2_aseg.img', 'c3_aseg.img', 'aparc.DKTatlas+aseg_newSeg.nii.gz'};
+for nroi=1:numel(roi_files)
+    for nsub=1:nsubjects
+        batch.Setup.rois.files{nroi}{nsub}{1} = fullfile(FS_DIRS{nsub}, 'recon_all', 'mri', roi_files{nroi});
+    end
+end
+
+batch.Setup.rois.multiplelabels = [0,0,0,1];
+batch.Setup.rois.regresscovariates = [0,1,1,0];
+batch.Setup.rois.unsmoothedvolumes = [1,1,1,1];
+
+%% Preprocessing steps
+% remove slicetime for the ones that we dont have it
+%
+batch.Setup.preprocessing.steps={'functional_label_as_original', 'functional_removescans', 'functional_realign&unwarp',... % 'functional_slicetime'...
+                                 'functional_art', 'functional_coregister_affine_reslice', 'functional_label_as_subjectspace', 'functional_smooth'...
+                             	 'functional_label_as_smoothed'};
+batch.Setup.preprocessing.sliceorder=sliceorder;
+batch.Setup.preprocessing.removescans=scans_to_remove;
+
+%% CONN Denoising
+batch.Denoising.filter=[0.001, 0.08];          % frequency filter (band-pass values, in Hz)
+batch.Denoising.done=1;
+batch.Denoising.overwrite='Yes';
+batch.Denoising.despiking=0;
+batch.Denoising.detrending=1;
+% Confound should be automatic
+
+%% CONN Analysis
+batch.Analysis.name='FC1';
+batch.Analysis.type=1;
+batch.Analysis.analysis_number=1;       % Sequential number identifying each set of independent first-level analyses
+batch.Analysis.measure=1;               % connectivity measure used {1 = 'correlation (bivariate)', 2 = 'correlation (semipartial)', 3 = 'regression (bivariate)', 4 = 'regression (multivariate)';
+batch.Analysis.weight=1;                % within-condition weight used {1 = 'none', 2 = 'hrf', 3 = 'hanning';
+batch.Analysis.sources={};              % (defaults to all ROIs)
+batch.Analysis.done=1;
+batch.Analysis.overwrite=1;
+
+%% QA
+batch.QA.plots = {'QA_REG functional','QA_REG structural','QA_REG functional','QA_DENOISE histogram','QA_DENOISE timeseries','QA_DENOISE FC-QC'};
+batch.QA.rois=4;
+batch.QA.sets=0;
+
+%% Parallelization: the subjects are split in nparallel jobs in this machine
+if nparallel > 1
+    batch.parallel.N=min(nparallel, nsubjects);
+    batch.parallel.profile='Background process';
+end
+
+%% RUN
+conn_batch(batch);
+
+end
@@ -50,6 +50,14 @@ json=${11}
 bval2=${12}
 bvec2=${13}
 
+# threads for each command, given by run_pipeline_prime.py (lib/scheduler.py)
+nthreads=${PIPELINE_NTHREADS:-4}
+
+# scanner parameters (s), from the json sidecar of the DWI, given by
+# run_pipeline_prime.py (lib/metadata.py). By default, the ones of MILAN and CLINIC
+readout_time=${DWI_READOUT_TIME:-0.0828}
+echo_spacing=${DWI_ECHO_SPACING:-0.000485}
+
 #SIEMENS DEFAULT
 # these are parameters that depend on the scanner
 # BOTH IN MS
@@ -76,10 +84,10 @@ mrconvert ${out_dir}/dwi_b0.mif ${out_dir}/dwi_b0.nii.gz
 mrconvert -force $dwi ${out_dir}/dwi.mif
 
 ## DENOISING
-dwidenoise ${out_dir}/dwi.mif ${out_dir}/dwi_den.mif -noise ${out_dir}/noise.mif -force -nthreads 4
+dwidenoise ${out_dir}/dwi.mif ${out_dir}/dwi_den.mif -noise ${out_dir}/noise.mif -force -nthreads ${nthreads}
 
 ## GIBBS RINGING REMOVAL
-mrdegibbs ${out_dir}/dwi_den.mif ${out_dir}/dwi_den_unr.mif -axes 0,1 -nthreads 4
+mrdegibbs ${out_dir}/dwi_den.mif ${out_dir}/dwi_den_unr.mif -axes 0,1 -nthreads ${nthreads}
 
 # use dti_preproc script 
 mrconvert -force ${out_dir}/dwi_den_unr.mif ${out_dir}/dwi_den_unr.nii.gz
@@ -87,7 +95,7 @@ mrconvert -force ${out_dir}/dwi_den_unr.mif ${out_dir}/dwi_den_unr.nii.gz
 if [ "$type_data" = "CLINIC" ]; then
 
     dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
-    -rpe_none -pe_dir j- -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -nthreads 4 -force #  ## -pe_dir ap # 
+    -rpe_none -pe_dir j- -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -nthreads ${nthreads} -force #  ## -pe_dir ap # 
 
     #### FUGUE
     bet $fm_magnitude ${out_dir}/fm_mag_ero.nii.gz -m -f 0.55
@@ -100,12 +108,12 @@ if [ "$type_data" = "CLINIC" ]; then
     fugue --loadfmap=${out_dir}/fieldmap_brain.nii.gz -s 4 --savefmap=${out_dir}/fieldmap_brain_s4.nii.gz
 
     # fugue --loadfmap=FieldMap/FieldMap_brain -s 4 --savefmap=FieldMap/FieldMap_brain_s4
-    fugue -v -i ${out_dir}/fm_mag_ero.nii.gz --unwarpdir=y- --dwell=0.000485 --nokspace --loadfmap=${out_dir}/fieldmap.nii -w ${out_dir}/fm_mag_ero_warped.nii.gz
+    fugue -v -i ${out_dir}/fm_mag_ero.nii.gz --unwarpdir=y- --dwell=${echo_spacing} --nokspace --loadfmap=${out_dir}/fieldmap.nii -w ${out_dir}/fm_mag_ero_warped.nii.gz
     flirt -in ${out_dir}/fm_mag_ero_warped.nii.gz -ref ${out_dir}/dwi_den_unr_ec.nii.gz -out ${out_dir}/fm_mag_ero_warped2dti.nii.gz -omat ${out_dir}/fieldmap2diff.mat
     flirt -in ${out_dir}/fieldmap_brain_s4.nii.gz -ref ${out_dir}/dwi_den_unr_ec.nii.gz -applyxfm -init ${out_dir}/fieldmap2diff.mat -out ${out_dir}/fieldmap_warped.nii
     # fugue -v -i DTI/data1_corr.nii.gz --icorr --unwarpdir=y --dwell=0.000485 --loadfmap=FieldMap/FieldMap_brain_s4_2_nodif_brain.nii.gz -u data/data.nii.gz
 
-    fugue -v -i ${out_dir}/dwi_den_unr_ec.nii.gz --icorr --dwell=0.000485 --loadfmap=${out_dir}/fieldmap_warped.nii --unwarpdir=y- -u ${out_dir}/dwi_den_unr_epi_ec.nii.gz
+    fugue -v -i ${out_dir}/dwi_den_unr_ec.nii.gz --icorr --dwell=${echo_spacing} --loadfmap=${out_dir}/fieldmap_warped.nii --unwarpdir=y- -u ${out_dir}/dwi_den_unr_epi_ec.nii.gz
 
     # fslpreproc
     # dwifslpreproc ${out_dir}/dwi_den_unr_epi.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
@@ -114,7 +122,7 @@ if [ "$type_data" = "CLINIC" ]; then
 elif [ "$type_data" = "MAINZ" ]; then
     # only fslpreproc
     dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
-    -rpe_none -pe_dir j- -json_import ${json} -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+    -rpe_none -pe_dir j- -json_import ${json} -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
 elif [ "$type_data" = "MILAN" ]; then
     ## CREATE DUAL B0
@@ -136,7 +144,7 @@ elif [ "$type_data" = "MILAN" ]; then
     #IT DOESNT GET READOUT TIME FROM JSON (NOT A BIG DEAL RIGHT)
     # amb 0.02 anava molt bé
     dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear --data_is_shelled" \
-    -rpe_pair -se_epi ${out_dir}/b0_pair.mif -pe_dir j -json_import ${json} -readout_time 0.0828 -align_seepi -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+    -rpe_pair -se_epi ${out_dir}/b0_pair.mif -pe_dir j -json_import ${json} -readout_time ${readout_time} -align_seepi -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
     # dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear --data_is_shelled" \
     # -rpe_none -pe_dir j -json_import ${json} -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
@@ -147,7 +155,7 @@ elif [ "$type_data" = "MILAN" ]; then
 elif [ "$type_data" = "NAPLES" ]; then
     # only fslpreproc
     dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
-    -rpe_none -pe_dir j- -json_import ${json} -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+    -rpe_none -pe_dir j- -json_import ${json} -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
 elif [ "$type_data" = "OSLO" ]; then
     ## CREATE DUAL B0
@@ -158,12 +166,12 @@ elif [ "$type_data" = "OSLO" ]; then
     mrcat ${out_dir}/dwi_b0_og.mif ${out_dir}/dwi_b0_2.mif ${out_dir}/b0_pair.mif -axis 3
     # theoretically, it will get readout time from the json
     dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
-    -rpe_pair -se_epi ${out_dir}/b0_pair.mif -pe_dir j -json_import ${json} -align_seepi -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+    -rpe_pair -se_epi ${out_dir}/b0_pair.mif -pe_dir j -json_import ${json} -align_seepi -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
 elif [ "$type_data" = "AMSTERDAM" ]; then
     # only fslpreproc
     dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
-    -rpe_none -pe_dir j- -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+    -rpe_none -pe_dir j- -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
 elif [ "$type_data" = "LONDON" ]; then
 
@@ -185,7 +193,7 @@ elif [ "$type_data" = "LONDON" ]; then
         #IT DOESNT GET READOUT TIME FROM JSON (NOT A BIG DEAL RIGHT)
         # amb 0.02 anava molt bé
         dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear --data_is_shelled" \
-        -rpe_pair -se_epi ${out_dir}/b0_pair.mif -pe_dir j -json_import ${json} -align_seepi -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+        -rpe_pair -se_epi ${out_dir}/b0_pair.mif -pe_dir j -json_import ${json} -align_seepi -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
         ######### IF MILAN, THEN CREATE AN EXTRA DT_RECON
         # AND IF LONDON, do it too
@@ -197,7 +205,7 @@ elif [ "$type_data" = "LONDON" ]; then
         # if not,
         # only fslpreproc
         dwifslpreproc ${out_dir}/dwi_den_unr.nii.gz  ${out_dir}/dwi_den_unr_epi_ec.nii.gz -fslgrad $bvec $bval -eddy_options " --slm=linear" \
-        -rpe_none -pe_dir j -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads 4
+        -rpe_none -pe_dir j -export_grad_fsl ${out_dir}/bvecs_ec.bvec ${out_dir}/bvals_ec.bval -force -nthreads ${nthreads}
 
     fi
 fi
@@ -231,7 +239,7 @@ mri_vol2vol --mov $lowb --targ ${subj_path}/recon_all/mri/T1.nii.gz  --inv --int
 
 ## BIAS CORRECT
 mrconvert -force ${subj_path}/dt_recon/dwi.nii.gz ${subj_path}/dt_recon/dwi.mif
-dwibiascorrect ants ${subj_path}/dt_recon/dwi.mif ${subj_path}/dt_recon/dwi-ec_unbiased.mif -bias ${out_dir}/bias.mif -fslgrad $bvec $bval -nthreads 4
+dwibiascorrect ants ${subj_path}/dt_recon/dwi.mif ${subj_path}/dt_recon/dwi-ec_unbiased.mif -bias ${out_dir}/bias.mif -fslgrad $bvec $bval -nthreads ${nthreads}
 
 ################################################
 ## PREPARE REGIONS FOR TRACKING
@@ -244,7 +252,7 @@ dwi2mask ${out_dir}/dwi_ec_unbiased.nii.gz -fslgrad $bvec $bval - | mrconvert -f
 
 # find the response using dhollander altogrithm
 dwi2response dhollander ${out_dir}/dwi_ec_unbiased.nii.gz -fslgrad $bvec $bval \
--mask ${out_dir}/dwi_ec_unbiased_mask.nii.gz ${out_dir}/wm.txt ${out_dir}/gm.txt ${out_dir}/csf.txt -voxels ${out_dir}/voxels.mif -force -nthreads 4
+-mask ${out_dir}/dwi_ec_unbiased_mask.nii.gz ${out_dir}/wm.txt ${out_dir}/gm.txt ${out_dir}/csf.txt -voxels ${out_dir}/voxels.mif -force -nthreads ${nthreads}
 
 # differentiate between wm and csf (have only 2 bval for the datasets that I have), except for MILAN (do it manually)
 t=$(tr ' ' '\n' < $bval | sort | uniq -c | wc -l)
@@ -253,10 +261,10 @@ t="$(($t-1))"
 # if we have 3 or more bvals, we can do 3 tissues msmt_csd
 if [ "$t" -ge 3 ]; then
     dwi2fod msmt_csd ${out_dir}/dwi_ec_unbiased.nii.gz -fslgrad $bvec $bval -mask ${out_dir}/dwi_ec_unbiased_mask.nii.gz \
-    ${out_dir}/wm.txt ${out_dir}/wmfod.mif ${out_dir}/gm.txt ${out_dir}/gm.mif ${out_dir}/csf.txt ${out_dir}/csffod.mif -nthreads 4
+    ${out_dir}/wm.txt ${out_dir}/wmfod.mif ${out_dir}/gm.txt ${out_dir}/gm.mif ${out_dir}/csf.txt ${out_dir}/csffod.mif -nthreads ${nthreads}
 else
     dwi2fod msmt_csd ${out_dir}/dwi_ec_unbiased.nii.gz -fslgrad $bvec $bval -mask ${out_dir}/dwi_ec_unbiased_mask.nii.gz \
-    ${out_dir}/wm.txt ${out_dir}/wmfod.mif ${out_dir}/csf.txt ${out_dir}/csffod.mif -nthreads 4
+    ${out_dir}/wm.txt ${out_dir}/wmfod.mif ${out_dir}/csf.txt ${out_dir}/csffod.mif -nthreads ${nthreads}
 fi
 
 ################################################
@@ -312,7 +320,7 @@ mri_vol2vol --mov $lowb --targ ${out_dir}/brainstem.nii.gz --inv --interp neares
 # recommended not to use mask (check documentation ACT)
 # -mask ${out_dir}/dwi_ec_unbiased_mask.nii.gz
 tckgen ${out_dir}/wmfod.mif ${out_dir}/brain_track.tck -algorithm iFOD2 -seed_image \
-${out_dir}/dwi_ec_unbiased_mask.nii.gz -select 6000000 -nthreads 6 \
+${out_dir}/dwi_ec_unbiased_mask.nii.gz -select 6000000 -nthreads ${PIPELINE_NTHREADS:-6} \
 -fslgrad $bvec $bval -act ${out_dir}/5tt2diff.nii -backtrack -cutoff 0.06 -crop_at_gmwmi -exclude ${out_dir}/brainstem2diff.nii.gz -force
 
 #tckgen ${out_dir}/wmfod.mif ${out_dir}/brain_track.tck -algorithm iFOD2 -seed_gmwmi ${out_dir}/gmwmSeed_coreg.mif -select 6000000 -nthreads 6 \
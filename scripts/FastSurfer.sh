@@ -39,7 +39,7 @@ echo "*** Load data & recon_all for FASTSurfer ***"
 # only use for amsterdam
 # fslmaths ${t1} -mas ${t1} ${out_dir}/t1_pos.nii.gz
 
-${FastSurferDir}/run_fastsurfer.sh --t1 ${t1} --sid recon_all --sd ${out_dir} --py python --no_cuda
+${FastSurferDir}/run_fastsurfer.sh --t1 ${t1} --sid recon_all --sd ${out_dir} --py python --no_cuda --threads ${PIPELINE_NTHREADS:-1}
 # 
 echo "*** Adapt filenames and folders to FreeSurfer output so that next scripts works flawlessly ***"
 
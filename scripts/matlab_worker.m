@@ -0,0 +1,60 @@
+function matlab_worker(spm_folder)
+% Worker of the MATLAB pool of the pipeline (lib/matlab_pool.py)
+% SPM (and LST) is added to the path once, and then the jobs are read from
+% stdin, a json per line. The answers are lines that start with @@POOL:
+%   {"type": "ping"}                                    -> @@POOL PONG
+%   {"type": "job", "id": 1, "cd": dir, "eval": "..."}  -> @@POOL DONE 1 ok
+%                                                          @@POOL DONE 1 failed <error>
+%   {"type": "exit"}                                    -> the worker ends
+
+if nargin > 0 && ~isempty(spm_folder)
+    addpath(genpath(spm_folder));
+end
+home = pwd;
+fprintf('@@POOL READY\n');
+
+while true
+    try
+        line = input('', 's');
+    catch
+        % stdin closed, the pool has ended
+        break;
+    end
+    if isempty(strtrim(line))
+        continue;
+    end
+    msg = jsondecode(line);
+    switch msg.type
+        case 'ping'
+            fprintf('@@POOL PONG\n');
+        case 'exit'
+            break;
+        case 'job'
+            [ok, message] = run_job(msg);
+            cd(home);
+            if ok
+                fprintf('@@POOL DONE %d ok\n', msg.id);
+            else
+                fprintf('@@POOL DONE %d failed %s\n', msg.id, strrep(message, newline, ' '));
+            end
+    end
+end
+exit;
+end
+
+function [ok, message] = run_job(msg)
+% run the statement of a job, in its own workspace
+ok = true;
+message = '';
+try
+    if ~isempty(msg.cd)
+        cd(msg.cd);
+    end
+    eval(msg.eval);
+catch err
+    ok = false;
+    message = err.message;
+end
+% figures of the toolboxes (SPM, CONN) are not kept between jobs
+close all force;
+end
@@ -18,13 +18,18 @@ t1_path=$2
 flair_path=$3
 out_dir=$4
 type_dir=$5
+# all (default), or only the part before MATLAB (prepare) or after it
+# (finalize), when ps_LST_lga is run by the MATLAB pool (lib/matlab_pool.py)
+stage=${6:-all}
 
 cd $out_dir
 
-mkdir -p $out_dir/lst/
+if [ "$stage" != "finalize" ]; then
+    mkdir -p $out_dir/lst/
 
-cp $t1_path $out_dir/lst/T1.nii.gz
-cp $flair_path $out_dir/lst/FLAIR.nii.gz
+    cp $t1_path $out_dir/lst/T1.nii.gz
+    cp $flair_path $out_dir/lst/FLAIR.nii.gz
+fi
 
 t1_path=$out_dir/lst/T1.nii.gz
 flair_path=$out_dir/lst/FLAIR.nii.gz
@@ -32,12 +37,20 @@ flair_path=$out_dir/lst/FLAIR.nii.gz
 # ONLY AMSTERDAM
 # TO WORK WITH T1
 if [ "$type_dir" = "AMSTERDAM" ]; then
-    fslmaths ${t1_path} -mas ${t1_path} $out_dir/lst/T1_pos.nii.gz
+    if [ "$stage" != "finalize" ]; then
+        fslmaths ${t1_path} -mas ${t1_path} $out_dir/lst/T1_pos.nii.gz
+    fi
     t1_path=$out_dir/lst/T1_pos.nii.gz
 fi
 
-# other version is ps_LST_lpa
-matlab -nodisplay -nosplash -r "cd '$out_dir';addpath(genpath('$spm_folder'));ps_LST_lga('$t1_path','$flair_path',0.3,1,50);quit;"
+if [ "$stage" = "all" ]; then
+    # other version is ps_LST_lpa
+    matlab -nodisplay -nosplash -r "cd '$out_dir';addpath(genpath('$spm_folder'));ps_LST_lga('$t1_path','$flair_path',0.3,1,50);quit;"
+fi
+
+if [ "$stage" = "prepare" ]; then
+    exit 0
+fi
 
 #this always generates a file
 out_lesion=$out_dir/lst/${subjID}_ROI.nii.gz # need to be same format, or similar, to the clinic ones